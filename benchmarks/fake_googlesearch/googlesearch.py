@@ -0,0 +1,39 @@
+import os
+import time
+import random
+import hashlib
+
+# Offline stand-in for the googlesearch package. benchmarks/run.py puts this
+# directory first on sys.path, so GoogleBackend and find_jobs import it
+# instead of the real module. Every call sleeps for LATENCY seconds (plus up
+# to JITTER) and returns deterministic URLs derived from the query.
+
+LATENCY = float(os.environ.get("BENCH_SEARCH_LATENCY", "0.2"))
+JITTER = float(os.environ.get("BENCH_SEARCH_JITTER", "0.05"))
+# Number of distinct sites results are spread over, so grouping by site has work to do
+SITES = int(os.environ.get("BENCH_SEARCH_SITES", "50"))
+
+calls = 0
+
+class SearchResult:
+    """What the real module yields with advanced=True."""
+
+    def __init__(self, url, title, description):
+        self.url = url
+        self.title = title
+        self.description = description
+
+def search(term, num_results=10, lang="en", advanced=False, **kwargs):
+    global calls
+    calls += 1
+    seed = int(hashlib.sha1(term.encode()).hexdigest()[:8], 16)
+    rng = random.Random(seed)
+    time.sleep(LATENCY + rng.uniform(0, JITTER))
+    for number in range(num_results):
+        site = rng.randrange(SITES)
+        page = rng.choice(["login/index.php", "course/view.php?id=%d" % rng.randrange(100), "", "my/"])
+        url = f"https://moodle{site}.example.edu/lms/{page}"
+        if advanced:
+            yield SearchResult(url, f"Moodle {site}: Log in to the site", f"Learning platform {site}")
+        else:
+            yield url
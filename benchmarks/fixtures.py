@@ -0,0 +1,127 @@
+import os
+import sys
+import stat
+import random
+import hashlib
+import zipfile
+
+# Synthetic trees are generated from a seed, so every run sees the same bytes
+
+# Stub of Moodle's admin/cli/upgrade.php: prints upgrade steps with a small delay
+STUB_UPGRADE_PHP = """<?php
+// Benchmark stand-in for admin/cli/upgrade.php
+$steps = (int)(getenv('BENCH_UPGRADE_STEPS') ?: 20);
+$delay = (int)(getenv('BENCH_UPGRADE_STEP_MS') ?: 10);
+for ($i = 1; $i <= $steps; $i++) {
+    echo "-->upgrade step $i of $steps\\n";
+    usleep($delay * 1000);
+}
+echo "Command line upgrade from 4.1 to 4.1.1 completed successfully.\\n";
+"""
+
+# Python stand-in for the php binary, used when PHP is not installed; it
+# emulates the stub script above
+PHP_SHIM = """#!{python}
+import os, sys, time
+steps = int(os.environ.get("BENCH_UPGRADE_STEPS") or 20)
+delay = int(os.environ.get("BENCH_UPGRADE_STEP_MS") or 10)
+if len(sys.argv) < 2 or not os.path.exists(sys.argv[1]):
+    sys.exit("Could not open input file")
+for i in range(1, steps + 1):
+    print(f"-->upgrade step {{i}} of {{steps}}", flush=True)
+    time.sleep(delay / 1000)
+print("Command line upgrade from 4.1 to 4.1.1 completed successfully.")
+"""
+
+# Function to draw file sizes from a log-normal distribution
+def file_sizes(count, mean_size, sigma, rng, max_size=64 * 1024 * 1024):
+    """Return count sizes whose mean is close to mean_size; sigma controls the spread."""
+    mu = max(1.0, __import__("math").log(mean_size) - sigma ** 2 / 2)
+    return [min(max_size, int(rng.lognormvariate(mu, sigma))) for _ in range(count)]
+
+def _content(rng, size):
+    # Half random, half repetitive, so compression has realistic work to do
+    random_part = rng.randbytes(size // 2)
+    return random_part + (b"moodle " * (size // 14 + 1))[:size - len(random_part)]
+
+# Function to generate a moodledata-like tree
+def make_moodledata(root, files=2000, mean_size=32 * 1024, sigma=1.5, seed=1):
+    """
+    Create a moodledata tree laid out like Moodle's file store
+    (filedir/ab/cd/<sha1>) plus cache, localcache and temp directories.
+    :return: Tuple of (files, bytes) written.
+    """
+    rng = random.Random(seed)
+    total = 0
+    for size in file_sizes(files, mean_size, sigma, rng):
+        data = _content(rng, size)
+        name = hashlib.sha1(data + rng.randbytes(8)).hexdigest()
+        directory = os.path.join(root, "filedir", name[:2], name[2:4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(data)
+        total += size
+    for directory in ("cache", "localcache", "temp", "sessions"):
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    return files, total
+
+# Function to generate a Moodle code tree
+def make_moodle_code(root, files=1000, mean_size=8 * 1024, seed=2, version="2022112800"):
+    """
+    Create a code tree of PHP files spread over typical Moodle directories,
+    with version.php and the stub admin/cli/upgrade.php.
+    :return: Tuple of (files, bytes) written.
+    """
+    rng = random.Random(seed)
+    areas = ["lib", "mod/scorm", "mod/quiz", "course", "user", "admin/tool", "theme/boost", "blocks", "local"]
+    total = 0
+    for number, size in enumerate(file_sizes(files, mean_size, 1.0, rng, max_size=1024 * 1024)):
+        directory = os.path.join(root, rng.choice(areas), f"part{number % 20}")
+        os.makedirs(directory, exist_ok=True)
+        data = b"<?php\n// generated\n" + _content(rng, size)
+        with open(os.path.join(directory, f"file{number}.php"), "wb") as f:
+            f.write(data)
+        total += len(data)
+    os.makedirs(os.path.join(root, "admin", "cli"), exist_ok=True)
+    with open(os.path.join(root, "admin", "cli", "upgrade.php"), "w") as f:
+        f.write(STUB_UPGRADE_PHP)
+    with open(os.path.join(root, "version.php"), "w") as f:
+        f.write(f"<?php\n$version = {version}.00;\n")
+    return files, total
+
+# Function to package a code tree as a Moodle release zip
+def make_release_zip(code_root, zip_path, changed_fraction=0.1, seed=3):
+    """
+    Zip code_root under a top-level moodle/ directory, as Moodle packages are,
+    rewriting changed_fraction of the files so delta upgrades have work to do.
+    :return: Size of the zip in bytes.
+    """
+    rng = random.Random(seed)
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+        for directory, _, names in os.walk(code_root):
+            for name in sorted(names):
+                path = os.path.join(directory, name)
+                arcname = os.path.join("moodle", os.path.relpath(path, code_root))
+                with open(path, "rb") as f:
+                    data = f.read()
+                if name.endswith(".php") and name != "upgrade.php" and rng.random() < changed_fraction:
+                    data += b"\n// changed in release\n"
+                archive.writestr(arcname, data)
+    return os.path.getsize(zip_path)
+
+# Function to make "php" runnable for the upgrade stage
+def install_php_shim(bin_dir, force=False):
+    """
+    Put a php stand-in first on PATH unless a real PHP is installed.
+    :return: True if the shim was installed.
+    """
+    if not force and any(os.access(os.path.join(path, "php"), os.X_OK)
+                         for path in os.environ.get("PATH", "").split(os.pathsep)):
+        return False
+    os.makedirs(bin_dir, exist_ok=True)
+    shim = os.path.join(bin_dir, "php")
+    with open(shim, "w") as f:
+        f.write(PHP_SHIM.format(python=sys.executable))
+    os.chmod(shim, os.stat(shim).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+    return True
@@ -0,0 +1,404 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import contextlib
+import subprocess
+
+# Offline benchmarks for the Moodle tools. Every external service is replaced
+# by a local stand-in: a synthetic moodledata and code tree (fixtures.py), a
+# stub Moodle web-service and download server (stub_server.py), a fake
+# googlesearch module with injected latency and a stub upgrade.php. Results
+# are written as JSON and can be compared with an earlier run.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+# The fake googlesearch must shadow the real one, so it goes first on the path
+sys.path[:0] = [os.path.join(BENCH_DIR, "fake_googlesearch"), REPO_DIR, BENCH_DIR]
+
+from fixtures import make_moodledata, make_moodle_code, make_release_zip, install_php_shim
+from stub_server import StubServer
+
+# Default file the results are written to
+BENCH_RESULTS = "benchmark_results.json"
+# A result slower than the baseline by more than this fraction is a regression
+REGRESSION_THRESHOLD = 0.10
+
+# Workload sizes; "small" finishes in well under a minute
+SCALES = {
+    "small": {"data_files": 500, "data_mean_size": 16 * 1024, "code_files": 300, "download_bytes": 16 << 20,
+              "courses": 200, "search_latency": 0.1},
+    "medium": {"data_files": 3000, "data_mean_size": 64 * 1024, "code_files": 2000, "download_bytes": 64 << 20,
+               "courses": 1000, "search_latency": 0.2},
+    "large": {"data_files": 20000, "data_mean_size": 128 * 1024, "code_files": 8000, "download_bytes": 256 << 20,
+              "courses": 5000, "search_latency": 0.3},
+}
+# Per-connection download bandwidth of the stub server, so segmented downloads have something to gain
+DOWNLOAD_BANDWIDTH = 32 << 20
+# Latency the stub server adds to every web-service call
+WS_LATENCY = 0.005
+
+def quiet(*args, **kwargs):
+    pass
+
+# Function to time a benchmark body over several runs
+def measure(body, repeat, setup=None):
+    """
+    Run setup() (untimed) and body() repeat times.
+    :return: Dict with every run's seconds, the best and the median, plus
+             whatever counters the last body() returned.
+    """
+    runs = []
+    extra = {}
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            extra = body() or {}
+        runs.append(time.perf_counter() - started)
+    result = {"seconds": [round(run, 4) for run in runs], "best": round(min(runs), 4),
+              "median": round(statistics.median(runs), 4)}
+    result.update(extra)
+    if "bytes" in extra:
+        result["mb_per_s"] = round(extra["bytes"] / statistics.median(runs) / 1e6, 1)
+    return result
+
+def tree_size(path):
+    files = total = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            total += os.path.getsize(os.path.join(directory, name))
+    return files, total
+
+class Context:
+    """Fixtures shared by the benchmarks of one run."""
+
+    def __init__(self, workdir, scale, repeat, server):
+        self.workdir = workdir
+        self.scale = scale
+        self.repeat = repeat
+        self.server = server
+        self.code = os.path.join(workdir, "site", "moodle")
+        self.data = os.path.join(workdir, "site", "moodledata")
+        self.release_zip = os.path.join(server.files_dir, "moodle-latest.zip")
+        self.payload = os.path.join(server.files_dir, "payload.bin")
+
+    def fresh_code(self, name):
+        """Return a private copy of the code tree for benchmarks that modify it."""
+        path = os.path.join(self.workdir, "scratch", name, "moodle")
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        shutil.copytree(self.code, path, symlinks=True)
+        return path
+
+def prepare(ctx):
+    scale = ctx.scale
+    started = time.perf_counter()
+    data_files, data_bytes = make_moodledata(ctx.data, scale["data_files"], scale["data_mean_size"])
+    code_files, code_bytes = make_moodle_code(ctx.code, scale["code_files"])
+    zip_bytes = make_release_zip(ctx.code, ctx.release_zip)
+    rng = random.Random(4)
+    with open(ctx.payload, "wb") as f:
+        for _ in range(scale["download_bytes"] // (1 << 20)):
+            f.write(rng.randbytes(1 << 20))
+    print(f"Fixtures: {data_files} data file(s) ({data_bytes / 1e6:.1f} MB), {code_files} code file(s) "
+          f"({code_bytes / 1e6:.1f} MB), release zip {zip_bytes / 1e6:.1f} MB, "
+          f"download payload {scale['download_bytes'] / 1e6:.0f} MB in {time.perf_counter() - started:.1f}s.")
+
+def bench_backup(ctx):
+    import moodle_upgrade
+
+    files, nbytes = (a + b for a, b in zip(tree_size(ctx.code), tree_size(ctx.data)))
+    counters = {"files": files, "bytes": nbytes}
+
+    def clean():
+        for pattern in ("*_backup", "*_snapshots", "*_backup_*.tar.gz"):
+            for path in glob.glob(os.path.join(os.path.dirname(ctx.code), pattern)):
+                shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+    def backup(mode):
+        moodle_upgrade.backup_site(ctx.code, ctx.data, mode=mode, log=quiet)
+        return counters
+
+    def first_snapshot():
+        clean()
+        backup("snapshot")
+
+    results = {}
+    for mode in ("copy", "archive", "snapshot"):
+        results[f"backup.{mode}"] = measure(lambda: backup(mode), ctx.repeat, setup=clean)
+    # A second snapshot of an unchanged tree only hard-links files
+    results["backup.snapshot_incremental"] = measure(lambda: backup("snapshot"), ctx.repeat, setup=first_snapshot)
+    clean()
+    return results
+
+def bench_download(ctx):
+    import moodle_upgrade
+
+    url = ctx.server.file_url(os.path.basename(ctx.payload))
+    size = os.path.getsize(ctx.payload)
+    cache_dir = os.path.join(ctx.workdir, "download-cache")
+
+    def download(segments=moodle_upgrade.DOWNLOAD_SEGMENTS):
+        moodle_upgrade.download_file(url, cache_dir, segments=segments, log=quiet)
+        return {"bytes": size}
+
+    results = {}
+    for segments in (1, moodle_upgrade.DOWNLOAD_SEGMENTS):
+        results[f"download.segments_{segments}"] = measure(
+            lambda: download(segments), ctx.repeat, setup=lambda: shutil.rmtree(cache_dir, ignore_errors=True)
+        )
+    # A repeated download is answered from the content-addressed cache
+    results["download.cached"] = measure(lambda: download() and None, ctx.repeat)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+def bench_extract(ctx):
+    import moodle_upgrade
+
+    dest = os.path.join(ctx.workdir, "scratch", "extract")
+
+    def extract(workers):
+        files, nbytes = moodle_upgrade.extract_zip_parallel(ctx.release_zip, dest, workers=workers)
+        return {"files": files, "bytes": nbytes}
+
+    results = {}
+    for workers in (1, moodle_upgrade.COPY_WORKERS):
+        results[f"extract.workers_{workers}"] = measure(
+            lambda: extract(workers), ctx.repeat, setup=lambda: shutil.rmtree(dest, ignore_errors=True)
+        )
+    for delta in (False, True):
+        code = {}
+        results["replace.delta" if delta else "replace.staged"] = measure(
+            lambda: moodle_upgrade.install_release(code["path"], ctx.release_zip, delta=delta, log=quiet),
+            ctx.repeat, setup=lambda: code.update(path=ctx.fresh_code("replace"))
+        )
+    shutil.rmtree(os.path.join(ctx.workdir, "scratch"), ignore_errors=True)
+    return results
+
+def bench_courses(ctx):
+    import scorm
+
+    count = ctx.scale["courses"]
+    runs = iter(range(1000))
+    results = {}
+    for batch_size in (1, scorm.COURSE_BATCH_SIZE):
+        def create():
+            run = next(runs)
+            courses = [{"fullname": f"Course {run}-{i}", "shortname": f"C{run}-{i}", "categoryid": 1 + i % 3,
+                        "idnumber": f"ID{run}-{i}", "format": "singleactivity"} for i in range(count)]
+            course_ids, errors = scorm.create_courses(courses, batch_size=batch_size)
+            if errors:
+                raise Exception(f"Course creation failed: {next(iter(errors.values()))}")
+            return {"courses": count}
+        # Rate limiting is the server's policy, not this code's speed, so it is lifted here
+        scorm.client = scorm.MoodleWSClient(ctx.server.ws_endpoint, ctx.server.token, rate=1e6, burst=1e6)
+        results[f"courses.batch_{batch_size}"] = measure(create, ctx.repeat)
+        results[f"courses.batch_{batch_size}"]["calls"] = sum(
+            stats["count"] for stats in scorm.client.latency_report().values()) // ctx.repeat
+        scorm.client.close()
+    results.update(bench_courses_async(ctx, runs))
+    return results
+
+def bench_courses_async(ctx, runs):
+    import asyncio
+    import importlib.util
+    import scorm
+
+    # The async client is optional, and so is its benchmark
+    if importlib.util.find_spec("httpx") is None:
+        print("  courses.async skipped: httpx is not installed")
+        return {}
+
+    count = ctx.scale["courses"]
+    batch_size = scorm.COURSE_BATCH_SIZE
+    calls = {}
+
+    async def create_batches(run):
+        client = scorm.AsyncMoodleWSClient(ctx.server.ws_endpoint, ctx.server.token, rate=1e6, burst=1e6)
+        try:
+            courses = [{"fullname": f"Course {run}-{i}", "shortname": f"C{run}-{i}", "categoryid": 1 + i % 3,
+                        "idnumber": f"ID{run}-{i}", "format": "singleactivity"} for i in range(count)]
+            responses = await asyncio.gather(*(
+                client.call("core_course_create_courses", {"courses": courses[start:start + batch_size]})
+                for start in range(0, count, batch_size)))
+            created = [course for response in responses for course in response]
+            # Read the courses back, so a call whose form encoding is wrong fails here instead of passing
+            found = await client.call("core_course_get_courses_by_field",
+                                      {"field": "idnumber", "value": courses[-1]["idnumber"]})
+            idnumbers = [course["idnumber"] for course in found["courses"]]
+            if len(created) != count or idnumbers != [courses[-1]["idnumber"]]:
+                raise Exception(f"Async course creation returned {len(created)} of {count} course(s).")
+            calls.update(count=sum(stats["count"] for stats in client.latency_report().values()))
+        finally:
+            await client.aclose()
+
+    def create():
+        asyncio.run(create_batches(next(runs)))
+        return {"courses": count}
+
+    result = measure(create, ctx.repeat)
+    result["calls"] = calls["count"]
+    return {f"courses.async_batch_{batch_size}": result}
+
+def bench_search(ctx):
+    import googlesearch
+    import search_core
+    from search_backends import RateLimiter
+
+    googlesearch.LATENCY = ctx.scale["search_latency"]
+    # The live limiter keeps Google polite; here it would only measure itself
+    search_core.search_limiter = RateLimiter(1000.0)
+    workers = search_core.SEARCH_WORKERS
+
+    def fan_out(refresh):
+        search = search_core.SiteSearch("moodle login", "", search_in_domains=True, refresh=refresh)
+        count, status = search.run(lambda sites, progress: None)
+        return {"queries": len(search.queries()), "sites": count}
+
+    results = {}
+    for search_workers in (1, workers):
+        search_core.SEARCH_WORKERS = search_workers
+        results[f"search.workers_{search_workers}"] = measure(lambda: fan_out(True), ctx.repeat)
+    results["search.cached"] = measure(lambda: fan_out(False), ctx.repeat)
+    search_core.SEARCH_WORKERS = workers
+    return results
+
+def bench_pipeline(ctx):
+    import moodle_upgrade
+
+    url = ctx.server.file_url(os.path.basename(ctx.release_zip))
+    shim = install_php_shim(os.path.join(ctx.workdir, "bin"))
+    site = {}
+    stages = {}
+
+    def setup():
+        code = ctx.fresh_code("pipeline")
+        data = os.path.join(os.path.dirname(code), "moodledata")
+        shutil.copytree(ctx.data, data)
+        site.update(name="bench", code_path=code, data_path=data, url=url, dump_database=False,
+                    backup_mode="snapshot", delta=True)
+        shutil.rmtree(os.path.join(ctx.workdir, "pipeline-cache"), ignore_errors=True)
+
+    def upgrade():
+        downloads = moodle_upgrade.SharedDownloads(cache_dir=os.path.join(ctx.workdir, "pipeline-cache"))
+        timings = moodle_upgrade.upgrade_site(site, downloads, threading.Lock(), log=quiet)
+        for name, seconds in timings.items():
+            stages.setdefault(name, []).append(round(seconds, 4))
+
+    result = measure(upgrade, ctx.repeat, setup=setup)
+    result["stages"] = {name: round(statistics.median(runs), 4) for name, runs in stages.items()}
+    result["php"] = "shim" if shim else "php"
+    shutil.rmtree(os.path.join(ctx.workdir, "scratch"), ignore_errors=True)
+    return {"pipeline.upgrade_site": result}
+
+BENCHMARKS = {
+    "backup": bench_backup,
+    "download": bench_download,
+    "extract": bench_extract,
+    "courses": bench_courses,
+    "search": bench_search,
+    "pipeline": bench_pipeline,
+}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Function to compare a run with an earlier one
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """
+    Print the median of every benchmark next to the baseline's.
+    :return: Names of the benchmarks slower than the baseline by more than threshold.
+    """
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'} ({baseline.get('created')}):")
+    for name, result in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            print(f"  {name:32} {result['median']:9.4f}s  (new)")
+            continue
+        ratio = result["median"] / max(before["median"], 1e-9)
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print(f"  {name:32} {result['median']:9.4f}s  was {before['median']:9.4f}s  x{ratio:.2f}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the offline Moodle tools benchmarks")
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--scale", choices=SCALES, default="small", help="workload size")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark")
+    parser.add_argument("--output", default=BENCH_RESULTS, help="JSON file the results are written to")
+    parser.add_argument("--compare", metavar="JSON", help="earlier results to compare with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="slowdown treated as a regression, as a fraction")
+    parser.add_argument("--workdir", help="directory for fixtures (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="keep the fixtures afterwards")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="moodle-bench-"))
+    files_dir = os.path.join(workdir, "files")
+    os.makedirs(files_dir, exist_ok=True)
+    scale = SCALES[args.scale]
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale": args.scale,
+        "params": dict(scale, repeat=args.repeat, download_bandwidth=DOWNLOAD_BANDWIDTH, ws_latency=WS_LATENCY),
+        "results": {},
+    }
+    cwd = os.getcwd()
+    try:
+        with StubServer(files_dir, ws_latency=WS_LATENCY, bandwidth=DOWNLOAD_BANDWIDTH) as server:
+            # Caches and databases the tools create in the working directory stay in the fixtures
+            os.chdir(workdir)
+            ctx = Context(workdir, scale, args.repeat, server)
+            prepare(ctx)
+            for name in args.benchmarks or BENCHMARKS:
+                print(f"Running {name}...")
+                for result_name, result in BENCHMARKS[name](ctx).items():
+                    report["results"][result_name] = result
+                    print(f"  {result_name:32} median {result['median']:.4f}s, best {result['best']:.4f}s"
+                          + (f", {result['mb_per_s']} MB/s" if "mb_per_s" in result else ""))
+    finally:
+        os.chdir(cwd)
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}.")
+    if baseline is not None and compare(baseline, report, args.threshold):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for a Moodle site and the download server: it emulates the
+# REST endpoint at /webservice/rest/server.php for the functions scorm.py
+# calls, and serves files from a directory with HEAD, ETag, Range and
+# <file>.sha256 support, as download.moodle.org does.
+
+WS_PATH = "/webservice/rest/server.php"
+FILES_PATH = "/files/"
+
+# Function to rebuild nested web-service parameters from flattened form fields
+def unflatten_params(pairs):
+    """Turn courses[0][fullname]=x pairs back into {'courses': [{'fullname': 'x'}]}."""
+    root = {}
+    for key, value in pairs:
+        parts = re.findall(r"[^\[\]]+", key)
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+
+    def listify(node):
+        if not isinstance(node, dict):
+            return node
+        if node and all(key.isdigit() for key in node):
+            return [listify(node[key]) for key in sorted(node, key=int)]
+        return {key: listify(value) for key, value in node.items()}
+    return listify(root)
+
+class FakeMoodle:
+    """In-memory state of the emulated Moodle site."""
+
+    def __init__(self, categories=(1, 2, 3)):
+        self.lock = threading.Lock()
+        self.categories = set(categories)
+        self.courses = {}
+        self.next_id = 2
+        self.next_itemid = 1000
+        self.calls = {}
+
+    def error(self, message, errorcode="invalidparameter"):
+        return {"exception": "invalid_parameter_exception", "errorcode": errorcode, "message": message}
+
+    def handle(self, wsfunction, params):
+        with self.lock:
+            self.calls[wsfunction] = self.calls.get(wsfunction, 0) + 1
+            handler = getattr(self, wsfunction, None)
+            if handler is None:
+                return self.error(f"Can't find data record in database table external_functions. ({wsfunction})",
+                                  "invalidrecord")
+            return handler(params)
+
+    def core_course_create_courses(self, params):
+        courses = params.get("courses", [])
+        shortnames = [course.get("shortname") for course in courses]
+        # Moodle validates the whole batch first and creates nothing if one course is invalid
+        for course in courses:
+            if course.get("shortname") in self.courses or shortnames.count(course.get("shortname")) > 1:
+                return self.error(f"Short name is already used for another course ({course.get('shortname')})",
+                                  "shortnametaken")
+            if int(course.get("categoryid", 0)) not in self.categories:
+                return self.error("Category does not exist", "invalidrecord")
+        created = []
+        for course in courses:
+            record = dict(course, id=self.next_id)
+            record["categoryid"] = int(record.get("categoryid", 0))
+            self.courses[course["shortname"]] = record
+            created.append({"id": self.next_id, "shortname": course["shortname"]})
+            self.next_id += 1
+        return created
+
+    def core_course_get_courses_by_field(self, params):
+        field, value = params.get("field", ""), params.get("value", "")
+        field = {"category": "categoryid"}.get(field, field)
+        courses = [course for course in self.courses.values()
+                   if not field or str(course.get(field, "")) == str(value)]
+        return {"courses": courses, "warnings": []}
+
+    def core_course_get_categories(self, params):
+        return [{"id": category, "name": f"Category {category}", "parent": 0} for category in sorted(self.categories)]
+
+    def mod_scorm_add_scorm(self, params):
+        return {"id": self.next_id}
+
+    def core_files_upload(self, length):
+        self.calls["core_files_upload"] = self.calls.get("core_files_upload", 0) + 1
+        self.next_itemid += 1
+        return [{"component": "user", "contextid": 5, "filearea": "draft", "itemid": self.next_itemid,
+                 "filepath": "/", "filesize": length}]
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # Headers and body go out in separate writes
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json", headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != WS_PATH:
+            return self.send_body(404, b"{}")
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        time.sleep(self.server.ws_latency)
+        query = dict(parse_qsl(url.query))
+        if query.get("wsfunction") == "core_files_upload":
+            # Parse the multipart body so malformed uploads fail as they would on Moodle
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode() + body)
+            if not any(part.get_filename() for part in message.iter_parts()):
+                return self.send_body(200, json.dumps({"error": "No file uploaded", "errorcode": "nofile"}).encode())
+            response = self.server.moodle.core_files_upload(length)
+        else:
+            pairs = parse_qsl(body.decode(), keep_blank_values=True)
+            fields = dict(pairs)
+            if fields.get("wstoken") != self.server.token:
+                response = {"exception": "moodle_exception", "errorcode": "invalidtoken",
+                            "message": "Invalid token - token not found"}
+            else:
+                params = unflatten_params([(k, v) for k, v in pairs
+                                           if k not in ("wstoken", "wsfunction", "moodlewsrestformat")])
+                response = self.server.moodle.handle(fields.get("wsfunction"), params)
+        self.send_body(200, json.dumps(response).encode())
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if not url.path.startswith(FILES_PATH):
+            return self.send_body(404, b"")
+        name = os.path.basename(url.path[len(FILES_PATH):])
+        if name.endswith(".sha256"):
+            path = os.path.join(self.server.files_dir, name[:-len(".sha256")])
+            if not os.path.isfile(path):
+                return self.send_body(404, b"")
+            return self.send_body(200, f"{self.server.sha256(path)}  {os.path.basename(path)}\n".encode(),
+                                  "text/plain")
+        path = os.path.join(self.server.files_dir, name)
+        if not os.path.isfile(path):
+            return self.send_body(404, b"")
+        size = os.path.getsize(path)
+        headers = [("Accept-Ranges", "bytes" if self.server.ranges else "none"), ("ETag", f'"{self.server.sha256(path)[:16]}"')]
+        start, end = 0, size - 1
+        status = 200
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match and self.server.ranges:
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start > end:
+                return self.send_body(416, b"", headers=[("Content-Range", f"bytes */{size}")])
+            status = 206
+            headers.append(("Content-Range", f"bytes {start}-{end}/{size}"))
+        self.send_response(status)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(end - start + 1))
+        for header, value in headers:
+            self.send_header(header, value)
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        self.stream(path, start, end - start + 1)
+
+    def stream(self, path, offset, remaining):
+        """Send a byte range, throttled to the server's per-connection bandwidth if one is set."""
+        rate = self.server.bandwidth
+        block = 64 * 1024
+        started = time.monotonic()
+        sent = 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while remaining > 0:
+                data = f.read(min(block, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                sent += len(data)
+                remaining -= len(data)
+                if rate:
+                    ahead = sent / rate - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Serve StubHandler on 127.0.0.1 from a background thread.
+    :param files_dir: Directory whose files are served under /files/.
+    :param ws_latency: Seconds added to every web-service call.
+    :param bandwidth: Bytes per second per connection for file downloads; 0 for unthrottled.
+    :param ranges: Honour Range requests; False emulates a server without them.
+    """
+    daemon_threads = True
+
+    def __init__(self, files_dir=".", ws_latency=0.0, bandwidth=0, ranges=True, token="bench-token"):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.files_dir = files_dir
+        self.ws_latency = ws_latency
+        self.bandwidth = bandwidth
+        self.ranges = ranges
+        self.token = token
+        self.moodle = FakeMoodle()
+        self.hashes = {}
+        self.hashes_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    @property
+    def ws_endpoint(self):
+        return self.url + WS_PATH
+
+    def file_url(self, name):
+        return self.url + FILES_PATH + name
+
+    def sha256(self, path):
+        key = (path, os.path.getmtime(path))
+        with self.hashes_lock:
+            if key not in self.hashes:
+                digest = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(block)
+                self.hashes[key] = digest.hexdigest()
+            return self.hashes[key]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the stub Moodle and download server in the foreground")
+    parser.add_argument("--files", default=".", help="directory served under /files/")
+    parser.add_argument("--ws-latency", type=float, default=0.0, help="seconds added to every web-service call")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes per second per download connection")
+    args = parser.parse_args()
+    with StubServer(args.files, args.ws_latency, args.bandwidth) as server:
+        print(f"Web services: {server.ws_endpoint} (token {server.token})")
+        print(f"Files:        {server.url}{FILES_PATH}<name>")
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
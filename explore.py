@@ -3,10 +3,12 @@ import logging
 import webbrowser
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QVBoxLayout, QWidget, QPushButton,
-    QLineEdit, QListWidget, QLabel, QComboBox, QCheckBox
+    QLineEdit, QLabel, QComboBox, QCheckBox
 )
 from PyQt5.QtCore import Qt, QThread, pyqtSignal
-from googlesearch import search
+from search_backends import GoogleBackend, LocalIndexBackend
+from search_core import COUNTRY_DATA, SiteSearch
+from result_view import ResultListModel, make_result_view
 
 # Configure logging
 logging.basicConfig(
@@ -15,59 +17,23 @@ logging.basicConfig(
     filename="moodle_search.log"
 )
 
-# Dictionary of country codes, full names, and their national domains
-COUNTRY_DATA = {
-    "us": {"name": "United States", "domain": "site:us"},
-    "uk": {"name": "United Kingdom", "domain": "site:uk"},
-    "ca": {"name": "Canada", "domain": "site:ca"},
-    "au": {"name": "Australia", "domain": "site:au"},
-    "in": {"name": "India", "domain": "site:in"},
-    "de": {"name": "Germany", "domain": "site:de"},
-    "fr": {"name": "France", "domain": "site:fr"},
-    "ae": {"name": "United Arab Emirates", "domain": "site:ae"},
-    "sa": {"name": "Saudi Arabia", "domain": "site:sa"},
-    "om": {"name": "Oman", "domain": "site:om"},
-    "qa": {"name": "Qatar", "domain": "site:qa"},
-    "kw": {"name": "Kuwait", "domain": "site:kw"},
-    "bh": {"name": "Bahrain", "domain": "site:bh"},
-    # Add more countries as needed
-}
-
 class SearchThread(QThread):
     """Thread to perform the Google search in the background."""
-    search_finished = pyqtSignal(list, str)  # Signal to emit search results and status
+    results_ready = pyqtSignal(list, str)  # Signal to emit a batch of (site root, row text) pairs and the progress
+    search_finished = pyqtSignal(int, str)  # Signal to emit the number of sites found and status
 
-    def __init__(self, query, country_code, search_in_domains=False):
+    def __init__(self, query, country_code, search_in_domains=False, refresh=False, backend=None):
         super().__init__()
-        self.query = query
-        self.country_code = country_code
-        self.search_in_domains = search_in_domains
+        self.search = SiteSearch(query, country_code, search_in_domains, refresh, backend)
+        self.cancelled = self.search.cancelled
+
+    def cancel(self):
+        """Stop starting new queries; queries already sent are abandoned."""
+        self.search.cancel()
 
     def run(self):
-        try:
-            results = []
-            if self.search_in_domains:
-                if self.country_code:
-                    # Search within the selected country's domain
-                    domain = COUNTRY_DATA[self.country_code]["domain"]
-                    query = f"{self.query} {domain}"
-                    results = list(search(query, num_results=10))
-                else:
-                    # Search within all country domains
-                    for code, data in COUNTRY_DATA.items():
-                        query = f"{self.query} {data['domain']}"
-                        results.extend(list(search(query, num_results=10)))
-            else:
-                # Perform a general search
-                query = self.query
-                if self.country_code:
-                    query += f" cr:{self.country_code}"
-                results = list(search(query, num_results=10))
+        self.search_finished.emit(*self.search.run(self.results_ready.emit))
 
-            self.search_finished.emit(results, f"Found {len(results)} result(s).")
-        except Exception as e:
-            logging.error(f"Search error: {e}")
-            self.search_finished.emit([], "An error occurred. Please try again later.")
 
 class MoodleSearchApp(QMainWindow):
     def __init__(self):
@@ -101,12 +67,31 @@ class MoodleSearchApp(QMainWindow):
         self.domain_checkbox.setToolTip("Search within national domains for more specific results")
         self.layout.addWidget(self.domain_checkbox)
 
+        # Dropdown for the search backend
+        self.backend_selector = QComboBox(self)
+        self.backend_selector.addItem("Google", "google")
+        self.backend_selector.addItem("Local index (offline)", "local")
+        self.backend_selector.setToolTip("Search Google live, or the local index of previously found sites")
+        self.layout.addWidget(self.backend_selector)
+
+        # Checkbox to bypass cached results
+        self.refresh_checkbox = QCheckBox("Refresh cached results", self)
+        self.refresh_checkbox.setToolTip("Search live even if this query was run recently")
+        self.layout.addWidget(self.refresh_checkbox)
+
         # Search button
         self.search_button = QPushButton("Search", self)
         self.search_button.clicked.connect(self.perform_search)
         self.search_button.setToolTip("Start the search")
         self.layout.addWidget(self.search_button)
 
+        # Cancel button
+        self.cancel_button = QPushButton("Cancel", self)
+        self.cancel_button.clicked.connect(self.cancel_search)
+        self.cancel_button.setToolTip("Stop the running search")
+        self.cancel_button.setEnabled(False)
+        self.layout.addWidget(self.cancel_button)
+
         # Clear button
         self.clear_button = QPushButton("Clear", self)
         self.clear_button.clicked.connect(self.clear_results)
@@ -119,12 +104,14 @@ class MoodleSearchApp(QMainWindow):
         self.layout.addWidget(self.status_label)
 
         # List widget to display search results
-        self.results_list = QListWidget(self)
-        self.results_list.itemDoubleClicked.connect(self.open_url)
+        self.results_model = ResultListModel(self)
+        self.results_list = make_result_view(self.results_model, self)
+        self.results_list.doubleClicked.connect(self.open_url)
         self.layout.addWidget(self.results_list)
 
         # Thread for search
         self.search_thread = None
+        self.backends = {}
 
     def perform_search(self):
         """Perform a Google search based on the user's input."""
@@ -144,39 +131,66 @@ class MoodleSearchApp(QMainWindow):
             self.status_label.setText("Search query is too long. Please shorten it.")
             return
 
+        try:
+            backend = self.get_backend(self.backend_selector.currentData())
+        except Exception as e:
+            logging.error(f"Backend error: {e}")
+            self.status_label.setText(f"Search backend unavailable: {e}")
+            return
+
         self.status_label.setText("Searching...")
-        self.results_list.clear()
+        self.results_model.clear()
         self.search_button.setEnabled(False)  # Disable search button during search
+        self.cancel_button.setEnabled(True)
 
         # Start the search in a separate thread
-        self.search_thread = SearchThread(query, country_code, search_in_domains)
+        self.search_thread = SearchThread(query, country_code, search_in_domains,
+                                          self.refresh_checkbox.isChecked(), backend)
+        self.search_thread.results_ready.connect(self.add_results)
         self.search_thread.search_finished.connect(self.update_results)
         self.search_thread.start()
 
-    def update_results(self, results, status):
-        """Update the UI with search results and status."""
-        if results:
-            self.results_list.addItems(results)
-            self.status_label.setText(f"Found {len(results)} result(s).")
-        else:
-            self.status_label.setText("No results found. Please refine your search.")
+    def get_backend(self, name):
+        """Return the backend selected in the UI; Google results are harvested into the local index."""
+        if name not in self.backends:
+            if name == "local":
+                self.backends[name] = LocalIndexBackend()
+            else:
+                self.backends[name] = GoogleBackend(harvest_index=self.get_backend("local"))
+        return self.backends[name]
+
+    def add_results(self, sites, progress):
+        """Add new sites and refresh the counts of known ones as results arrive."""
+        self.results_model.upsert(sites)
+        self.status_label.setText(f"Searching... {self.results_model.rowCount()} site(s) so far ({progress}).")
+
+    def update_results(self, total, status):
+        """Update the UI with the final search status."""
+        self.status_label.setText(status)
         self.search_button.setEnabled(True)  # Re-enable search button
+        self.cancel_button.setEnabled(False)
+
+    def cancel_search(self):
+        """Cancel the running search."""
+        if self.search_thread and self.search_thread.isRunning():
+            self.search_thread.cancel()
+            self.status_label.setText("Cancelling...")
 
     def clear_results(self):
         """Clear the search input and results."""
         self.search_input.clear()
-        self.results_list.clear()
+        self.results_model.clear()
         self.status_label.setText("Enter a search query and click 'Search'")
 
-    def open_url(self, item):
+    def open_url(self, index):
         """Open the selected URL in the default web browser."""
-        url = item.text()
+        url = index.data(Qt.UserRole)
         webbrowser.open(url)
 
     def closeEvent(self, event):
         """Ensure the search thread is terminated when the window is closed."""
         if self.search_thread and self.search_thread.isRunning():
-            self.search_thread.quit()
+            self.search_thread.cancel()
             self.search_thread.wait()
         event.accept()
 
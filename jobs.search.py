@@ -1,44 +1,34 @@
 import sys
 import random
 import logging
+import webbrowser
 from PyQt5.QtCore import QThread, pyqtSignal
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QListWidget, QMessageBox, QTextEdit
-from googlesearch import search  # Import the Google Search function
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QListWidget, QMessageBox, QCheckBox, QAbstractItemView
+from search_core import ResultBatcher, find_jobs
+from result_view import ResultListModel, make_result_view
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 class JobSearchThread(QThread):
-    results_ready = pyqtSignal(str)
+    results_ready = pyqtSignal(list)  # Batches of result lines
     error_occurred = pyqtSignal(str)
 
-    def __init__(self, job_titles, parent=None):
+    def __init__(self, job_titles, parent=None, refresh=False, only_new=False):
         super().__init__(parent)
         self.job_titles = job_titles
+        self.refresh = refresh
+        self.only_new = only_new
 
     def run(self):
-        for job_title in self.job_titles:
-            try:
-                self.results_ready.emit(f"Searching for '{job_title}' jobs on Google...\n")
-                
-                # Perform Google search
-                search_results = search(
-                    f"{job_title} jobs",  # Search query as the first positional argument
-                    stop=10,  # Stop after fetching 10 results
-                    pause=2.0  # Delay between requests (in seconds)
-                )
-
-                if not search_results:
-                    self.results_ready.emit(f"No jobs found for '{job_title}'.\n")
-                    continue
-
-                for result in search_results:
-                    self.results_ready.emit(f"Link: {result}\n")
-                    self.results_ready.emit("-" * 50 + "\n")
-
-            except Exception as e:
-                logging.error(f"Error fetching jobs for '{job_title}': {e}")
-                self.error_occurred.emit(f"Error fetching jobs for '{job_title}': {e}\n")
+        batcher = ResultBatcher(self.results_ready.emit)
+        try:
+            count = find_jobs(self.job_titles, batcher.add, self.only_new, self.refresh)
+            batcher.add([f"Done: {count} posting(s) listed."])
+        except Exception as e:
+            logging.error(f"Error fetching jobs: {e}")
+            self.error_occurred.emit(f"Error fetching jobs: {e}")
+        batcher.flush()
 
 
 class JobSearchApp(QWidget):
@@ -66,6 +56,7 @@ class JobSearchApp(QWidget):
         self.job_title_label = QLabel("Job Titles:")
         self.job_title_list = QListWidget()
         self.job_title_list.addItems(self.job_titles)
+        self.job_title_list.setSelectionMode(QAbstractItemView.ExtendedSelection)
         layout.addWidget(self.job_title_label)
         layout.addWidget(self.job_title_list)
 
@@ -78,6 +69,14 @@ class JobSearchApp(QWidget):
         layout.addWidget(self.new_job_title_input)
         layout.addWidget(self.add_job_title_button)
 
+        # Force a live search instead of using cached results
+        self.refresh_checkbox = QCheckBox("Refresh cached results")
+        layout.addWidget(self.refresh_checkbox)
+
+        # Only list postings that earlier runs did not find
+        self.only_new_checkbox = QCheckBox("Only show postings new since the last run")
+        layout.addWidget(self.only_new_checkbox)
+
         # Search button
         self.search_button = QPushButton("Search Jobs")
         self.search_button.clicked.connect(self.search_jobs)
@@ -85,8 +84,9 @@ class JobSearchApp(QWidget):
 
         # Results display
         self.results_label = QLabel("Search Results:")
-        self.results_display = QTextEdit()
-        self.results_display.setReadOnly(True)
+        self.results_model = ResultListModel(self)
+        self.results_display = make_result_view(self.results_model)
+        self.results_display.doubleClicked.connect(self.open_url)
         layout.addWidget(self.results_label)
         layout.addWidget(self.results_display)
 
@@ -111,19 +111,24 @@ class JobSearchApp(QWidget):
             return
 
         # Clear previous results
-        self.results_display.clear()
+        self.results_model.clear()
 
         # Start search in a separate thread
-        self.thread = JobSearchThread(selected_job_titles)
+        self.thread = JobSearchThread(selected_job_titles, refresh=self.refresh_checkbox.isChecked(),
+                                      only_new=self.only_new_checkbox.isChecked())
         self.thread.results_ready.connect(self.update_results)
         self.thread.error_occurred.connect(self.show_error)
         self.thread.start()
 
-    def update_results(self, text):
-        self.results_display.append(text)
+    def update_results(self, lines):
+        self.results_model.append(lines)
 
     def show_error(self, error_message):
-        self.results_display.append(error_message)
+        self.results_model.append([error_message])
+
+    def open_url(self, index):
+        if index.data().startswith("http"):
+            webbrowser.open(index.data())
 
 
 if __name__ == "__main__":
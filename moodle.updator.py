@@ -1,12 +1,70 @@
 import sys
 import os
-import shutil
-import subprocess
-import requests
-import mysql.connector
+import time
+import threading
 from PyQt5.QtWidgets import (
-    QApplication, QMainWindow, QLabel, QPushButton, QLineEdit, QTextEdit, QVBoxLayout, QWidget, QFileDialog, QMessageBox
+    QApplication, QMainWindow, QLabel, QPushButton, QLineEdit, QTextEdit, QVBoxLayout, QWidget, QFileDialog, QMessageBox,
+    QCheckBox, QSpinBox, QComboBox, QProgressBar
 )
+from PyQt5.QtCore import QThread, pyqtSignal
+from moodle_upgrade import (
+    COPY_WORKERS, DOWNLOAD_SEGMENTS, DUMP_WORKERS, SNAPSHOT_RETENTION, WARMUP_CONCURRENCY, WARMUP_PATHS,
+    SharedDownloads, StageMetrics, rollback_release, upgrade_site
+)
+
+# Lines kept in the log display; older lines are dropped as new ones arrive
+LOG_MAX_LINES = 5000
+
+
+class UpgradeThread(QThread):
+    """Thread to run the upgrade pipeline in the background."""
+    log_ready = pyqtSignal(str)
+    progress_ready = pyqtSignal(str, int)  # Progress text and percent (-1 when the total is unknown)
+    upgrade_finished = pyqtSignal(bool, str)  # Success flag and summary or error message
+
+    def __init__(self, site, segments=DOWNLOAD_SEGMENTS):
+        super().__init__()
+        self.site = site
+        self.segments = segments
+        self.stage = None
+        self.stage_started = 0.0
+
+    def report_progress(self, stage, done, total, unit):
+        """Turn raw stage progress into a rate and ETA for the window."""
+        now = time.monotonic()
+        if stage != self.stage:
+            self.stage, self.stage_started = stage, now
+        rate = done / max(now - self.stage_started, 1e-6)
+        if unit == "bytes":
+            text = f"{stage}: {done / (1024 * 1024):.1f} MB"
+            if total:
+                text += f" of {total / (1024 * 1024):.1f} MB"
+            text += f", {rate / (1024 * 1024):.1f} MB/s"
+        else:
+            text = f"{stage}: {done:,} {unit}, {rate:,.0f} {unit}/s"
+        percent = -1
+        if total:
+            percent = int(done * 100 / total)
+            eta = (total - done) / rate if rate else 0
+            text += f", ETA {int(eta // 60)}:{int(eta % 60):02d}"
+        self.progress_ready.emit(text, percent)
+
+    def run(self):
+        timings = {}
+        metrics = StageMetrics(self.site["name"], release=self.site["url"])
+        try:
+            upgrade_site(
+                self.site, SharedDownloads(segments=self.segments), threading.Lock(),
+                timings=timings, progress=self.report_progress, metrics=metrics,
+                log=self.log_ready.emit
+            )
+            failed = {r["stage"] for r in metrics.records if r["status"] == "failed"}
+            summary = ", ".join(f"{stage} {seconds:.1f}s" + (" (failed)" if stage in failed else "")
+                                for stage, seconds in timings.items())
+            self.upgrade_finished.emit(True, summary)
+        except Exception as e:
+            self.upgrade_finished.emit(False, str(e))
+
 
 class MoodleUpgradeManager(QMainWindow):
     def __init__(self):
@@ -47,17 +105,72 @@ class MoodleUpgradeManager(QMainWindow):
         self.test_connection_button = QPushButton("Test Database Connection", self)
         self.test_connection_button.clicked.connect(self.test_database_connection)
 
+        self.dump_database_checkbox = QCheckBox("Dump database before upgrade", self)
+        self.dump_database_checkbox.setChecked(True)
+        self.dump_workers_label = QLabel("Database dump connections:", self)
+        self.dump_workers_input = QSpinBox(self)
+        self.dump_workers_input.setRange(1, 64)
+        self.dump_workers_input.setValue(DUMP_WORKERS)
+
         # Upgrade URL
         self.upgrade_url_label = QLabel("Moodle Update URL:", self)
         self.upgrade_url_input = QLineEdit(self)
+        self.checksum_label = QLabel("Expected SHA-256 (optional):", self)
+        self.checksum_input = QLineEdit(self)
+        self.checksum_input.setPlaceholderText("Defaults to the checksum published next to the package")
+        self.download_segments_label = QLabel("Download segments:", self)
+        self.download_segments_input = QSpinBox(self)
+        self.download_segments_input.setRange(1, 32)
+        self.download_segments_input.setValue(DOWNLOAD_SEGMENTS)
+
+        # Backup Options
+        self.backup_mode_label = QLabel("Backup Mode:", self)
+        self.backup_mode_selector = QComboBox(self)
+        self.backup_mode_selector.addItem("Full copy", "copy")
+        self.backup_mode_selector.addItem("Incremental snapshots (hard-link unchanged files)", "snapshot")
+        self.backup_mode_selector.addItem("Compressed archive (.tar.gz)", "archive")
+        self.hash_backup_checkbox = QCheckBox("Compare content hashes when snapshotting", self)
+        self.retention_label = QLabel("Snapshots to keep:", self)
+        self.retention_input = QSpinBox(self)
+        self.retention_input.setRange(1, 100)
+        self.retention_input.setValue(SNAPSHOT_RETENTION)
+        self.copy_workers_label = QLabel("Copy worker threads:", self)
+        self.copy_workers_input = QSpinBox(self)
+        self.copy_workers_input.setRange(1, 256)
+        self.copy_workers_input.setValue(COPY_WORKERS)
 
         # Upgrade Button
         self.upgrade_button = QPushButton("Start Upgrade", self)
         self.upgrade_button.clicked.connect(self.start_upgrade)
 
+        self.delta_upgrade_checkbox = QCheckBox("Delta upgrade (only write files that changed)", self)
+
+        # Post-upgrade warm-up
+        self.warmup_checkbox = QCheckBox("Warm up caches after upgrade (purge caches, build theme CSS, load pages)",
+                                         self)
+        self.site_url_label = QLabel("Site URL (wwwroot):", self)
+        self.site_url_input = QLineEdit(self)
+        self.site_url_input.setPlaceholderText("https://moodle.example.com")
+        self.warmup_paths_label = QLabel("Pages to warm up (comma-separated):", self)
+        self.warmup_paths_input = QLineEdit(", ".join(WARMUP_PATHS), self)
+        self.warmup_concurrency_label = QLabel("Warm-up concurrent requests:", self)
+        self.warmup_concurrency_input = QSpinBox(self)
+        self.warmup_concurrency_input.setRange(1, 64)
+        self.warmup_concurrency_input.setValue(WARMUP_CONCURRENCY)
+
+        self.rollback_button = QPushButton("Roll Back Code to Previous Release", self)
+        self.rollback_button.clicked.connect(self.rollback_moodle_files)
+
         # Log Display
+        # Progress of the running stage
+        self.progress_label = QLabel("", self)
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(0)
+
         self.log_display = QTextEdit(self)
         self.log_display.setReadOnly(True)
+        self.log_display.document().setMaximumBlockCount(LOG_MAX_LINES)
 
         # Layout Setup
         layout = QVBoxLayout()
@@ -80,16 +193,44 @@ class MoodleUpgradeManager(QMainWindow):
         layout.addWidget(self.db_password_label)
         layout.addWidget(self.db_password_input)
         layout.addWidget(self.test_connection_button)
+        layout.addWidget(self.dump_database_checkbox)
+        layout.addWidget(self.dump_workers_label)
+        layout.addWidget(self.dump_workers_input)
 
         layout.addWidget(self.upgrade_url_label)
         layout.addWidget(self.upgrade_url_input)
+        layout.addWidget(self.checksum_label)
+        layout.addWidget(self.checksum_input)
+        layout.addWidget(self.download_segments_label)
+        layout.addWidget(self.download_segments_input)
+        layout.addWidget(self.backup_mode_label)
+        layout.addWidget(self.backup_mode_selector)
+        layout.addWidget(self.hash_backup_checkbox)
+        layout.addWidget(self.retention_label)
+        layout.addWidget(self.retention_input)
+        layout.addWidget(self.copy_workers_label)
+        layout.addWidget(self.copy_workers_input)
+        layout.addWidget(self.delta_upgrade_checkbox)
+        layout.addWidget(self.warmup_checkbox)
+        layout.addWidget(self.site_url_label)
+        layout.addWidget(self.site_url_input)
+        layout.addWidget(self.warmup_paths_label)
+        layout.addWidget(self.warmup_paths_input)
+        layout.addWidget(self.warmup_concurrency_label)
+        layout.addWidget(self.warmup_concurrency_input)
         layout.addWidget(self.upgrade_button)
+        layout.addWidget(self.rollback_button)
+        layout.addWidget(self.progress_label)
+        layout.addWidget(self.progress_bar)
         layout.addWidget(self.log_display)
 
         container = QWidget()
         container.setLayout(layout)
         self.setCentralWidget(container)
 
+        # Thread for the upgrade pipeline
+        self.upgrade_thread = None
+
     def log_message(self, message):
         """Log messages to the QTextEdit log display."""
         self.log_display.append(message)
@@ -106,23 +247,23 @@ class MoodleUpgradeManager(QMainWindow):
         if data_path:
             self.data_path_input.setText(data_path)
 
+    def get_db_params(self):
+        """Return the database connection details entered in the form."""
+        return {
+            "host": self.db_ip_input.text(),
+            "database": self.db_name_input.text(),
+            "user": self.db_user_input.text(),
+            "password": self.db_password_input.text(),
+            "port": int(self.db_port_input.text()),
+        }
+
     def test_database_connection(self):
         """Test the connection to the database."""
-        db_ip = self.db_ip_input.text()
-        db_name = self.db_name_input.text()
-        db_port = self.db_port_input.text()
-        db_user = self.db_user_input.text()
-        db_password = self.db_password_input.text()
+        import mysql.connector
 
         try:
             self.log_message("Testing database connection...")
-            connection = mysql.connector.connect(
-                host=db_ip,
-                database=db_name,
-                user=db_user,
-                password=db_password,
-                port=int(db_port)
-            )
+            connection = mysql.connector.connect(**self.get_db_params())
             if connection.is_connected():
                 self.log_message("Database connection successful.")
                 QMessageBox.information(self, "Success", "Database connection successful.")
@@ -146,92 +287,97 @@ class MoodleUpgradeManager(QMainWindow):
         if not upgrade_url:
             QMessageBox.critical(self, "Error", "Please enter the Moodle update URL.")
             return
+        if self.warmup_checkbox.isChecked() and not self.site_url_input.text().strip():
+            QMessageBox.critical(self, "Error", "Please enter the site URL to warm up.")
+            return
 
-        try:
-            self.log_message("Starting Moodle upgrade...")
-            self.backup_moodle(moodle_path, data_path)
-            zip_file = self.download_update(upgrade_url)
-            self.replace_moodle_files(moodle_path, zip_file)
-            self.run_database_upgrade(moodle_path)
+        if self.upgrade_thread and self.upgrade_thread.isRunning():
+            self.log_message("An upgrade is already in progress.")
+            return
+
+        site = {
+            "name": "site",
+            "code_path": moodle_path,
+            "data_path": data_path,
+            "url": upgrade_url,
+            "sha256": self.checksum_input.text().strip() or None,
+            "backup_mode": self.backup_mode_selector.currentData(),
+            "hash_backup": self.hash_backup_checkbox.isChecked(),
+            "retention": self.retention_input.value(),
+            "copy_workers": self.copy_workers_input.value(),
+            "dump_database": self.dump_database_checkbox.isChecked(),
+            "dump_workers": self.dump_workers_input.value(),
+            "delta": self.delta_upgrade_checkbox.isChecked(),
+            "warmup": self.warmup_checkbox.isChecked(),
+            "wwwroot": self.site_url_input.text().strip(),
+            "warmup_paths": [path.strip() for path in self.warmup_paths_input.text().split(",") if path.strip()],
+            "warmup_concurrency": self.warmup_concurrency_input.value(),
+        }
+        if site["dump_database"]:
+            try:
+                site["db"] = self.get_db_params()
+            except ValueError:
+                QMessageBox.critical(self, "Error", "Invalid database port.")
+                return
+
+        self.log_message("Starting Moodle upgrade...")
+        self.upgrade_button.setEnabled(False)  # Disable upgrade button during the upgrade
+        self.rollback_button.setEnabled(False)
+        self.progress_bar.setValue(0)
+
+        # Run the pipeline in a separate thread
+        self.upgrade_thread = UpgradeThread(site, segments=self.download_segments_input.value())
+        self.upgrade_thread.log_ready.connect(self.log_message)
+        self.upgrade_thread.progress_ready.connect(self.update_progress)
+        self.upgrade_thread.upgrade_finished.connect(self.upgrade_finished)
+        self.upgrade_thread.start()
+
+    def update_progress(self, text, percent):
+        """Show progress of the running stage."""
+        self.progress_label.setText(text)
+        if percent < 0:
+            self.progress_bar.setRange(0, 0)  # Busy indicator when the total is unknown
+        else:
+            self.progress_bar.setRange(0, 100)
+            self.progress_bar.setValue(percent)
+
+    def upgrade_finished(self, success, message):
+        """Report the outcome of the upgrade thread."""
+        self.upgrade_button.setEnabled(True)
+        self.rollback_button.setEnabled(True)
+        self.progress_bar.setRange(0, 100)
+        if success:
+            self.progress_bar.setValue(100)
+            self.progress_label.setText(f"Completed: {message}")
             self.log_message("Moodle upgrade completed successfully.")
+        else:
+            self.progress_label.setText("Upgrade failed.")
+            self.log_message(f"Error: {message}")
+            QMessageBox.critical(self, "Error", f"Upgrade failed: {message}")
+
+    def rollback_moodle_files(self):
+        """Switch the code directory back to the release kept by the last upgrade."""
+        moodle_path = self.moodle_path_input.text()
+        if not moodle_path:
+            QMessageBox.critical(self, "Error", "Invalid Moodle code path.")
+            return
+        try:
+            rollback_release(moodle_path, log=self.log_message)
         except Exception as e:
             self.log_message(f"Error: {str(e)}")
-            QMessageBox.critical(self, "Error", f"Upgrade failed: {str(e)}")
+            QMessageBox.critical(self, "Error", f"Rollback failed: {str(e)}")
 
-    def backup_moodle(self, moodle_path, data_path):
-        """Backup the existing Moodle code and data directories."""
-        self.log_message("Backing up Moodle directories...")
-
-        def ignore_patterns(directory, contents):
-            """Ignore specified patterns during backup."""
-            return ['.git', '__pycache__']
-
-        for path, name in [(moodle_path, "code"), (data_path, "data")]:
-            backup_path = f"{path}_backup"
-            try:
-                if os.path.exists(backup_path):
-                    shutil.rmtree(backup_path)
-                shutil.copytree(path, backup_path, ignore=shutil.ignore_patterns(*ignore_patterns(path, [])))
-                self.log_message(f"Backup of {name} directory completed at {backup_path}.")
-            except PermissionError as e:
-                self.log_message(f"Permission error while backing up {name}: {e}")
-                raise Exception(f"Access denied during backup of {name}. Please check permissions.")
-            except Exception as e:
-                self.log_message(f"Unexpected error while backing up {name}: {e}")
-                raise Exception(f"Failed to backup {name}: {e}")
-
-    def download_update(self, url):
-        """Download the Moodle update package."""
-        self.log_message("Downloading Moodle update...")
-        response = requests.get(url, stream=True)
-        if response.status_code != 200:
-            raise Exception("Failed to download update.")
-
-        zip_file = "moodle_update.zip"
-        with open(zip_file, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        self.log_message(f"Downloaded update to {zip_file}.")
-        return zip_file
-
-    def replace_moodle_files(self, moodle_path, zip_file):
-        """Replace existing Moodle files with the new version."""
-        self.log_message("Extracting and replacing Moodle files...")
-        extract_path = "moodle_temp"
-        if os.path.exists(extract_path):
-            shutil.rmtree(extract_path)
-
-        shutil.unpack_archive(zip_file, extract_path)
-        for item in os.listdir(extract_path):
-            s = os.path.join(extract_path, item)
-            d = os.path.join(moodle_path, item)
-            if os.path.exists(d):
-                if os.path.isdir(d):
-                    shutil.rmtree(d)
-                else:
-                    os.remove(d)
-            shutil.move(s, d)
-        shutil.rmtree(extract_path)
-        os.remove(zip_file)
-        self.log_message("Files replaced successfully.")
-
-    def run_database_upgrade(self, moodle_path):
-        """Run Moodle's CLI script to upgrade the database."""
-        self.log_message("Running database upgrade script...")
-        script_path = os.path.join(moodle_path, "admin", "cli", "upgrade.php")
-        if not os.path.exists(script_path):
-            raise Exception("CLI upgrade script not found.")
-        result = subprocess.run(
-            ["php", script_path, "--non-interactive"],
-            capture_output=True,
-            text=True
-        )
-        if result.returncode != 0:
-            raise Exception(f"Database upgrade failed: {result.stderr}")
-        self.log_message(result.stdout)
+    def closeEvent(self, event):
+        """Wait for a running upgrade before closing the window."""
+        if self.upgrade_thread and self.upgrade_thread.isRunning():
+            QMessageBox.warning(self, "Warning", "An upgrade is in progress. Please wait for it to finish.")
+            event.ignore()
+            return
+        event.accept()
 
 
 if __name__ == "__main__":
+    # Headless and fleet upgrades run through "moodle_tools.py upgrade", which never loads Qt
     app = QApplication(sys.argv)
     window = MoodleUpgradeManager()
     window.show()
@@ -0,0 +1,202 @@
+import os
+import re
+import sys
+import json
+import time
+import runpy
+import shlex
+import argparse
+import subprocess
+
+# Every tool is imported inside its subcommand, so "--help" and headless runs
+# only pay for what they use; PyQt5 is loaded only for --gui and the MySQL
+# driver only when a database dump actually runs.
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Cold-start measurements appended by the "startup" subcommand
+STARTUP_LOG = "startup_times.jsonl"
+# Modules a headless command must never import
+HEAVY_MODULES = ("PyQt5", "mysql")
+
+# Function to launch one of the GUI scripts as if it were run directly
+def run_gui(script, argv=()):
+    sys.argv = [script, *argv]
+    runpy.run_path(os.path.join(TOOLS_DIR, script), run_name="__main__")
+    return 0
+
+def cmd_upgrade(args):
+    if args.gui:
+        return run_gui("moodle.updator.py")
+    if not args.inventory:
+        print("An inventory is required unless --gui is given.", file=sys.stderr)
+        return 2
+    import moodle_upgrade
+
+    return moodle_upgrade.run_fleet(
+        args.inventory,
+        args.concurrency or moodle_upgrade.FLEET_CONCURRENCY,
+        args.io_concurrency or moodle_upgrade.FLEET_IO_CONCURRENCY,
+        args.summary,
+        args.metrics or moodle_upgrade.METRICS_LOG,
+        args.prometheus,
+        args.warmup
+    )
+
+def cmd_search(args):
+    if args.gui:
+        return run_gui("explore.py")
+    if not args.query:
+        print("A query is required unless --gui is given.", file=sys.stderr)
+        return 2
+    from search_backends import GoogleBackend, LocalIndexBackend
+    from search_core import SiteSearch
+
+    if args.backend == "local":
+        backend = LocalIndexBackend()
+    else:
+        backend = GoogleBackend(harvest_index=LocalIndexBackend() if args.harvest else None)
+    search = SiteSearch(" ".join(args.query), args.country or "", args.domains, args.refresh, backend)
+
+    def show(sites, progress):
+        if not args.json:
+            for _, text in sites:
+                print(text)
+
+    try:
+        count, status = search.run(show)
+    except KeyboardInterrupt:
+        search.cancel()
+        return 130
+    if args.json:
+        json.dump([{"site": root, "hits": site["hits"], "pages": sorted(site["pages"]),
+                    "countries": sorted(site["countries"])} for root, site in search.sites.sites.items()],
+                  sys.stdout, indent=2)
+        print()
+    print(status, file=sys.stderr)
+    return 0 if count or "No results" in status else 1
+
+def cmd_job_search(args):
+    if args.gui:
+        return run_gui("jobs.search.py")
+    if not args.titles:
+        print("At least one job title is required unless --gui is given.", file=sys.stderr)
+        return 2
+    from search_core import find_jobs
+
+    count = find_jobs(args.titles, lambda lines: print("\n".join(lines)), args.only_new, args.refresh)
+    print(f"{count} posting(s) listed.", file=sys.stderr)
+    return 0
+
+def cmd_scorm(argv):
+    import scorm
+
+    return scorm.main(argv)
+
+# Function to measure the cold start of subcommands with -X importtime
+def measure_startup(command, argv=("--help",)):
+    """
+    Run "moodle_tools.py <command> <argv>" in a fresh interpreter with
+    -X importtime and summarise what it imported.
+    :return: Dict with the wall time, total import time, slowest top-level
+             imports and any HEAVY_MODULES that were loaded.
+    """
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.join(TOOLS_DIR, "moodle_tools.py"), command, *argv],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    wall = time.perf_counter() - started
+    top_level = []
+    modules = set()
+    for line in completed.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if not match:
+            continue
+        modules.add(match.group(4))
+        if len(match.group(3)) <= 1:
+            top_level.append((int(match.group(2)), match.group(4)))
+    return {
+        "command": " ".join([command, *argv]),
+        "exit_code": completed.returncode,
+        "wall_s": round(wall, 4),
+        "import_s": round(sum(us for us, _ in top_level) / 1e6, 4),
+        "modules": len(modules),
+        "slowest": [{"module": name, "cumulative_s": round(us / 1e6, 4)} for us, name in sorted(top_level)[-5:][::-1]],
+        "heavy": sorted({name.split(".")[0] for name in modules if name.split(".")[0] in HEAVY_MODULES}),
+    }
+
+def cmd_startup(args):
+    failed = False
+    records = []
+    for command in args.commands or ["upgrade", "search", "job-search", "scorm"]:
+        record = measure_startup(command, shlex.split(args.args) if args.args else ["--help"])
+        record["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        records.append(record)
+        heavy = f", loaded {', '.join(record['heavy'])}" if record["heavy"] else ""
+        print(f"{record['command']}: {record['wall_s'] * 1000:.0f} ms wall, {record['import_s'] * 1000:.0f} ms "
+              f"importing {record['modules']} modules{heavy}")
+        for entry in record["slowest"]:
+            print(f"    {entry['cumulative_s'] * 1000:8.1f} ms  {entry['module']}")
+        failed = failed or bool(record["heavy"]) or record["exit_code"] != 0
+    if args.log:
+        with open(args.log, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    return 1 if failed else 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="moodle_tools.py", description="Moodle administration tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    upgrade = commands.add_parser("upgrade", help="upgrade Moodle sites listed in an inventory")
+    upgrade.add_argument("inventory", nargs="?", help="JSON or YAML inventory of sites")
+    upgrade.add_argument("--gui", action="store_true", help="open the Moodle Upgrade Manager window instead")
+    upgrade.add_argument("--concurrency", type=int, help="number of sites upgraded at once")
+    upgrade.add_argument("--io-concurrency", type=int, help="disk-heavy stages allowed at once per disk or io_group")
+    upgrade.add_argument("--summary", metavar="PATH", help="write per-site timings as JSON")
+    upgrade.add_argument("--metrics", metavar="PATH", help="append per-stage metrics as JSON lines")
+    upgrade.add_argument("--prometheus", metavar="PATH", help="also write stage metrics in Prometheus text format")
+    upgrade.add_argument("--warmup", action="store_true",
+                         help="purge caches, build theme CSS and warm each site's pages after upgrading "
+                              "(sites need a wwwroot)")
+    upgrade.set_defaults(handler=cmd_upgrade)
+
+    search = commands.add_parser("search", help="find Moodle sites, grouped by site")
+    search.add_argument("query", nargs="*", help="search terms")
+    search.add_argument("--gui", action="store_true", help="open the Moodle LMS Website Finder window instead")
+    search.add_argument("--country", help="country code, e.g. in; all countries when omitted")
+    search.add_argument("--domains", action="store_true", help="search within national domains")
+    search.add_argument("--backend", choices=("google", "local"), default="google", help="search backend")
+    search.add_argument("--harvest", action="store_true", help="add Google results to the local index")
+    search.add_argument("--refresh", action="store_true", help="ignore cached results")
+    search.add_argument("--json", action="store_true", help="print the sites found as JSON")
+    search.set_defaults(handler=cmd_search)
+
+    jobs = commands.add_parser("job-search", help="search job postings for job titles")
+    jobs.add_argument("titles", nargs="*", help="job titles, e.g. 'Moodle Administrator'")
+    jobs.add_argument("--gui", action="store_true", help="open the job search window instead")
+    jobs.add_argument("--only-new", action="store_true", help="list only postings new since the last run")
+    jobs.add_argument("--refresh", action="store_true", help="ignore cached results")
+    jobs.set_defaults(handler=cmd_job_search)
+
+    # Listed for --help only; main() hands "scorm" arguments straight to scorm.py's own parser
+    commands.add_parser("scorm", help="provision courses and SCORM packages (see 'scorm --help')", add_help=False)
+
+    startup = commands.add_parser("startup", help="measure subcommand cold start with -X importtime")
+    startup.add_argument("commands", nargs="*", help="subcommands to measure (default: all)")
+    startup.add_argument("--args", help="arguments given to each subcommand, as one string (default: --help)")
+    startup.add_argument("--log", default=STARTUP_LOG, help="JSON-lines file the measurements are appended to")
+    startup.set_defaults(handler=cmd_startup)
+    return parser
+
+# Function to run the command line
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv[:1] == ["scorm"]:
+        return cmd_scorm(argv[1:])
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
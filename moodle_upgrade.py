@@ -0,0 +1,1738 @@
+import sys
+import os
+import io
+import re
+import html
+import json
+import time
+import zlib
+import gzip
+import struct
+import queue
+import threading
+import bisect
+import decimal
+import datetime
+import tarfile
+import zipfile
+import errno
+import fnmatch
+import hashlib
+import shutil
+import subprocess
+import contextlib
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Names skipped when backing up the code and data trees
+BACKUP_IGNORE = ('.git', '__pycache__')
+
+# Number of timestamped snapshots kept per tree in incremental mode
+SNAPSHOT_RETENTION = 5
+
+# Uncompressed bytes per independently compressed gzip member in backup archives
+ARCHIVE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Name of the tar member holding the per-file index of a backup archive
+ARCHIVE_INDEX_NAME = ".moodle-backup-index.json"
+
+# Database dump tuning: rows per INSERT/fetch, rows per primary-key range, worker connections
+DUMP_BATCH_ROWS = 5000
+DUMP_CHUNK_ROWS = 1000000
+DUMP_WORKERS = 4
+
+# Update package downloads: content-addressed cache location, concurrent Range segments,
+# smallest segment worth splitting off, and adaptive read size bounds
+DOWNLOAD_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "moodle-updator")
+DOWNLOAD_SEGMENTS = 4
+DOWNLOAD_MIN_SEGMENT = 8 * 1024 * 1024
+DOWNLOAD_MIN_CHUNK = 64 * 1024
+DOWNLOAD_MAX_CHUNK = 4 * 1024 * 1024
+
+# Fleet mode: sites upgraded at once, and I/O-heavy stages allowed at once per disk
+FLEET_CONCURRENCY = 4
+FLEET_IO_CONCURRENCY = 1
+
+# Post-upgrade warm-up: pages requested (relative to the site's wwwroot), requests in
+# flight at once, the most rounds tried, and the round-to-round change in median
+# latency below which response times count as stable
+WARMUP_PATHS = ("/", "/login/index.php", "/my/", "/course/index.php")
+WARMUP_CONCURRENCY = 4
+WARMUP_MAX_ROUNDS = 20
+WARMUP_STABLE_CHANGE = 0.1
+WARMUP_TIMEOUT = 60
+# Theme and JavaScript bundles linked from the warmed pages, fetched once so Moodle builds them
+WARMUP_ASSET_RE = re.compile(
+    r'(?:src|href)="([^"]*/(?:theme/styles\.php|theme/yui_combo\.php|theme/font\.php|'
+    r'lib/javascript\.php|lib/requirejs\.php)[^"]*)"'
+)
+
+# JSON-lines file that receives one metrics record per pipeline stage
+METRICS_LOG = "moodle_upgrade_metrics.jsonl"
+
+# Default size of the worker pool used for tree copies
+COPY_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# errno values meaning "this in-kernel copy path is not available here"
+_KERNEL_COPY_FALLBACK = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+
+def _kernel_copy(infd, outfd, size):
+    """Copy up to size bytes between descriptors without going through userspace.
+
+    Tries copy_file_range (which can reflink on CoW filesystems) and then
+    sendfile. Returns the number of bytes copied; the caller finishes anything
+    left over with a regular read/write loop.
+    """
+    offset = 0
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method) or offset >= size:
+            continue
+        try:
+            while offset < size:
+                if method == "copy_file_range":
+                    sent = os.copy_file_range(infd, outfd, size - offset, offset, offset)
+                else:
+                    os.lseek(outfd, offset, os.SEEK_SET)
+                    sent = os.sendfile(outfd, infd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as e:
+            if e.errno not in _KERNEL_COPY_FALLBACK:
+                raise
+    return offset
+
+
+def copy_file_fast(src, dst):
+    """Copy a file's contents and metadata, returning the number of bytes copied."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = _kernel_copy(fsrc.fileno(), fdst.fileno(), size)
+        fsrc.seek(copied)
+        fdst.seek(copied)
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        copied = fdst.tell()
+    shutil.copystat(src, dst)
+    return copied
+
+
+def run_bounded(tasks, workers=COPY_WORKERS, progress=None, interval=1.0):
+    """Run callables from tasks on a bounded thread pool.
+
+    At most twice `workers` tasks are in flight at a time, so walking a tree of
+    millions of files never queues millions of futures. Each task returns the
+    number of bytes it processed. progress(files, bytes) is called at most once
+    per interval seconds and once at the end. Returns (files, bytes).
+    """
+    files = nbytes = 0
+    last_report = time.monotonic()
+
+    def collect(done):
+        nonlocal files, nbytes, last_report
+        for future in done:
+            nbytes += future.result() or 0
+            files += 1
+        if progress and time.monotonic() - last_report >= interval:
+            progress(files, nbytes)
+            last_report = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for task in tasks:
+            pending.add(pool.submit(task))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        if pending:
+            done, _ = wait(pending)
+            collect(done)
+    if progress:
+        progress(files, nbytes)
+    return files, nbytes
+
+
+def _ignored(name, ignore):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in ignore)
+
+
+def _walk_dirs(dirpath, dirnames, ignore):
+    """Prune ignored directories and symlinks to directories from an os.walk dirnames list in place.
+
+    os.walk lists a symlink to a directory in dirnames without descending
+    into it; the returned names of those links are handled like symlinked files.
+    """
+    links = [d for d in dirnames if not _ignored(d, ignore) and os.path.islink(os.path.join(dirpath, d))]
+    dirnames[:] = [d for d in dirnames if not _ignored(d, ignore) and d not in links]
+    return links
+
+
+def copy_tree_parallel(src, dst, workers=COPY_WORKERS, ignore=BACKUP_IGNORE, progress=None):
+    """Copy the tree at src to dst with a pool of worker threads.
+
+    Directories are created and symlinks recreated while walking; regular
+    files are copied concurrently with copy_file_fast. Returns (files, bytes).
+    """
+    def tasks():
+        for dirpath, dirnames, filenames in os.walk(src):
+            links = _walk_dirs(dirpath, dirnames, ignore)
+            target_dir = os.path.normpath(os.path.join(dst, os.path.relpath(dirpath, src)))
+            os.makedirs(target_dir, exist_ok=True)
+            for link in links:
+                os.symlink(os.readlink(os.path.join(dirpath, link)), os.path.join(target_dir, link))
+            for filename in filenames:
+                if _ignored(filename, ignore):
+                    continue
+                source = os.path.join(dirpath, filename)
+                target = os.path.join(target_dir, filename)
+                if os.path.islink(source):
+                    os.symlink(os.readlink(source), target)
+                    continue
+                yield lambda source=source, target=target: copy_file_fast(source, target)
+
+    return run_bounded(tasks(), workers=workers, progress=progress)
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Return the hex SHA-256 digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ChunkedGzipWriter(io.RawIOBase):
+    """Write-only stream that gzips fixed-size chunks in parallel.
+
+    Every chunk becomes an independent gzip member, so the output is a plain
+    multi-member .gz file that gzip and tar read natively, and decompression
+    can start at any chunk boundary. `chunks` records the uncompressed and
+    compressed offset at which each member starts.
+    """
+
+    def __init__(self, fileobj, chunk_size=ARCHIVE_CHUNK_SIZE, level=6, workers=None):
+        super().__init__()
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = []
+        self.buffer = bytearray()
+        self.uncompressed_offset = 0
+        self.compressed_offset = 0
+        self.bytes_in = 0
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def _compress(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def _drain(self, keep):
+        """Write finished chunks in order until at most `keep` are outstanding."""
+        while len(self.pending) > keep:
+            size, future = self.pending.pop(0)
+            data = future.result()
+            self.chunks.append((self.uncompressed_offset, self.compressed_offset))
+            self.fileobj.write(data)
+            self.uncompressed_offset += size
+            self.compressed_offset += len(data)
+
+    def flush_chunk(self):
+        """End the current chunk and wait until everything written so far is on disk.
+
+        The next byte written starts a new gzip member at compressed_offset.
+        """
+        if self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            self.pending.append((len(data), self.pool.submit(self._compress, data)))
+        self._drain(0)
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_in += len(data)
+        while len(self.buffer) >= self.chunk_size:
+            chunk = bytes(self.buffer[:self.chunk_size])
+            del self.buffer[:self.chunk_size]
+            self.pending.append((len(chunk), self.pool.submit(self._compress, chunk)))
+            self._drain(self.workers * 2)
+        return len(data)
+
+    def tell(self):
+        return self.bytes_in
+
+    def close(self):
+        if not self.closed:
+            self.flush_chunk()
+            self.pool.shutdown()
+        super().close()
+
+
+# Trailing empty gzip member whose FEXTRA field locates the archive index:
+# magic, flags=FEXTRA, mtime, xfl, os, XLEN, subfield "MI" of 16 bytes, empty deflate block, CRC32, ISIZE
+_INDEX_FOOTER = struct.Struct("<4sIBBHBBHQQ2sII")
+_INDEX_FOOTER_MAGIC = b"\x1f\x8b\x08\x04"
+
+
+def write_backup_archive(archive_path, sources, ignore=BACKUP_IGNORE, level=6, workers=None, progress=None,
+                         log=print):
+    """Stream several directory trees into one indexed, chunk-parallel .tar.gz.
+
+    sources maps the top-level name inside the archive to a directory path.
+    The archive ends with a tar member holding a JSON index of every file's
+    tar header offset and the chunk table, followed by a tiny gzip member that
+    points at that index, so single files can be restored with restore_from_archive.
+    """
+    index = {}
+    last_report = time.monotonic()
+    with open(archive_path, "wb") as raw:
+        writer = ChunkedGzipWriter(raw, level=level, workers=workers)
+        with tarfile.open(fileobj=writer, mode="w", format=tarfile.PAX_FORMAT) as tar:
+            for arc_root, src in sources.items():
+                for dirpath, dirnames, filenames in os.walk(src):
+                    links = _walk_dirs(dirpath, dirnames, ignore)
+                    rel_dir = os.path.relpath(dirpath, src)
+                    arc_dir = os.path.normpath(os.path.join(arc_root, rel_dir))
+                    tar.add(dirpath, arcname=arc_dir, recursive=False)
+                    for link in links:
+                        tar.add(os.path.join(dirpath, link), arcname=f"{arc_dir}/{link}", recursive=False)
+                    for filename in filenames:
+                        if _ignored(filename, ignore):
+                            continue
+                        arcname = f"{arc_dir}/{filename}"
+                        header_offset = tar.offset
+                        tar.add(os.path.join(dirpath, filename), arcname=arcname, recursive=False)
+                        index[arcname] = header_offset
+                        if progress and time.monotonic() - last_report >= 1.0:
+                            progress(len(index), writer.bytes_in)
+                            last_report = time.monotonic()
+
+            # Start the index on a fresh chunk so the footer can point straight at it
+            writer.flush_chunk()
+            index_offsets = (writer.compressed_offset, writer.uncompressed_offset)
+            payload = json.dumps({"files": index, "chunks": writer.chunks}).encode()
+            info = tarfile.TarInfo(ARCHIVE_INDEX_NAME)
+            info.size = len(payload)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(payload))
+        writer.close()
+        raw.write(_INDEX_FOOTER.pack(
+            _INDEX_FOOTER_MAGIC, 0, 0, 255, 20, ord("M"), ord("I"), 16,
+            index_offsets[0], index_offsets[1], b"\x03\x00", 0, 0
+        ))
+        compressed = raw.tell()
+    if progress:
+        progress(len(index), writer.bytes_in)
+    log(f"Archived {len(index)} file(s): {writer.bytes_in} bytes compressed to {compressed} bytes in "
+        f"{len(writer.chunks)} chunk(s).")
+    return archive_path
+
+
+def _open_archive_at(f, compressed_offset):
+    """Return a stream of decompressed bytes starting at a chunk boundary."""
+    f.seek(compressed_offset)
+    return gzip.GzipFile(fileobj=f, mode="rb")
+
+
+def read_archive_index(archive_path):
+    """Load the per-file index embedded in a backup archive."""
+    with open(archive_path, "rb") as f:
+        f.seek(-_INDEX_FOOTER.size, os.SEEK_END)
+        fields = _INDEX_FOOTER.unpack(f.read(_INDEX_FOOTER.size))
+        if fields[0] != _INDEX_FOOTER_MAGIC or bytes(fields[5:7]) != b"MI":
+            raise Exception(f"{archive_path} is not an indexed Moodle backup archive.")
+        with tarfile.open(fileobj=_open_archive_at(f, fields[8]), mode="r|") as tar:
+            member = tar.next()
+            return json.load(tar.extractfile(member))
+
+
+def restore_from_archive(archive_path, arcname, dest_dir, index=None):
+    """Extract one file from a backup archive, decompressing only its chunk onwards."""
+    index = index or read_archive_index(archive_path)
+    if arcname not in index["files"]:
+        raise Exception(f"{arcname} is not in {archive_path}.")
+    header_offset = index["files"][arcname]
+    chunk_starts = [start for start, _ in index["chunks"]]
+    uncompressed_start, compressed_start = index["chunks"][bisect.bisect_right(chunk_starts, header_offset) - 1]
+    with open(archive_path, "rb") as f:
+        stream = _open_archive_at(f, compressed_start)
+        stream.seek(header_offset - uncompressed_start)
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            member = tar.next()
+            tar.extract(member, dest_dir)
+    return os.path.join(dest_dir, member.name)
+
+
+def list_snapshots(snapshot_root):
+    """Return completed snapshot names under snapshot_root, oldest first.
+
+    A snapshot only counts as completed once its manifest has been written,
+    so an interrupted run is never used as the base for the next one.
+    """
+    if not os.path.isdir(snapshot_root):
+        return []
+    return sorted(
+        name for name in os.listdir(snapshot_root)
+        if os.path.isdir(os.path.join(snapshot_root, name))
+        and os.path.exists(os.path.join(snapshot_root, f"{name}.manifest.json"))
+    )
+
+
+def load_manifest(snapshot_root, name):
+    """Load the manifest of a completed snapshot."""
+    with open(os.path.join(snapshot_root, f"{name}.manifest.json")) as f:
+        return json.load(f)
+
+
+def snapshot_tree(src, snapshot_root, use_hash=False, ignore=BACKUP_IGNORE, workers=COPY_WORKERS,
+                  progress=None, log=print):
+    """Take an incremental, hard-link based snapshot of src.
+
+    Files whose size and mtime (and SHA-256, when use_hash is set) match the
+    manifest of the previous snapshot are hard-linked from it; everything else
+    is copied. Returns the path of the new snapshot directory.
+    """
+    os.makedirs(snapshot_root, exist_ok=True)
+    previous = list_snapshots(snapshot_root)
+    base_name = previous[-1] if previous else None
+    base_manifest = load_manifest(snapshot_root, base_name)["files"] if base_name else {}
+    base_dir = os.path.join(snapshot_root, base_name) if base_name else None
+
+    name = time.strftime("%Y%m%d-%H%M%S")
+    suffix = 1
+    while os.path.exists(os.path.join(snapshot_root, name)):
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{suffix:02d}"
+        suffix += 1
+    dest_root = os.path.join(snapshot_root, name)
+
+    manifest = {}
+    linked = []
+
+    def snapshot_file(source, rel_path, target):
+        st = os.stat(source)
+        entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        previous_entry = base_manifest.get(rel_path)
+        unchanged = False
+        if use_hash:
+            entry["sha256"] = file_sha256(source)
+            unchanged = previous_entry is not None and previous_entry.get("sha256") == entry["sha256"]
+        elif previous_entry is not None:
+            unchanged = (previous_entry["size"], previous_entry["mtime_ns"]) == (st.st_size, st.st_mtime_ns)
+        manifest[rel_path] = entry
+
+        if unchanged:
+            try:
+                os.link(os.path.join(base_dir, rel_path), target)
+                linked.append(rel_path)
+                return 0
+            except OSError:
+                # Base file missing or on another filesystem: fall back to a copy
+                pass
+        return copy_file_fast(source, target)
+
+    def tasks():
+        for dirpath, dirnames, filenames in os.walk(src):
+            links = _walk_dirs(dirpath, dirnames, ignore)
+            rel_dir = os.path.relpath(dirpath, src)
+            os.makedirs(os.path.normpath(os.path.join(dest_root, rel_dir)), exist_ok=True)
+            for link in links:
+                os.symlink(os.readlink(os.path.join(dirpath, link)),
+                           os.path.normpath(os.path.join(dest_root, rel_dir, link)))
+            for filename in filenames:
+                if _ignored(filename, ignore):
+                    continue
+                source = os.path.join(dirpath, filename)
+                rel_path = os.path.normpath(os.path.join(rel_dir, filename))
+                target = os.path.join(dest_root, rel_path)
+                if os.path.islink(source):
+                    os.symlink(os.readlink(source), target)
+                    continue
+                yield lambda source=source, rel_path=rel_path, target=target: snapshot_file(source, rel_path, target)
+
+    files, copied_bytes = run_bounded(tasks(), workers=workers, progress=progress)
+
+    with open(os.path.join(snapshot_root, f"{name}.manifest.json"), "w") as f:
+        json.dump({"source": os.path.abspath(src), "base": base_name, "files": manifest}, f)
+    log(f"Snapshot {name}: {files - len(linked)} file(s) copied ({copied_bytes} bytes), "
+        f"{len(linked)} file(s) hard-linked from {base_name or 'nothing'}.")
+    return dest_root
+
+
+def prune_snapshots(snapshot_root, keep=SNAPSHOT_RETENTION, log=print):
+    """Delete all but the newest `keep` completed snapshots, plus any incomplete ones."""
+    completed = list_snapshots(snapshot_root)
+    expired = completed[:-keep] if keep > 0 else completed
+    for name in os.listdir(snapshot_root):
+        path = os.path.join(snapshot_root, name)
+        if os.path.isdir(path) and (name in expired or name not in completed):
+            shutil.rmtree(path)
+            manifest = f"{path}.manifest.json"
+            if os.path.exists(manifest):
+                os.remove(manifest)
+            log(f"Removed expired snapshot {name}.")
+
+
+_SQL_ESCAPES = str.maketrans({"\\": "\\\\", "'": "\\'", "\0": "\\0", "\n": "\\n", "\r": "\\r", "\x1a": "\\Z"})
+
+
+def sql_literal(value):
+    """Render a value returned by mysql.connector as a MySQL literal."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return f"X'{bytes(value).hex()}'"
+    if isinstance(value, set):
+        value = ",".join(sorted(value))
+    if isinstance(value, (datetime.date, datetime.time, datetime.timedelta)):
+        return f"'{value}'"
+    return "'" + str(value).translate(_SQL_ESCAPES) + "'"
+
+
+def plan_table_dump(cursor, table, chunk_rows=DUMP_CHUNK_ROWS):
+    """Split a table into primary-key ranges of roughly chunk_rows rows each.
+
+    Returns (tasks, estimated_rows). Each task is (table, key, low, high) with
+    inclusive bounds; the first range has no lower and the last no upper bound
+    so rows committed between planning and the snapshot are not missed. key is
+    None for tables without a single integer primary key, which are dumped in
+    one piece.
+    """
+    cursor.execute(
+        "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table,)
+    )
+    estimated_rows = (cursor.fetchone() or (0,))[0] or 0
+    cursor.execute(
+        "SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_KEY = 'PRI'",
+        (table,)
+    )
+    keys = cursor.fetchall()
+    if len(keys) != 1 or keys[0][1] not in ("tinyint", "smallint", "mediumint", "int", "bigint"):
+        return [(table, None, None, None)], estimated_rows
+    key = keys[0][0]
+    cursor.execute(f"SELECT MIN(`{key}`), MAX(`{key}`) FROM `{table}`")
+    low, high = cursor.fetchone()
+    parts = max(1, -(-estimated_rows // chunk_rows))
+    if low is None or parts == 1:
+        return [(table, key, None, None)], estimated_rows
+    step = -(-(high - low + 1) // parts)
+    bounds = list(range(low, high + 1, step))
+    tasks = [
+        (table, key, None if i == 0 else start, None if i == len(bounds) - 1 else start + step - 1)
+        for i, start in enumerate(bounds)
+    ]
+    return tasks, estimated_rows
+
+
+def dump_table_part(connection, task, path, batch_rows=DUMP_BATCH_ROWS):
+    """Stream one table or primary-key range into a gzip-compressed SQL file.
+
+    Ranges are read with keyset pagination so memory stays bounded by
+    batch_rows regardless of table size. Returns the number of rows written.
+    """
+    table, key, low, high = task
+    rows_written = 0
+    cursor = connection.cursor()
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=6) as out:
+        def write_batch(columns, rows):
+            column_list = ", ".join(f"`{c}`" for c in columns)
+            values = ",\n".join("(" + ", ".join(sql_literal(v) for v in row) + ")" for row in rows)
+            out.write(f"INSERT INTO `{table}` ({column_list}) VALUES\n{values};\n")
+
+        if key is None:
+            cursor.execute(f"SELECT * FROM `{table}`")
+            while True:
+                rows = cursor.fetchmany(batch_rows)
+                if not rows:
+                    break
+                write_batch(cursor.column_names, rows)
+                rows_written += len(rows)
+        else:
+            after = None if low is None else low - 1
+            while True:
+                conditions, params = [], []
+                if after is not None:
+                    conditions.append(f"`{key}` > %s")
+                    params.append(after)
+                if high is not None:
+                    conditions.append(f"`{key}` <= %s")
+                    params.append(high)
+                where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+                cursor.execute(f"SELECT * FROM `{table}` {where}ORDER BY `{key}` LIMIT %s", (*params, batch_rows))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                write_batch(cursor.column_names, rows)
+                rows_written += len(rows)
+                after = rows[-1][cursor.column_names.index(key)]
+    cursor.close()
+    return rows_written
+
+
+def dump_database(db_params, dest_dir, workers=DUMP_WORKERS, batch_rows=DUMP_BATCH_ROWS,
+                  chunk_rows=DUMP_CHUNK_ROWS, progress=None, log=print):
+    """Take a consistent, parallel dump of a MySQL database into dest_dir.
+
+    A coordinator connection holds FLUSH TABLES WITH READ LOCK just long enough
+    for every worker connection to open a consistent-snapshot transaction, so
+    all workers see the same point in time. Without the RELOAD privilege the
+    dump falls back to a single worker, which is consistent on its own.
+    The schema goes to schema.sql.gz and each table or primary-key range to
+    its own <table>.<part>.sql.gz; dump.json records what was written.
+    """
+    import mysql.connector  # Imported here so runs that skip the dump never load the driver
+
+    os.makedirs(dest_dir, exist_ok=True)
+    coordinator = mysql.connector.connect(**db_params)
+    cursor = coordinator.cursor()
+    cursor.execute("SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'")
+    tables = [row[0] for row in cursor.fetchall()]
+
+    with gzip.open(os.path.join(dest_dir, "schema.sql.gz"), "wt", encoding="utf-8") as out:
+        for table in tables:
+            cursor.execute(f"SHOW CREATE TABLE `{table}`")
+            out.write(f"DROP TABLE IF EXISTS `{table}`;\n{cursor.fetchone()[1]};\n\n")
+
+    parts = []
+    for table in tables:
+        tasks, estimated_rows = plan_table_dump(cursor, table, chunk_rows)
+        for number, task in enumerate(tasks):
+            parts.append({"file": f"{table}.{number:05d}.sql.gz", "task": task,
+                          "estimate": estimated_rows // len(tasks)})
+    # Largest parts first so the long tail is made of small tables
+    parts.sort(key=lambda part: -part["estimate"])
+
+    connections = queue.Queue()
+    binlog = None
+    try:
+        try:
+            cursor.execute("FLUSH TABLES WITH READ LOCK")
+            locked = True
+        except mysql.connector.Error as e:
+            log(f"Cannot lock tables ({e}); dumping with a single connection to stay consistent.")
+            locked = False
+            workers = 1
+        try:
+            for _ in range(workers):
+                connection = mysql.connector.connect(**db_params)
+                connection.start_transaction(
+                    consistent_snapshot=True, isolation_level="REPEATABLE READ", readonly=True
+                )
+                connections.put(connection)
+            if locked:
+                try:
+                    cursor.execute("SHOW MASTER STATUS")
+                    status = cursor.fetchone()
+                    binlog = {"file": status[0], "position": status[1]} if status else None
+                except mysql.connector.Error:
+                    # Binary logging disabled or statement renamed on this server version
+                    pass
+        finally:
+            if locked:
+                cursor.execute("UNLOCK TABLES")
+
+        def run(part):
+            connection = connections.get()
+            try:
+                part["rows"] = dump_table_part(connection, part["task"], os.path.join(dest_dir, part["file"]),
+                                               batch_rows)
+            finally:
+                connections.put(connection)
+            return part["rows"]
+
+        started = time.monotonic()
+        _, total_rows = run_bounded((lambda part=part: run(part) for part in parts), workers=workers,
+                                    progress=progress)
+        elapsed = time.monotonic() - started
+    finally:
+        while not connections.empty():
+            connection = connections.get()
+            connection.rollback()
+            connection.close()
+        coordinator.close()
+
+    with open(os.path.join(dest_dir, "dump.json"), "w") as f:
+        json.dump({
+            "database": db_params.get("database"),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "binlog": binlog,
+            "tables": tables,
+            "parts": [
+                {"file": p["file"], "table": p["task"][0], "key": p["task"][1], "low": p["task"][2],
+                 "high": p["task"][3], "rows": p["rows"]}
+                for p in sorted(parts, key=lambda p: p["file"])
+            ],
+        }, f, indent=2)
+    log(f"Dumped {len(tables)} table(s), {total_rows} row(s) in {len(parts)} part(s) "
+        f"({total_rows / max(elapsed, 1e-6):.0f} rows/s).")
+    return dest_dir
+
+
+def make_download_session(pool_size=DOWNLOAD_SEGMENTS):
+    """Return a requests session whose connection pool fits pool_size concurrent segments."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_published_sha256(session, url):
+    """Return the SHA-256 Moodle publishes next to a package as <url>.sha256, or None."""
+    try:
+        response = session.get(f"{url}.sha256", timeout=30)
+    except requests.RequestException:
+        return None
+    if response.status_code != 200:
+        return None
+    token = response.text.strip().split()[0] if response.text.strip() else ""
+    return token.lower() if len(token) == 64 else None
+
+
+def _stream_to_file(response, f, offset, on_data, stop):
+    """Write a response body to f, positioned at offset, growing the read size while the link keeps up."""
+    chunk_size = DOWNLOAD_MIN_CHUNK
+    while not stop.is_set():
+        started = time.monotonic()
+        data = response.raw.read(chunk_size, decode_content=True)
+        if not data:
+            break
+        f.write(data)
+        f.flush()  # Bytes must be on disk before on_data lets hash_prefix read them
+        offset += len(data)
+        on_data(len(data))
+        elapsed = time.monotonic() - started
+        if elapsed < 0.05:
+            chunk_size = min(chunk_size * 2, DOWNLOAD_MAX_CHUNK)
+        elif elapsed > 0.5:
+            chunk_size = max(chunk_size // 2, DOWNLOAD_MIN_CHUNK)
+    return offset
+
+
+# Serialises updates of the download cache's urls.json within this process
+_urls_index_lock = threading.Lock()
+
+
+def _update_urls_index(urls_index_path, url, entry):
+    """Record the cached package of url in urls.json.
+
+    The index is re-read under a lock so concurrent downloads keep each
+    other's entries, and written to a temporary file that replaces it, so a
+    crash never leaves a truncated index behind.
+    """
+    with _urls_index_lock:
+        urls_index = {}
+        if os.path.exists(urls_index_path):
+            with open(urls_index_path) as f:
+                urls_index = json.load(f)
+        urls_index[url] = entry
+        # Unique per writer, so another process updating the same cache cannot clobber it
+        temp_path = f"{urls_index_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(urls_index, f, indent=2)
+        os.replace(temp_path, urls_index_path)
+
+
+def download_file(url, cache_dir=DOWNLOAD_CACHE_DIR, segments=DOWNLOAD_SEGMENTS, expected_sha256=None,
+                  session=None, progress=None, log=print):
+    """Download url into a content-addressed cache and return the cached path.
+
+    Servers that support Range requests are fetched in up to `segments`
+    concurrent ranges over one pooled session; progress is kept in a JSON
+    sidecar next to the partial file so an interrupted download resumes where
+    it stopped. The SHA-256 is computed over the contiguous prefix while the
+    ranges are still arriving and checked against expected_sha256 (or the
+    published <url>.sha256). Packages already in the cache are not fetched again.
+    """
+    session = session or make_download_session(segments)
+    expected_sha256 = (expected_sha256 or fetch_published_sha256(session, url) or "").lower() or None
+    blobs_dir = os.path.join(cache_dir, "sha256")
+    partial_dir = os.path.join(cache_dir, "partial")
+    os.makedirs(blobs_dir, exist_ok=True)
+    os.makedirs(partial_dir, exist_ok=True)
+
+    if expected_sha256 and os.path.exists(os.path.join(blobs_dir, f"{expected_sha256}.zip")):
+        log(f"Using cached package {expected_sha256}.")
+        return os.path.join(blobs_dir, f"{expected_sha256}.zip")
+
+    head = session.head(url, allow_redirects=True, timeout=30)
+    size = int(head.headers.get("Content-Length", 0) or 0)
+    etag = head.headers.get("ETag", "")
+    ranged = head.status_code == 200 and head.headers.get("Accept-Ranges", "").lower() == "bytes" and size > 0
+
+    urls_index_path = os.path.join(cache_dir, "urls.json")
+    urls_index = {}
+    if os.path.exists(urls_index_path):
+        with open(urls_index_path) as f:
+            urls_index = json.load(f)
+    known = urls_index.get(url)
+    if (not expected_sha256 and known and etag and known["etag"] == etag and known["size"] == size
+            and os.path.exists(os.path.join(blobs_dir, f"{known['sha256']}.zip"))):
+        log(f"Using cached package {known['sha256']} (ETag unchanged).")
+        return os.path.join(blobs_dir, f"{known['sha256']}.zip")
+
+    key = hashlib.sha256(url.encode()).hexdigest()[:32]
+    partial_path = os.path.join(partial_dir, f"{key}.part")
+    sidecar_path = f"{partial_path}.json"
+    state = None
+    if ranged and os.path.exists(partial_path) and os.path.exists(sidecar_path):
+        with open(sidecar_path) as f:
+            state = json.load(f)
+        if (state["url"], state["size"], state["etag"]) != (url, size, etag):
+            state = None
+        else:
+            log(f"Resuming download: {sum(seg['done'] for seg in state['segments'])} of {size} bytes present.")
+    if state is None:
+        count = max(1, min(segments, size // DOWNLOAD_MIN_SEGMENT)) if ranged else 1
+        step = -(-size // count) if ranged else 0
+        state = {"url": url, "size": size, "etag": etag, "segments": [
+            {"start": i * step, "end": min((i + 1) * step, size) - 1, "done": 0} for i in range(count)
+        ]}
+        with open(partial_path, "wb") as f:
+            if ranged:
+                f.truncate(size)
+
+    lock = threading.Lock()
+    stop = threading.Event()
+    last_saved = time.monotonic()
+
+    def save_state():
+        with open(f"{sidecar_path}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{sidecar_path}.tmp", sidecar_path)
+
+    def fetch(segment):
+        nonlocal last_saved
+
+        def on_data(n):
+            nonlocal last_saved
+            with lock:
+                segment["done"] += n
+                if time.monotonic() - last_saved >= 1.0:
+                    save_state()
+                    last_saved = time.monotonic()
+
+        start = segment["start"] + segment["done"]
+        headers = {}
+        if ranged:
+            if start > segment["end"]:
+                return
+            headers["Range"] = f"bytes={start}-{segment['end']}"
+        with session.get(url, headers=headers, stream=True, timeout=60) as response:
+            if response.status_code != (206 if ranged else 200):
+                raise Exception(f"Failed to download update (HTTP {response.status_code}).")
+            # Each segment writes through its own handle (os.pwrite is not available on Windows)
+            with open(partial_path, "r+b") as f:
+                f.seek(start)
+                _stream_to_file(response, f, start, on_data, stop)
+
+    digest = hashlib.sha256()
+    hashed = 0
+
+    def contiguous_end():
+        for segment in state["segments"]:
+            if segment["start"] + segment["done"] <= segment["end"] or not ranged:
+                return segment["start"] + segment["done"]
+        return size
+
+    def hash_prefix(f):
+        nonlocal hashed
+        with lock:
+            end = contiguous_end()
+        while hashed < end:
+            f.seek(hashed)
+            data = f.read(min(DOWNLOAD_MAX_CHUNK, end - hashed))
+            if not data:
+                break
+            digest.update(data)
+            hashed += len(data)
+
+    reader = open(partial_path, "rb", buffering=0)
+    try:
+        with ThreadPoolExecutor(max_workers=len(state["segments"])) as pool:
+            futures = [pool.submit(fetch, segment) for segment in state["segments"]]
+            try:
+                while futures:
+                    done, _ = wait(futures, timeout=1.0)
+                    for future in done:
+                        futures.remove(future)
+                        future.result()
+                    hash_prefix(reader)
+                    if progress:
+                        with lock:
+                            progress(sum(seg["done"] for seg in state["segments"]), size)
+            except BaseException:
+                stop.set()
+                raise
+            finally:
+                with lock:
+                    save_state()
+        hash_prefix(reader)
+    finally:
+        reader.close()
+    if ranged and hashed != size:
+        raise Exception(f"Download of {url} ended early at {hashed} of {size} bytes; run again to resume.")
+
+    sha256 = digest.hexdigest()
+    if expected_sha256 and sha256 != expected_sha256:
+        os.remove(partial_path)
+        os.remove(sidecar_path)
+        raise Exception(f"Checksum mismatch for {url}: expected {expected_sha256}, got {sha256}.")
+    if not expected_sha256:
+        log("No published checksum found; the package could not be verified.")
+
+    cached_path = os.path.join(blobs_dir, f"{sha256}.zip")
+    os.replace(partial_path, cached_path)
+    os.remove(sidecar_path)
+    _update_urls_index(urls_index_path, url, {"sha256": sha256, "etag": etag, "size": size})
+    log(f"Downloaded {hashed} bytes in {len(state['segments'])} segment(s), SHA-256 {sha256}.")
+    return cached_path
+
+
+def _zip_root(names):
+    """Return the single top-level directory shared by every zip member, or ''."""
+    roots = {name.split("/", 1)[0] for name in names}
+    if len(roots) == 1 and all("/" in name for name in names):
+        return roots.pop() + "/"
+    return ""
+
+
+def extract_zip_parallel(zip_file, dest, workers=COPY_WORKERS, strip_root=True, members=None, progress=None):
+    """Stream every member of zip_file into dest, decompressing members in parallel.
+
+    Each worker thread reads through its own ZipFile handle and writes members
+    straight to their final path, so nothing is staged twice; every file is
+    written under a temporary name and renamed into place. With strip_root,
+    a single top-level directory (moodle/ in Moodle packages) is removed from
+    member paths. members optionally limits extraction to a set of
+    root-relative file names. Returns (files, bytes).
+    """
+    local = threading.local()
+    handles = []
+
+    def extract(info, target):
+        if not hasattr(local, "zip"):
+            local.zip = zipfile.ZipFile(zip_file)
+            handles.append(local.zip)
+        partial = f"{target}.part"
+        with local.zip.open(info) as source, open(partial, "wb") as out:
+            shutil.copyfileobj(source, out, 1024 * 1024)
+        mode = (info.external_attr >> 16) & 0o777
+        if mode:
+            os.chmod(partial, mode)
+        os.replace(partial, target)
+        return info.file_size
+
+    def tasks(infos, root):
+        for info in infos:
+            name = info.filename[len(root):]
+            if not name or name.startswith("/") or ".." in name.split("/"):
+                continue
+            target = os.path.join(dest, *name.split("/"))
+            if info.is_dir():
+                if members is None:
+                    os.makedirs(target, exist_ok=True)
+                continue
+            if members is not None and name not in members:
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            yield lambda info=info, target=target: extract(info, target)
+
+    with zipfile.ZipFile(zip_file) as archive:
+        infos = archive.infolist()
+    root = _zip_root([info.filename for info in infos]) if strip_root else ""
+    os.makedirs(dest, exist_ok=True)
+    try:
+        return run_bounded(tasks(infos, root), workers=workers, progress=progress)
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+def file_crc32(path, chunk_size=1024 * 1024):
+    """Return the CRC32 of a file, as stored in zip central directories."""
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _package_layout(zip_file):
+    """Return a package's root-relative file names mapped to their ZipInfo, and every directory it ships."""
+    with zipfile.ZipFile(zip_file) as archive:
+        infos = archive.infolist()
+    root = _zip_root([info.filename for info in infos])
+    package = {
+        info.filename[len(root):]: info
+        for info in infos if not info.is_dir() and info.filename[len(root):]
+    }
+    package_dirs = {name.rsplit("/", 1)[0] for name in package if "/" in name}
+    package_dirs |= {"/".join(d.split("/")[:i]) for d in list(package_dirs) for i in range(1, d.count("/") + 1)}
+    return package, package_dirs
+
+
+def _scan_live_tree(moodle_path, package_dirs, ignore=BACKUP_IGNORE):
+    """Walk the live code tree and return (files, plugins) as root-relative paths.
+
+    A plugin is a directory with a version.php that the package does not
+    ship, such as an add-on under local/ or mod/; directories inside a
+    plugin are part of it. Symlinked plugin directories count as plugins too.
+    """
+    local_files = []
+    plugins = set()
+    for dirpath, dirnames, filenames in os.walk(moodle_path):
+        dirnames[:] = [d for d in dirnames if not _ignored(d, ignore)]
+        rel_dir = os.path.relpath(dirpath, moodle_path).replace(os.sep, "/")
+        rel_dir = "" if rel_dir == "." else rel_dir
+        if rel_dir and rel_dir not in package_dirs and "version.php" in filenames \
+                and not any(rel_dir.startswith(f"{p}/") for p in plugins):
+            plugins.add(rel_dir)
+        for dirname in dirnames:
+            # os.walk does not descend into symlinked directories
+            rel_link = f"{rel_dir}/{dirname}" if rel_dir else dirname
+            if os.path.islink(os.path.join(dirpath, dirname)) and rel_link not in package_dirs \
+                    and os.path.isfile(os.path.join(dirpath, dirname, "version.php")) \
+                    and not any(rel_link.startswith(f"{p}/") for p in plugins):
+                plugins.add(rel_link)
+        for filename in filenames:
+            if not _ignored(filename, ignore):
+                local_files.append(f"{rel_dir}/{filename}" if rel_dir else filename)
+    return local_files, plugins
+
+
+def plan_delta(moodle_path, zip_file, workers=COPY_WORKERS, ignore=BACKUP_IGNORE):
+    """Compare the live code tree with a Moodle package's central directory.
+
+    Files are compared by size first and CRC32 second, hashed in parallel.
+    Returns a dict with the root-relative paths to add, change and remove,
+    the number of unchanged files, and the local plugins that were kept.
+    Files missing from the package are removed unless they sit at the top
+    level (config.php and other site files) or inside a plugin directory,
+    i.e. one with a version.php, that the package does not ship.
+    """
+    package, package_dirs = _package_layout(zip_file)
+    local_files, plugins = _scan_live_tree(moodle_path, package_dirs, ignore)
+
+    changed = []
+
+    def compare(name):
+        info = package[name]
+        path = os.path.join(moodle_path, *name.split("/"))
+        if os.path.islink(path) or os.path.getsize(path) != info.file_size or file_crc32(path) != info.CRC:
+            changed.append(name)
+        return info.file_size
+
+    local_set = set(local_files)
+    run_bounded((lambda name=name: compare(name) for name in package if name in local_set), workers=workers)
+
+    removed = []
+    for name in local_files:
+        if name in package or "/" not in name or name.split("/", 1)[0] not in package_dirs:
+            continue
+        if any(name.startswith(f"{plugin}/") for plugin in plugins):
+            continue
+        removed.append(name)
+
+    added = [name for name in package if name not in local_set]
+    return {
+        "added": sorted(added),
+        "changed": sorted(changed),
+        "removed": sorted(removed),
+        "unchanged": len(package) - len(added) - len(changed),
+        "plugins": sorted(plugins),
+    }
+
+
+def apply_delta(moodle_path, zip_file, workers=COPY_WORKERS, progress=None, log=print):
+    """Bring the live code tree in line with a package by touching only files that differ."""
+    delta = plan_delta(moodle_path, zip_file, workers=workers)
+    for plugin in delta["plugins"]:
+        log(f"Keeping local plugin not shipped in the package: {plugin}")
+    files, nbytes = extract_zip_parallel(
+        zip_file, moodle_path, workers=workers,
+        members=set(delta["added"]) | set(delta["changed"]), progress=progress
+    )
+    for name in delta["removed"]:
+        path = os.path.join(moodle_path, *name.split("/"))
+        os.remove(path)
+        # Drop directories the removal left empty
+        parent = os.path.dirname(path)
+        while os.path.abspath(parent) != os.path.abspath(moodle_path) and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+    log(f"Delta upgrade: {len(delta['added'])} added, {len(delta['changed'])} changed, "
+        f"{len(delta['removed'])} removed, {delta['unchanged']} unchanged ({nbytes} bytes written).")
+    return delta
+
+
+def stage_release(moodle_path, zip_file, workers=COPY_WORKERS, progress=None, log=print):
+    """Extract a Moodle package into a staging directory next to the live code.
+
+    Top-level entries of the live tree that the package does not contain
+    (config.php, local additions) and add-on plugins inside shipped
+    directories (local/*, mod/*, theme/*, ... as found by plan_delta) are
+    copied across so the staged tree can replace the live one as a whole.
+    Returns the staging path.
+    """
+    live = os.path.realpath(moodle_path)
+    if os.path.islink(moodle_path.rstrip(os.sep)):
+        # Symlinked layout: the staged tree becomes a new release directory next to the current one
+        staging = os.path.join(os.path.dirname(live), f"release-{time.strftime('%Y%m%d-%H%M%S')}")
+    else:
+        staging = f"{live}.staging-{time.strftime('%Y%m%d-%H%M%S')}"
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    files, nbytes = extract_zip_parallel(zip_file, staging, workers=workers, progress=progress)
+    log(f"Extracted {files} file(s), {nbytes} bytes into {staging}.")
+
+    for item in os.listdir(live):
+        source = os.path.join(live, item)
+        target = os.path.join(staging, item)
+        if os.path.lexists(target):
+            continue
+        if os.path.isdir(source) and not os.path.islink(source):
+            copy_tree_parallel(source, target, workers=workers, ignore=())
+        else:
+            shutil.copy2(source, target, follow_symlinks=False)
+        log(f"Kept {item} from the current installation.")
+
+    # Plugins inside directories the package ships, which the loop above did not copy
+    _, package_dirs = _package_layout(zip_file)
+    _, plugins = _scan_live_tree(live, package_dirs)
+    for plugin in sorted(plugins):
+        source = os.path.join(live, *plugin.split("/"))
+        target = os.path.join(staging, *plugin.split("/"))
+        if os.path.lexists(target):
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.islink(source):
+            os.symlink(os.readlink(source), target)
+        else:
+            copy_tree_parallel(source, target, workers=workers, ignore=())
+        log(f"Keeping local plugin not shipped in the package: {plugin}")
+    return staging
+
+
+def swap_release(moodle_path, staging, log=print):
+    """Make staging the live code tree and keep the old one at <moodle_path>.previous.
+
+    When moodle_path is a symlink the switch is a single atomic symlink
+    replacement; otherwise the live directory and the staging directory are
+    exchanged with two back-to-back renames on the same filesystem.
+    """
+    moodle_path = moodle_path.rstrip(os.sep)
+    previous = f"{moodle_path}.previous"
+    if os.path.islink(previous):
+        os.unlink(previous)
+    elif os.path.isdir(previous):
+        shutil.rmtree(previous)
+
+    if os.path.islink(moodle_path):
+        os.symlink(os.readlink(moodle_path), previous)
+        link = f"{moodle_path}.new"
+        os.symlink(staging, link)
+        os.replace(link, moodle_path)
+    else:
+        os.rename(moodle_path, previous)
+        os.rename(staging, moodle_path)
+    log(f"Switched {moodle_path} to the new release; previous tree kept at {previous}.")
+
+
+def rollback_release(moodle_path, log=print):
+    """Swap the live code tree back with <moodle_path>.previous."""
+    moodle_path = moodle_path.rstrip(os.sep)
+    previous = f"{moodle_path}.previous"
+    if not os.path.lexists(previous):
+        raise Exception(f"No previous release found at {previous}.")
+    if os.path.islink(moodle_path):
+        current = os.readlink(moodle_path)
+        link = f"{moodle_path}.new"
+        os.symlink(os.readlink(previous), link)
+        os.replace(link, moodle_path)
+        os.unlink(previous)
+        os.symlink(current, previous)
+    else:
+        swap = f"{moodle_path}.rollback"
+        os.rename(moodle_path, swap)
+        os.rename(previous, moodle_path)
+        os.rename(swap, previous)
+    log(f"Rolled {moodle_path} back; the rolled-back tree is now at {previous}.")
+
+
+def backup_site(moodle_path, data_path, mode="copy", workers=COPY_WORKERS, use_hash=False,
+                retention=SNAPSHOT_RETENTION, progress=None, log=print):
+    """Backup the Moodle code and data directories.
+
+    mode is "copy" for a full copy to <path>_backup, "snapshot" for incremental
+    snapshots under <path>_snapshots, or "archive" for one indexed .tar.gz.
+    """
+    log("Backing up Moodle directories...")
+
+    if mode == "archive":
+        archive_path = f"{moodle_path.rstrip(os.sep)}_backup_{time.strftime('%Y%m%d-%H%M%S')}.tar.gz"
+        try:
+            write_backup_archive(
+                archive_path, {"code": moodle_path, "data": data_path},
+                workers=workers, progress=progress, log=log
+            )
+        except PermissionError as e:
+            log(f"Permission error while archiving: {e}")
+            raise Exception("Access denied during backup archive. Please check permissions.")
+        except Exception as e:
+            log(f"Unexpected error while archiving: {e}")
+            raise Exception(f"Failed to write backup archive: {e}")
+        log(f"Backup archive completed at {archive_path}.")
+        return
+
+    # Report progress cumulatively across the code and data trees
+    totals = {"files": 0, "bytes": 0}
+    tree = {"files": 0, "bytes": 0}
+
+    def tree_progress(files, nbytes):
+        tree.update(files=files, bytes=nbytes)
+        if progress:
+            progress(totals["files"] + files, totals["bytes"] + nbytes)
+
+    for path, name in [(moodle_path, "code"), (data_path, "data")]:
+        # A trailing separator would put the backup inside the tree being copied
+        path = path.rstrip(os.sep)
+        backup_path = f"{path}_backup"
+        totals["files"] += tree["files"]
+        totals["bytes"] += tree["bytes"]
+        tree.update(files=0, bytes=0)
+        try:
+            if mode == "snapshot":
+                snapshot_root = f"{path}_snapshots"
+                snapshot = snapshot_tree(
+                    path, snapshot_root, use_hash=use_hash, workers=workers, progress=tree_progress, log=log
+                )
+                prune_snapshots(snapshot_root, keep=retention, log=log)
+                log(f"Snapshot of {name} directory completed at {snapshot}.")
+                continue
+            if os.path.exists(backup_path):
+                shutil.rmtree(backup_path)
+            copy_tree_parallel(path, backup_path, workers=workers, progress=tree_progress)
+            log(f"Backup of {name} directory completed at {backup_path}.")
+        except PermissionError as e:
+            log(f"Permission error while backing up {name}: {e}")
+            raise Exception(f"Access denied during backup of {name}. Please check permissions.")
+        except Exception as e:
+            log(f"Unexpected error while backing up {name}: {e}")
+            raise Exception(f"Failed to backup {name}: {e}")
+
+
+def backup_site_database(db_params, data_path, workers=DUMP_WORKERS, progress=None, log=print):
+    """Dump the Moodle database next to the data directory and return the dump path."""
+    import mysql.connector
+
+    log("Dumping Moodle database...")
+    dump_path = f"{data_path.rstrip(os.sep)}_dbdump_{time.strftime('%Y%m%d-%H%M%S')}"
+    try:
+        dump_database(db_params, dump_path, workers=workers, progress=progress, log=log)
+    except (mysql.connector.Error, ValueError) as e:
+        log(f"Database dump failed: {e}")
+        raise Exception(f"Failed to dump database: {e}")
+    log(f"Database dump completed at {dump_path}.")
+    return dump_path
+
+
+def install_release(moodle_path, zip_file, delta=False, workers=COPY_WORKERS, progress=None, log=print):
+    """Replace existing Moodle files with the new version, in place (delta) or by staging and swapping."""
+    if delta:
+        log("Applying changed Moodle files in place...")
+        apply_delta(moodle_path, zip_file, workers=workers, progress=progress, log=log)
+    else:
+        log("Extracting and replacing Moodle files...")
+        staging = stage_release(moodle_path, zip_file, workers=workers, progress=progress, log=log)
+        swap_release(moodle_path, staging, log=log)
+    log("Files replaced successfully.")
+
+
+def run_php_script(script_path, args=(), log=print):
+    """Run a Moodle CLI script with php, relaying its output.
+
+    Returns the exit status and the last 20 lines of output.
+    """
+    process = subprocess.Popen(
+        ["php", script_path, *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1
+    )
+    # Relay output as it is produced, keeping only the tail for the error message
+    tail = []
+    for line in process.stdout:
+        line = line.rstrip("\n")
+        log(line)
+        tail = (tail + [line])[-20:]
+    return process.wait(), tail
+
+
+def run_upgrade_script(moodle_path, log=print):
+    """Run Moodle's CLI script to upgrade the database."""
+    log("Running database upgrade script...")
+    script_path = os.path.join(moodle_path, "admin", "cli", "upgrade.php")
+    if not os.path.exists(script_path):
+        raise Exception("CLI upgrade script not found.")
+    status, tail = run_php_script(script_path, ["--non-interactive"], log=log)
+    if status != 0:
+        raise Exception("Database upgrade failed: " + "\n".join(tail))
+
+
+def purge_caches(moodle_path, log=print):
+    """Purge every Moodle cache (MUC, theme, JavaScript and language caches) with the CLI script."""
+    log("Purging Moodle caches...")
+    script_path = os.path.join(moodle_path, "admin", "cli", "purge_caches.php")
+    if not os.path.exists(script_path):
+        raise Exception("CLI cache purge script not found.")
+    status, tail = run_php_script(script_path, log=log)
+    if status != 0:
+        raise Exception("Cache purge failed: " + "\n".join(tail))
+
+
+def build_theme_css(moodle_path, themes=None, log=print):
+    """Compile theme CSS ahead of the first request with admin/cli/build_theme_css.php.
+
+    themes is a list of theme names, or None for every installed theme.
+    Releases without the script (before Moodle 3.7) are skipped and their CSS
+    is built by the warm-up requests instead. Returns True if the script ran.
+    """
+    script_path = os.path.join(moodle_path, "admin", "cli", "build_theme_css.php")
+    if not os.path.exists(script_path):
+        log("No build_theme_css.php in this release; theme CSS will be built by the warm-up requests.")
+        return False
+    log("Building theme CSS...")
+    status, tail = run_php_script(script_path, [f"--themes={','.join(themes)}"] if themes else [], log=log)
+    if status != 0:
+        raise Exception("Theme CSS build failed: " + "\n".join(tail))
+    return True
+
+
+def latency_percentiles(samples):
+    """Return the 50th, 90th, 95th and 99th percentile and maximum of samples, in seconds."""
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+    report = {f"p{p}": round(ordered[min(len(ordered) - 1, -(-len(ordered) * p // 100) - 1)], 4)
+              for p in (50, 90, 95, 99)}
+    report["max"] = round(ordered[-1], 4)
+    return report
+
+
+def warm_up_urls(urls, concurrency=WARMUP_CONCURRENCY, max_rounds=WARMUP_MAX_ROUNDS,
+                 tolerance=WARMUP_STABLE_CHANGE, cookies=None, timeout=WARMUP_TIMEOUT, progress=None, log=print):
+    """Request urls in rounds until their response times stabilize.
+
+    Every round requests each URL `concurrency` times from that many threads.
+    After the first round, the theme and JavaScript bundles the pages link to
+    are fetched once. Rounds stop when the median latency changes by less than
+    tolerance from one round to the next, or after max_rounds. Returns a dict
+    with the latency percentiles of the first ("before") and last ("after")
+    rounds, the number of rounds and requests, and the failed requests.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.cookies.update(cookies or {})
+    report = {"rounds": 0, "requests": 0, "errors": 0, "assets": 0, "stable": False}
+    last_error = None
+
+    def fetch(url):
+        nonlocal last_error
+        started = time.perf_counter()
+        try:
+            response = session.get(url, timeout=timeout)
+            elapsed = time.perf_counter() - started
+            if response.status_code >= 500:
+                raise Exception(f"HTTP {response.status_code} from {url}")
+            return elapsed, response.text if "html" in response.headers.get("Content-Type", "") else ""
+        except Exception as e:
+            last_error = e
+            return None, ""
+
+    batch = [url for url in urls for _ in range(concurrency)]
+    rounds = []
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for number in range(1, max_rounds + 1):
+                results = list(pool.map(fetch, batch))
+                samples = [elapsed for elapsed, _ in results if elapsed is not None]
+                report["requests"] += len(results)
+                report["errors"] += len(results) - len(samples)
+                if not samples:
+                    raise Exception(f"Warm-up could not fetch any page: {last_error}")
+                rounds.append(samples)
+                if progress:
+                    progress(number, max_rounds)
+                median = latency_percentiles(samples)["p50"]
+                log(f"Warm-up round {number}: median {median * 1000:.0f} ms over {len(samples)} request(s).")
+                if number == 1:
+                    assets = {urljoin(url, html.unescape(match))
+                              for url, (_, page) in zip(batch, results) for match in WARMUP_ASSET_RE.findall(page)}
+                    list(pool.map(fetch, sorted(assets)))
+                    report["assets"] = len(assets)
+                    if assets:
+                        log(f"Fetched {len(assets)} theme and JavaScript bundle(s).")
+                    continue
+                previous = latency_percentiles(rounds[-2])["p50"]
+                if abs(median - previous) <= tolerance * previous:
+                    report["stable"] = True
+                    break
+    finally:
+        session.close()
+    report["rounds"] = len(rounds)
+    report["before"] = latency_percentiles(rounds[0])
+    report["after"] = latency_percentiles(rounds[-1])
+    return report
+
+
+def warm_up_site(site, progress=None, log=print):
+    """Purge caches, build theme CSS and warm the site's pages after an upgrade.
+
+    Uses the site's wwwroot with the optional warmup_paths (absolute URLs or
+    paths relative to wwwroot), warmup_concurrency, warmup_rounds,
+    warmup_themes and warmup_cookies (e.g. a MoodleSession cookie so the
+    dashboard is rendered for a real user). Returns the warm_up_urls report.
+    """
+    if not site.get("wwwroot"):
+        raise Exception(f"Warming up {site.get('name', 'the site')} needs its wwwroot.")
+    purge_caches(site["code_path"], log=log)
+    build_theme_css(site["code_path"], site.get("warmup_themes"), log=log)
+    base = site["wwwroot"].rstrip("/") + "/"
+    urls = [urljoin(base, path.lstrip("/")) for path in site.get("warmup_paths") or WARMUP_PATHS]
+    report = warm_up_urls(
+        urls, concurrency=site.get("warmup_concurrency", WARMUP_CONCURRENCY),
+        max_rounds=site.get("warmup_rounds", WARMUP_MAX_ROUNDS), cookies=site.get("warmup_cookies"),
+        progress=progress, log=log
+    )
+    before, after = report["before"], report["after"]
+    log(f"Warm-up {'stabilized' if report['stable'] else 'stopped'} after {report['rounds']} round(s): "
+        f"p50 {before['p50'] * 1000:.0f} -> {after['p50'] * 1000:.0f} ms, "
+        f"p95 {before['p95'] * 1000:.0f} -> {after['p95'] * 1000:.0f} ms, "
+        f"p99 {before['p99'] * 1000:.0f} -> {after['p99'] * 1000:.0f} ms"
+        + (f"; {report['errors']} request(s) failed." if report["errors"] else "."))
+    return report
+
+
+def load_inventory(path):
+    """Load a fleet inventory from JSON or YAML.
+
+    The inventory holds a list of "sites", each with name, code_path,
+    data_path, url, an optional sha256 and a "db" mapping of mysql.connector
+    parameters, plus optional "defaults" merged into every site. Per-site
+    options are backup_mode, hash_backup, retention, dump_database,
+    dump_workers, delta, copy_workers and io_group, plus warmup (with
+    wwwroot and the warmup_* options read by warm_up_site).
+    """
+    with open(path) as f:
+        if path.endswith((".yml", ".yaml")):
+            try:
+                import yaml
+            except ImportError:
+                raise Exception("Reading a YAML inventory requires PyYAML (pip install pyyaml).")
+            inventory = yaml.safe_load(f)
+        else:
+            inventory = json.load(f)
+    defaults = inventory.get("defaults", {})
+    sites = []
+    for number, site in enumerate(inventory.get("sites", []), start=1):
+        site = {**defaults, **site}
+        site.setdefault("name", f"site{number}")
+        for key in ("code_path", "data_path", "url"):
+            if not site.get(key):
+                raise Exception(f"Inventory entry {site['name']} is missing {key}.")
+        sites.append(site)
+    return sites
+
+
+class SharedDownloads:
+    """Download each package URL once, however many sites ask for it concurrently."""
+
+    def __init__(self, cache_dir=DOWNLOAD_CACHE_DIR, segments=DOWNLOAD_SEGMENTS):
+        self.cache_dir = cache_dir
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.downloads = {}
+
+    def get(self, url, expected_sha256=None, progress=None, log=print):
+        with self.lock:
+            future = self.downloads.get(url)
+            owner = future is None
+            if owner:
+                future = self.downloads[url] = Future()
+        if owner:
+            try:
+                future.set_result(download_file(
+                    url, cache_dir=self.cache_dir, segments=self.segments,
+                    expected_sha256=expected_sha256, progress=progress, log=log
+                ))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            log("Waiting for a download already started by another site...")
+        return future.result()
+
+
+def read_process_io():
+    """Return this process's cumulative I/O counters, or {} where /proc is unavailable."""
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(":") for line in f)}
+    except OSError:
+        return {}
+
+
+def peak_rss_bytes():
+    """Return the peak resident set size of this process in bytes, or None."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageMetrics:
+    """Record wall time, I/O, counts and peak RSS for each stage of one site's upgrade.
+
+    Every finished stage is appended to path as one JSON line. I/O counters
+    come from /proc/self/io and peak RSS from getrusage, so both cover the
+    whole process when several sites run at once.
+    """
+    write_lock = threading.Lock()
+
+    def __init__(self, site, release=None, path=METRICS_LOG):
+        self.site = site
+        self.release = release
+        self.path = path
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure the enclosed block; callers may add files, bytes or rows to the yielded record."""
+        record = {"site": self.site, "release": self.release, "stage": name,
+                  "started": datetime.datetime.now().isoformat(timespec="seconds")}
+        io_before = read_process_io()
+        started = time.monotonic()
+        record["status"] = "failed"
+        try:
+            yield record
+            record["status"] = "ok"
+        finally:
+            wall = time.monotonic() - started
+            io_after = read_process_io()
+            record["wall_seconds"] = round(wall, 3)
+            for counter, key in (("rchar", "read_bytes"), ("wchar", "write_bytes"),
+                                 ("read_bytes", "disk_read_bytes"), ("write_bytes", "disk_write_bytes")):
+                if counter in io_after:
+                    record[key] = io_after[counter] - io_before.get(counter, 0)
+            record["peak_rss_bytes"] = peak_rss_bytes()
+            if "rows" in record:
+                record["rows_per_second"] = round(record["rows"] / max(wall, 1e-6), 1)
+            if "bytes" in record:
+                record["bytes_per_second"] = round(record["bytes"] / max(wall, 1e-6), 1)
+            self.records.append(record)
+            if self.path:
+                with self.write_lock, open(self.path, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+
+
+_PROMETHEUS_LABEL_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n"})
+
+
+def write_prometheus(records, path):
+    """Write stage metrics in the Prometheus text exposition format.
+
+    The file is replaced atomically so a node_exporter textfile collector
+    never reads a half-written file.
+    """
+    gauges = [
+        ("wall_seconds", "moodle_upgrade_stage_seconds", "Wall time of an upgrade stage."),
+        ("bytes", "moodle_upgrade_stage_bytes", "Bytes copied, archived or downloaded by a stage."),
+        ("files", "moodle_upgrade_stage_files", "Files processed by a stage."),
+        ("rows", "moodle_upgrade_stage_rows", "Database rows dumped by a stage."),
+        ("bytes_per_second", "moodle_upgrade_stage_bytes_per_second", "Throughput of a stage in bytes per second."),
+        ("rows_per_second", "moodle_upgrade_stage_rows_per_second", "Database rows dumped per second by a stage."),
+        ("read_bytes", "moodle_upgrade_stage_read_bytes", "Bytes read by the process during a stage."),
+        ("write_bytes", "moodle_upgrade_stage_write_bytes", "Bytes written by the process during a stage."),
+        ("peak_rss_bytes", "moodle_upgrade_peak_rss_bytes", "Peak resident set size at the end of a stage."),
+        ("before_p50_seconds", "moodle_upgrade_warmup_before_p50_seconds", "Median page latency before warm-up."),
+        ("before_p95_seconds", "moodle_upgrade_warmup_before_p95_seconds", "95th percentile latency before warm-up."),
+        ("after_p50_seconds", "moodle_upgrade_warmup_after_p50_seconds", "Median page latency after warm-up."),
+        ("after_p95_seconds", "moodle_upgrade_warmup_after_p95_seconds", "95th percentile latency after warm-up."),
+    ]
+    lines = []
+    for key, metric, help_text in gauges:
+        samples = [r for r in records if r.get(key) is not None]
+        if not samples:
+            continue
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        for r in samples:
+            labels = ",".join(f'{label}="{str(r[label]).translate(_PROMETHEUS_LABEL_ESCAPES)}"'
+                              for label in ("site", "stage", "status"))
+            lines.append(f"{metric}{{{labels}}} {r[key]}")
+    with open(f"{path}.tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(f"{path}.tmp", path)
+
+
+def upgrade_site(site, downloads, io_lock, timings=None, progress=None, metrics=None, log=print):
+    """Run backup, dump, download, replace, upgrade.php and the optional warm-up for one inventory site.
+
+    io_lock guards the disk-heavy stages so sites sharing a disk take turns.
+    Stage timings in seconds are recorded in timings as each stage finishes,
+    whether it succeeded or failed, and the dict is returned. progress(stage, done, total, unit) receives
+    progress from every stage that reports it; total is 0 when unknown.
+    Each stage is also measured by metrics (a StageMetrics), if given.
+    A failed warm-up is logged and recorded as failed in its metrics record
+    but does not fail the upgrade, which has already completed by then.
+    """
+    timings = {} if timings is None else timings
+    progress = progress or (lambda stage, done, total, unit: None)
+    metrics = metrics or StageMetrics(site["name"], release=site["url"], path=None)
+    current = {}
+
+    def report(name, done, total, unit, **counts):
+        current.update(counts)
+        progress(name, done, total, unit)
+
+    def stage(name, func, *args, disk=False, **kwargs):
+        nonlocal current
+        started = time.monotonic()
+        try:
+            with metrics.stage(name) as current:
+                if disk:
+                    with io_lock:
+                        return func(*args, **kwargs)
+                return func(*args, **kwargs)
+        finally:
+            # A failed stage keeps its duration too; its metrics record says it failed
+            timings[name] = time.monotonic() - started
+
+    workers = site.get("copy_workers", COPY_WORKERS)
+    stage("backup", backup_site, site["code_path"], site["data_path"], disk=True,
+          mode=site.get("backup_mode", "copy"), workers=workers, use_hash=site.get("hash_backup", False),
+          retention=site.get("retention", SNAPSHOT_RETENTION),
+          progress=lambda files, nbytes: report("backup", nbytes, 0, "bytes", files=files, bytes=nbytes),
+          log=log)
+    if site.get("dump_database", True):
+        db_params = dict(site.get("db", {}))
+        db_params["port"] = int(db_params.get("port", 3306))
+        stage("dump", backup_site_database, db_params, site["data_path"], disk=True,
+              workers=site.get("dump_workers", DUMP_WORKERS),
+              progress=lambda parts, rows: report("dump", rows, 0, "rows", files=parts, rows=rows), log=log)
+    zip_file = stage("download", downloads.get, site["url"], site.get("sha256"),
+                     progress=lambda done, total: report("download", done, total, "bytes", bytes=done), log=log)
+    stage("replace", install_release, site["code_path"], zip_file, disk=True,
+          delta=site.get("delta", False), workers=workers,
+          progress=lambda files, nbytes: report("replace", nbytes, 0, "bytes", files=files, bytes=nbytes),
+          log=log)
+    stage("upgrade", run_upgrade_script, site["code_path"], log=log)
+    if site.get("warmup"):
+        def warm_up():
+            # Latency percentiles go into the stage's metrics record
+            try:
+                result = warm_up_site(site, progress=lambda done, total: report("warmup", done, total, "rounds"),
+                                      log=log)
+            except Exception as e:
+                current["error"] = str(e)
+                raise
+            current.update(rounds=result["rounds"], requests=result["requests"], errors=result["errors"],
+                           stable=result["stable"])
+            for when in ("before", "after"):
+                for key, seconds in result[when].items():
+                    current[f"{when}_{key}_seconds"] = seconds
+            return result
+
+        # The site is already upgraded: a failed warm-up is reported but does not fail the upgrade
+        try:
+            stage("warmup", warm_up)
+        except Exception as e:
+            log(f"Warm-up failed: {e}")
+    return timings
+
+
+def run_fleet(inventory_path, concurrency=FLEET_CONCURRENCY, io_concurrency=FLEET_IO_CONCURRENCY,
+              summary_path=None, metrics_path=METRICS_LOG, prometheus_path=None, warmup=False):
+    """Upgrade every site in an inventory without the GUI and print a timing summary.
+
+    Stage metrics are appended to metrics_path as JSON lines and, with
+    prometheus_path, also written in Prometheus text format. warmup turns on
+    the post-upgrade warm-up for every site, whatever the inventory says.
+    Returns 0 when every site upgraded and 1 otherwise.
+    """
+    sites = load_inventory(inventory_path)
+    if warmup:
+        for site in sites:
+            site["warmup"] = True
+    downloads = SharedDownloads()
+    all_metrics = []
+    io_locks = {}
+    io_locks_lock = threading.Lock()
+
+    def io_lock(site):
+        """Return the semaphore of the site's io_group, or of the disk holding its data directory."""
+        group = site.get("io_group") or os.stat(site["data_path"]).st_dev
+        with io_locks_lock:
+            return io_locks.setdefault(group, threading.Semaphore(io_concurrency))
+
+    def run(site):
+        def log(message):
+            print(f"[{site['name']}] {message}", flush=True)
+
+        started = time.monotonic()
+        timings = {}
+        metrics = StageMetrics(site["name"], release=site["url"], path=metrics_path)
+        all_metrics.append(metrics)
+        try:
+            # A missing data_path fails this site only
+            upgrade_site(site, downloads, io_lock(site), timings=timings, metrics=metrics, log=log)
+            status, error = "ok", None
+            log("Moodle upgrade completed successfully.")
+        except Exception as e:
+            status, error = "failed", str(e)
+            log(f"Error: {e}")
+        warmed = next((r for r in metrics.records if r["stage"] == "warmup" and r["status"] == "ok"), None)
+        latency = {key: value for key, value in (warmed or {}).items() if key.startswith(("before_", "after_"))}
+        failed_stages = [r["stage"] for r in metrics.records if r["status"] == "failed"]
+        return {"site": site["name"], "status": status, "error": error, "timings": timings,
+                "failed_stages": failed_stages, "total": time.monotonic() - started, "warmup_latency": latency or None}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(run, sites))
+
+    stages = ("backup", "dump", "download", "replace", "upgrade", "warmup")
+    name_width = max([len("site")] + [len(r["site"]) for r in results])
+    print(f"{'site':<{name_width}}  {'status':<7}" + "".join(f"{s:>10}" for s in stages) + f"{'total':>10}")
+    for r in results:
+        cells = "".join(
+            f"{r['timings'][s]:.1f}{'!' if s in r['failed_stages'] else ''}".rjust(10) if s in r["timings"]
+            else f"{'-':>10}" for s in stages
+        )
+        print(f"{r['site']:<{name_width}}  {r['status']:<7}{cells}{r['total']:>10.1f}")
+    if any(r["failed_stages"] for r in results):
+        print("! marks a stage that failed.")
+    if summary_path:
+        with open(summary_path, "w") as f:
+            json.dump(results, f, indent=2)
+    if prometheus_path:
+        write_prometheus([r for m in all_metrics for r in m.records], prometheus_path)
+    return 0 if all(r["status"] == "ok" for r in results) else 1
@@ -0,0 +1,68 @@
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QVariant
+from PyQt5.QtWidgets import QListView
+from search_core import BATCH_SIZE
+
+class ResultListModel(QAbstractListModel):
+    """
+    Flat list of strings appended in batches. Rows may carry a key (returned
+    for Qt.UserRole) so that later batches can update them in place.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.keys = []
+        self.positions = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid() and role in (Qt.DisplayRole, Qt.ToolTipRole):
+            return self.rows[index.row()]
+        if index.isValid() and role == Qt.UserRole:
+            return self.keys[index.row()]
+        return QVariant()
+
+    def append(self, items):
+        if items:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(items) - 1)
+            self.rows.extend(items)
+            self.keys.extend(items)
+            self.endInsertRows()
+
+    def upsert(self, pairs):
+        """Update the rows of known keys and append the rest, given (key, text) pairs."""
+        new = {}
+        for key, text in pairs:
+            position = self.positions.get(key)
+            if position is None:
+                new[key] = text
+            elif self.rows[position] != text:
+                self.rows[position] = text
+                self.dataChanged.emit(self.index(position), self.index(position))
+        if new:
+            start = len(self.rows)
+            self.beginInsertRows(QModelIndex(), start, start + len(new) - 1)
+            for offset, (key, text) in enumerate(new.items()):
+                self.positions[key] = start + offset
+                self.keys.append(key)
+                self.rows.append(text)
+            self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.keys = []
+        self.positions = {}
+        self.endResetModel()
+
+# Function to create a list view that stays responsive with very many rows
+def make_result_view(model, parent=None):
+    view = QListView(parent)
+    view.setModel(model)
+    view.setUniformItemSizes(True)  # Row heights are not measured one by one
+    view.setLayoutMode(QListView.Batched)
+    view.setBatchSize(BATCH_SIZE)
+    view.setEditTriggers(QListView.NoEditTriggers)
+    return view
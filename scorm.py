@@ -1,11 +1,512 @@
-import requests
+import os
+import sys
+import csv
+import mmap
+import time
+import uuid
+import sqlite3
+import zipfile
+import hashlib
+import xml.etree.ElementTree as ET
+import random
+import argparse
+import threading
+from collections import OrderedDict
+import re
 import json
+import posixpath
+from urllib.parse import urlparse, urljoin, unquote
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # Moodle configurations
 MOODLE_URL = "https://your-moodle-site.com"
 TOKEN = "your-webservice-token"
 ENDPOINT = f"{MOODLE_URL}/webservice/rest/server.php"
 
+# Number of courses sent in one core_course_create_courses call
+COURSE_BATCH_SIZE = 50
+
+# Upload pipeline: packages in flight, web-service calls allowed at once per Moodle server,
+# attempts per call with exponential backoff from RETRY_BACKOFF seconds, and the progress journal
+UPLOAD_WORKERS = 8
+SERVER_CONCURRENCY = 4
+RETRY_ATTEMPTS = 4
+RETRY_BACKOFF = 2.0
+JOURNAL_PATH = "scorm_upload_journal.jsonl"
+
+# Uploaded packages by content hash, so a package attached to many courses is uploaded once;
+# draft files are cleaned up by Moodle's cron, so entries older than the TTL are ignored
+UPLOAD_CACHE_PATH = "scorm_upload_cache.json"
+UPLOAD_CACHE_TTL = 24 * 60 * 60
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# SQLite index of validated packages, reused while a package's size and mtime are unchanged
+SCORM_INDEX_PATH = "scorm_index.db"
+
+# Web-service client limits: sustained calls per second and burst size of the token bucket,
+# per-request timeout in seconds, and upper bounds of the per-wsfunction latency histogram buckets
+WS_RATE_LIMIT = 20.0
+WS_BURST = 40
+WS_TIMEOUT = 120
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+# Read-through cache for read-only web-service functions: entries kept in memory (LRU),
+# the on-disk store and how long its entries stay fresh in seconds
+WS_CACHE_PATH = "scorm_ws_cache.db"
+WS_CACHE_SIZE = 4096
+WS_CACHE_TTL = 60 * 60
+WS_CACHED_FUNCTIONS = {
+    'core_course_get_courses_by_field',
+    'core_course_get_categories',
+    'core_course_get_contents',
+}
+# Cached functions whose answers change when the tool calls a write function;
+# other functions whose names match WS_WRITE_FUNCTION invalidate the whole cache,
+# and the rest (get_site_info and other reads) invalidate nothing
+WS_CACHE_INVALIDATES = {
+    'core_files_upload': (),
+    'core_course_create_courses': ('core_course_get_courses_by_field', 'core_course_get_categories'),
+    'core_course_update_courses': ('core_course_get_courses_by_field', 'core_course_get_categories'),
+    'core_course_delete_courses': ('core_course_get_courses_by_field', 'core_course_get_categories',
+                                   'core_course_get_contents'),
+    'core_course_create_categories': ('core_course_get_categories',),
+    'mod_scorm_add_scorm': ('core_course_get_contents',),
+}
+WS_WRITE_FUNCTION = re.compile(
+    r'_(create|update|delete|add|set|remove|save|import|duplicate|move|enrol|unenrol|assign|unassign|'
+    r'upload|edit|submit|toggle|reset|restore|process)(_|$)'
+)
+
+# Moodle error codes that fail every call of the token rather than one course:
+# authentication, permissions and the site being unavailable
+WS_FATAL_ERRORS = {
+    'invalidtoken', 'accessexception', 'requireloginerror', 'nopermissions', 'usernotfullysetup',
+    'servicenotavailable', 'sitemaintenance', 'enablewsdescription',
+}
+
+# Error returned by Moodle itself (an exception payload); retrying will not help
+class MoodleWSError(Exception):
+    def __init__(self, wsfunction, data):
+        self.wsfunction = wsfunction
+        self.errorcode = data.get('errorcode')
+        super().__init__(f"{wsfunction}: {data.get('message', data)}")
+
+# Function to flatten nested parameters into Moodle's form encoding
+def flatten_params(value, prefix=''):
+    """
+    Flatten nested dicts and lists into the key[0][sub] pairs Moodle's REST server expects.
+    :param value: Dict, list or scalar to flatten.
+    :param prefix: Key of value itself; empty for the top-level dict.
+    :return: List of (key, value) pairs.
+    """
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, (list, tuple)):
+        items = enumerate(value)
+    elif value is None:
+        return []
+    else:
+        return [(prefix, int(value) if isinstance(value, bool) else value)]
+    pairs = []
+    for key, item in items:
+        pairs.extend(flatten_params(item, f"{prefix}[{key}]" if prefix else str(key)))
+    return pairs
+
+# Token bucket shared by every call a client makes
+class TokenBucket:
+    def __init__(self, rate=WS_RATE_LIMIT, burst=WS_BURST):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take one token and return how many seconds the caller must wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+# Function to decide which cached functions a call makes stale
+def cache_invalidates(wsfunction):
+    """
+    Return the cached functions whose answers wsfunction may change: the
+    WS_CACHE_INVALIDATES entry, None (everything) for other write functions,
+    or () for read-only functions.
+    """
+    if wsfunction in WS_CACHE_INVALIDATES:
+        return WS_CACHE_INVALIDATES[wsfunction]
+    if wsfunction in WS_CACHED_FUNCTIONS or not WS_WRITE_FUNCTION.search(wsfunction):
+        return ()
+    return None
+
+# Read-through cache of web-service responses
+class WSCache:
+    """
+    Two-level cache of read-only web-service responses, keyed by endpoint,
+    token, function and arguments: an in-memory LRU in front of an SQLite store whose
+    entries expire after ttl seconds. The store is opened on first use.
+    """
+
+    def __init__(self, path=WS_CACHE_PATH, size=WS_CACHE_SIZE, ttl=WS_CACHE_TTL):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _db(self):
+        if self.conn is None and self.path:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                wsfunction TEXT,
+                stored REAL,
+                response TEXT
+            )
+            """)
+            self.conn.commit()
+        return self.conn
+
+    @staticmethod
+    def key(endpoint, wsfunction, params, token=''):
+        # Different tokens may see different courses, so they never share answers; only the hash is stored
+        return hashlib.sha256(json.dumps([endpoint, token, wsfunction, flatten_params(params or {})],
+                                         default=str).encode()).hexdigest()
+
+    def get(self, endpoint, wsfunction, params, token=''):
+        """Return the cached response, or None when it is missing or stale."""
+        key = self.key(endpoint, wsfunction, params, token)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None and self._db():
+                row = self.conn.execute("SELECT wsfunction, stored, response FROM responses WHERE key = ?",
+                                        (key,)).fetchone()
+                if row:
+                    entry = (row[0], row[1], json.loads(row[2]))
+            if entry is None or now - entry[1] > self.ttl:
+                return None
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            self._trim()
+            return entry[2]
+
+    def put(self, endpoint, wsfunction, params, response, token=''):
+        key = self.key(endpoint, wsfunction, params, token)
+        entry = (wsfunction, time.time(), response)
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            self._trim()
+            if self._db():
+                self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                                  (key, wsfunction, entry[1], json.dumps(response)))
+                self.conn.commit()
+
+    def put_many(self, endpoint, wsfunction, entries, token=''):
+        """Store several (params, response) pairs in one transaction, e.g. after a bulk prefetch."""
+        stored = time.time()
+        rows = []
+        with self.lock:
+            for params, response in entries:
+                key = self.key(endpoint, wsfunction, params, token)
+                self.memory[key] = (wsfunction, stored, response)
+                self.memory.move_to_end(key)
+                rows.append((key, wsfunction, stored, json.dumps(response)))
+            self._trim()
+            if self._db():
+                self.conn.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", rows)
+                self.conn.commit()
+
+    def invalidate(self, wsfunctions=None):
+        """Drop cached responses of the given functions, or of every function when None."""
+        with self.lock:
+            for key in [key for key, entry in self.memory.items() if wsfunctions is None or entry[0] in wsfunctions]:
+                del self.memory[key]
+            if self._db():
+                if wsfunctions is None:
+                    self.conn.execute("DELETE FROM responses")
+                elif wsfunctions:
+                    self.conn.execute(f"DELETE FROM responses WHERE wsfunction IN ({', '.join('?' * len(wsfunctions))})",
+                                      tuple(wsfunctions))
+                self.conn.commit()
+
+    def _trim(self):
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+# Behaviour shared by the blocking and asyncio web-service clients
+class _WSClientBase:
+    def __init__(self, endpoint, token, rate, burst, attempts, backoff, timeout):
+        self.endpoint = endpoint
+        self.token = token
+        self.bucket = TokenBucket(rate, burst)
+        self.attempts = attempts
+        self.backoff = backoff
+        self.timeout = timeout
+        self.latencies = {}
+        self.latencies_lock = threading.Lock()
+
+    def payload(self, wsfunction, params):
+        return [('wstoken', self.token), ('moodlewsrestformat', 'json'), ('wsfunction', wsfunction)] \
+            + flatten_params(params or {})
+
+    def upload_url(self):
+        return f"{self.endpoint}?wstoken={self.token}&moodlewsrestformat=json&wsfunction=core_files_upload"
+
+    def record(self, wsfunction, seconds):
+        with self.latencies_lock:
+            histogram = self.latencies.setdefault(
+                wsfunction, {'count': 0, 'sum': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS)}
+            )
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['buckets'][next(i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound)] += 1
+
+    def parse(self, wsfunction, status, text):
+        """Return the decoded response, or raise MoodleWSError for an exception payload."""
+        try:
+            data = json.loads(text) if text else None
+        except ValueError:
+            raise Exception(f"{wsfunction}: unexpected HTTP {status} response: {text[:200]}")
+        if isinstance(data, dict) and 'exception' in data:
+            raise MoodleWSError(wsfunction, data)
+        if isinstance(data, dict) and 'error' in data and wsfunction == 'core_files_upload':
+            raise MoodleWSError(wsfunction, {'message': data['error'], 'errorcode': data.get('errorcode')})
+        return data
+
+    def retry_delay(self, wsfunction, attempt, error):
+        """Return the jittered backoff before the next attempt, or re-raise after the last one."""
+        if attempt == self.attempts:
+            raise error
+        delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+        print(f"Attempt {attempt} of {wsfunction} failed ({error}); retrying in {delay:.1f}s.")
+        return delay
+
+    def latency_report(self):
+        """
+        Summarise the latency histograms.
+        :return: Dict mapping each wsfunction to its call count, mean and the
+                 bucket bounds containing the 50th and 95th percentiles, in seconds.
+        """
+        report = {}
+        with self.latencies_lock:
+            for wsfunction, histogram in self.latencies.items():
+                def percentile(fraction):
+                    seen = 0
+                    for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                        seen += count
+                        if seen >= fraction * histogram['count']:
+                            return bound
+                report[wsfunction] = {
+                    'count': histogram['count'],
+                    'mean': histogram['sum'] / histogram['count'],
+                    'p50': percentile(0.5),
+                    'p95': percentile(0.95),
+                    'buckets': dict(zip(map(str, LATENCY_BUCKETS), histogram['buckets'])),
+                }
+        return report
+
+    def print_latency_report(self):
+        for wsfunction, stats in sorted(self.latency_report().items()):
+            print(f"{wsfunction}: {stats['count']} call(s), mean {stats['mean'] * 1000:.0f} ms, "
+                  f"p50 <= {stats['p50']}s, p95 <= {stats['p95']}s")
+
+# Moodle web-service client
+class MoodleWSClient(_WSClientBase):
+    """
+    Blocking client for Moodle's REST web services.
+    Calls share a pooled keep-alive session, a token-bucket rate limit and the
+    per-server concurrency limit. Timeouts, connection errors and 5xx responses
+    are retried with jittered exponential backoff; errors reported by Moodle
+    itself are raised as MoodleWSError straight away. With a WSCache, calls to
+    WS_CACHED_FUNCTIONS are answered from it, and write calls invalidate the
+    entries listed in WS_CACHE_INVALIDATES (see cache_invalidates).
+    """
+
+    def __init__(self, endpoint=ENDPOINT, token=TOKEN, rate=WS_RATE_LIMIT, burst=WS_BURST,
+                 attempts=RETRY_ATTEMPTS, backoff=RETRY_BACKOFF, timeout=WS_TIMEOUT, pool_size=16, cache=None):
+        # requests is imported here so that "--help" and the validation-only paths start quickly
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        super().__init__(endpoint, token, rate, burst, attempts, backoff, timeout)
+        self.cache = cache
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+        self.session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+
+    def request(self, wsfunction, send):
+        import requests
+
+        for attempt in range(1, self.attempts + 1):
+            self.bucket.acquire()
+            start = time.perf_counter()
+            try:
+                with server_limit(self.endpoint):
+                    response = send()
+                if response.status_code >= 500:
+                    raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+            except (requests.Timeout, requests.ConnectionError, requests.HTTPError) as e:
+                self.record(wsfunction, time.perf_counter() - start)
+                time.sleep(self.retry_delay(wsfunction, attempt, e))
+                continue
+            self.record(wsfunction, time.perf_counter() - start)
+            return self.parse(wsfunction, response.status_code, response.text)
+
+    def call(self, wsfunction, params=None, refresh=False):
+        """
+        Call a web-service function.
+        :param wsfunction: Name of the function, e.g. core_course_create_courses.
+        :param params: Nested dict of arguments; flattened with flatten_params.
+        :param refresh: Bypass the cache for a read-only function and store the fresh answer.
+        :return: Decoded JSON response.
+        """
+        cached = self.cache is not None and wsfunction in WS_CACHED_FUNCTIONS
+        if cached and not refresh:
+            response = self.cache.get(self.endpoint, wsfunction, params, self.token)
+            if response is not None:
+                return response
+        data = self.payload(wsfunction, params)
+        try:
+            response = self.request(wsfunction,
+                                    lambda: self.session.post(self.endpoint, data=data, timeout=self.timeout))
+        finally:
+            # A failed write may still have changed something on the server
+            invalidates = cache_invalidates(wsfunction)
+            if self.cache is not None and not cached and invalidates != ():
+                self.cache.invalidate(invalidates)
+        if cached:
+            self.cache.put(self.endpoint, wsfunction, params, response, self.token)
+        return response
+
+    def upload(self, file_path, use_mmap=False):
+        """
+        Upload a file to the user's draft area with core_files_upload, streaming the body.
+        :return: Decoded JSON response.
+        """
+        def send():
+            with MultipartFile(file_path, use_mmap=use_mmap) as body:
+                return self.session.post(self.upload_url(), data=body, headers={'Content-Type': body.content_type},
+                                         timeout=self.timeout)
+        return self.request('core_files_upload', send)
+
+    def close(self):
+        self.session.close()
+
+# asyncio variant of the web-service client
+class AsyncMoodleWSClient(_WSClientBase):
+    """
+    asyncio counterpart of MoodleWSClient built on httpx, for callers that
+    drive many web-service calls from one event loop. Requires httpx.
+    """
+
+    def __init__(self, endpoint=ENDPOINT, token=TOKEN, rate=WS_RATE_LIMIT, burst=WS_BURST,
+                 attempts=RETRY_ATTEMPTS, backoff=RETRY_BACKOFF, timeout=WS_TIMEOUT, pool_size=16):
+        import asyncio
+        try:
+            import httpx
+        except ImportError:  # The async client is optional
+            raise Exception("httpx is required for AsyncMoodleWSClient.")
+        super().__init__(endpoint, token, rate, burst, attempts, backoff, timeout)
+        self.client = httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=pool_size))
+        self.limit = asyncio.Semaphore(SERVER_CONCURRENCY)
+
+    async def request(self, wsfunction, send):
+        import asyncio
+        import httpx
+
+        for attempt in range(1, self.attempts + 1):
+            delay = self.bucket.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            start = time.perf_counter()
+            try:
+                async with self.limit:
+                    response = await send()
+                if response.status_code >= 500:
+                    raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request,
+                                                response=response)
+            except (httpx.TimeoutException, httpx.TransportError, httpx.HTTPStatusError) as e:
+                self.record(wsfunction, time.perf_counter() - start)
+                await asyncio.sleep(self.retry_delay(wsfunction, attempt, e))
+                continue
+            self.record(wsfunction, time.perf_counter() - start)
+            return self.parse(wsfunction, response.status_code, response.text)
+
+    async def call(self, wsfunction, params=None):
+        # httpx only form-encodes dicts (a list would be sent as raw content); the flattened keys are unique
+        data = dict(self.payload(wsfunction, params))
+        return await self.request(wsfunction, lambda: self.client.post(self.endpoint, data=data))
+
+    async def upload(self, file_path, use_mmap=False):
+        async def send():
+            with MultipartFile(file_path, use_mmap=use_mmap) as body:
+                async def chunks():
+                    for chunk in body:
+                        yield chunk
+                return await self.client.post(self.upload_url(), content=chunks(), headers={
+                    'Content-Type': body.content_type, 'Content-Length': str(len(body))})
+        return await self.request('core_files_upload', send)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+# Client used by the provisioning functions below, created on first use
+client = None
+
+def get_client():
+    global client
+    if client is None:
+        client = MoodleWSClient(cache=WSCache())
+    return client
+
+# Function to load existing courses into the cache in bulk
+def prefetch_courses(category_ids=None):
+    """
+    Fetch existing courses with one call per category (or one call for the
+    whole site) and cache each of them under its idnumber and shortname, so
+    later per-course lookups are answered locally.
+    :param category_ids: Categories to fetch, or None for every course on the site.
+    :return: Dict mapping idnumber to course for the courses fetched.
+    """
+    client = get_client()
+    if category_ids is None:
+        responses = [client.call('core_course_get_courses_by_field')]
+    else:
+        responses = [client.call('core_course_get_courses_by_field', {'field': 'category', 'value': category_id})
+                     for category_id in sorted(set(category_ids))]
+    courses = [course for response in responses for course in response.get('courses', [])]
+    if client.cache is not None:
+        client.cache.put_many(client.endpoint, 'core_course_get_courses_by_field', [
+            ({'field': field, 'value': course[field]}, {'courses': [course], 'warnings': []})
+            for course in courses for field in ('idnumber', 'shortname') if course.get(field)
+        ], client.token)
+    return {course['idnumber']: course for course in courses if course.get('idnumber')}
+
+# Function to find an existing course by idnumber
+def find_course(idnumber):
+    """
+    Return the course with the given idnumber, or None, through the cache.
+    """
+    courses = get_client().call('core_course_get_courses_by_field', {'field': 'idnumber', 'value': idnumber})
+    return courses['courses'][0] if courses.get('courses') else None
+
+# Function to list the IDs of existing categories
+def category_ids():
+    return {category['id'] for category in get_client().call('core_course_get_categories')}
+
 # Function to create a course
 def create_course(category_id, course_name, course_idnumber, scorm_format="singleactivity"):
     """
@@ -16,27 +517,282 @@ def create_course(category_id, course_name, course_idnumber, scorm_format="singl
     :param scorm_format: Format of the course (default: "singleactivity").
     :return: Course ID of the created course.
     """
-    payload = {
-        'wstoken': TOKEN,
-        'moodlewsrestformat': 'json',
-        'wsfunction': 'core_course_create_courses',
-        'courses[0][fullname]': course_name,
-        'courses[0][shortname]': course_name,
-        'courses[0][categoryid]': category_id,
-        'courses[0][idnumber]': course_idnumber,
-        'courses[0][format]': scorm_format
+    course = {
+        'fullname': course_name,
+        'shortname': course_name,
+        'categoryid': category_id,
+        'idnumber': course_idnumber,
+        'format': scorm_format
     }
-
-    response = requests.post(ENDPOINT, data=payload)
-    response_data = response.json()
-    
-    if response.status_code == 200 and isinstance(response_data, list):
-        course_id = response_data[0]['id']
-        print(f"Course '{course_name}' created successfully with ID {course_id}.")
-        return course_id
-    else:
-        print(f"Error creating course: {response_data}")
+    course_ids, errors = create_courses([course])
+    if errors:
+        print(f"Error creating course: {errors[0]}")
         raise Exception("Course creation failed.")
+    return course_ids[0]
+
+# Function to create many courses with batched web-service calls
+def create_courses(courses, batch_size=COURSE_BATCH_SIZE, skip_existing=False):
+    """
+    Create many Moodle courses, packing up to batch_size courses into each call.
+    core_course_create_courses rejects a whole batch when one course is invalid,
+    so a failed batch is split in half and retried until the failing courses
+    are isolated; only those are reported as errors. When a batch fails for a
+    reason no course can fix (an error in WS_FATAL_ERRORS such as an invalid
+    token, or the server still unreachable after the client's retries), it and
+    every later course are reported as errors without further calls.
+    :param courses: List of dicts with fullname, shortname, categoryid, idnumber and optional format.
+    :param batch_size: Maximum number of courses per web-service call.
+    :param skip_existing: Look up existing courses and categories first (two bulk calls, through
+                          the cache); courses whose idnumber exists are not created again and
+                          courses in unknown categories fail without a call.
+    :return: Tuple of (course_ids, errors): course_ids[i] is the ID created for courses[i]
+             or None, and errors maps the index of each failed course to Moodle's message.
+    """
+    course_ids = [None] * len(courses)
+    errors = {}
+    pending = list(range(len(courses)))
+
+    if skip_existing:
+        # idnumbers are unique site-wide, so one whole-site fetch answers every lookup
+        valid_categories = category_ids()
+        existing = prefetch_courses()
+        pending = []
+        for index, course in enumerate(courses):
+            found = existing.get(course.get('idnumber'))
+            if found:
+                course_ids[index] = found['id']
+                print(f"Course '{course['fullname']}' already exists with ID {found['id']}.")
+            elif int(course['categoryid']) not in valid_categories:
+                errors[index] = f"Category {course['categoryid']} does not exist."
+                print(f"Error creating course '{course['fullname']}': {errors[index]}")
+            else:
+                pending.append(index)
+
+    def send(indexes):
+        # Only per-course errors reported by Moodle are split; transport errors were already retried
+        # by the client, and authentication or permission errors would fail every half as well
+        try:
+            response_data = get_client().call('core_course_create_courses', {'courses': [courses[i] for i in indexes]})
+        except MoodleWSError as e:
+            if e.errorcode in WS_FATAL_ERRORS:
+                raise
+            response_data = e
+
+        if isinstance(response_data, list):
+            created = {course['shortname']: course['id'] for course in response_data}
+            for index in indexes:
+                course_ids[index] = created.get(courses[index]['shortname'])
+                print(f"Course '{courses[index]['fullname']}' created successfully with ID {course_ids[index]}.")
+            return
+        if len(indexes) == 1:
+            errors[indexes[0]] = str(response_data)
+            print(f"Error creating course '{courses[indexes[0]]['fullname']}': {errors[indexes[0]]}")
+            return
+        middle = len(indexes) // 2
+        send(indexes[:middle])
+        send(indexes[middle:])
+
+    for start in range(0, len(pending), batch_size):
+        try:
+            send(pending[start:start + batch_size])
+        except Exception as e:
+            # The server is unreachable or refuses the token: report the rest instead of retrying every course
+            print(f"Error creating courses: {e}")
+            for index in pending[start:]:
+                if course_ids[index] is None and index not in errors:
+                    errors[index] = str(e)
+            break
+    return course_ids, errors
+
+# Function to read courses to create from a CSV file
+def load_courses_csv(csv_path, scorm_format="singleactivity"):
+    """
+    Read course rows from a CSV file with a header row.
+    Required columns are fullname, categoryid and idnumber; shortname defaults
+    to fullname and format to scorm_format. Any other column is passed to
+    core_course_create_courses as-is.
+    :param csv_path: Path to the CSV file.
+    :return: List of course dicts suitable for create_courses.
+    """
+    courses = []
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            course = {key: value for key, value in row.items() if value not in (None, '')}
+            course.setdefault('shortname', course['fullname'])
+            course.setdefault('format', scorm_format)
+            courses.append(course)
+    return courses
+
+# Streaming multipart/form-data body for a single file
+class MultipartFile:
+    """
+    File-like multipart/form-data body that requests can stream.
+    The file is read in chunks (or sliced from an mmap) while the request is
+    sent, so memory use stays flat however large the package is.
+    """
+
+    def __init__(self, file_path, field='file', use_mmap=False, chunk_size=UPLOAD_CHUNK_SIZE):
+        boundary = uuid.uuid4().hex
+        filename = os.path.basename(file_path)
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self.head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        self.tail = f'\r\n--{boundary}--\r\n'.encode()
+        self.file = open(file_path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if use_mmap and self.size else None
+        self.chunk_size = chunk_size
+        self.position = 0
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self)
+        size = min(size, self.chunk_size)
+        position = self.position
+        if position < len(self.head):
+            data = self.head[position:position + size]
+        elif position < len(self.head) + self.size:
+            offset = position - len(self.head)
+            if self.map is not None:
+                data = self.map[offset:offset + size]
+            else:
+                data = self.file.read(min(size, self.size - offset))
+        else:
+            offset = position - len(self.head) - self.size
+            data = self.tail[offset:offset + size]
+        self.position += len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.chunk_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Function to hash a file without loading it into memory
+def file_sha256(file_path, use_mmap=False):
+    """
+    Return the hex SHA-256 of a file.
+    :param file_path: Path to the file.
+    :param use_mmap: Hash through an mmap of the file instead of buffered reads.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        if use_mmap and os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+        else:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+_upload_cache = None
+_upload_cache_lock = threading.Lock()
+_uploads_in_flight = {}
+
+# Function to upload a file to the user's draft area
+def upload_file(file_path, use_mmap=False, cache_path=UPLOAD_CACHE_PATH):
+    """
+    Upload a file through core_files_upload, streaming the multipart body.
+    Files whose SHA-256 was uploaded to the same endpoint with the same token
+    within UPLOAD_CACHE_TTL reuse the earlier draft item ID instead of being
+    sent again; concurrent calls for the same content wait for a single upload.
+    :param file_path: Path to the file to upload.
+    :param use_mmap: Read the file through mmap while hashing and uploading.
+    :param cache_path: JSON file mapping content hashes to draft item IDs, or None to disable reuse.
+    :return: Draft item ID of the uploaded file.
+    """
+    global _upload_cache
+    key = None
+    if cache_path:
+        # Draft items belong to the token's user, so another user or server never reuses them;
+        # only a hash of the token is written to the cache file
+        client = get_client()
+        token_hash = hashlib.sha256(client.token.encode()).hexdigest()[:16]
+        key = f"{client.endpoint}:{token_hash}:{file_sha256(file_path, use_mmap)}"
+    owner = True
+    if key:
+        with _upload_cache_lock:
+            if _upload_cache is None:
+                try:
+                    with open(cache_path, encoding='utf-8') as f:
+                        _upload_cache = json.load(f)
+                except FileNotFoundError:
+                    _upload_cache = {}
+            cached = _upload_cache.get(key)
+            if cached and time.time() - cached['time'] < UPLOAD_CACHE_TTL:
+                print(f"SCORM package {os.path.basename(file_path)} already uploaded with item ID {cached['itemid']}.")
+                return cached['itemid']
+            future = _uploads_in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = _uploads_in_flight[key] = Future()
+        if not owner:
+            return future.result()
+
+    try:
+        upload_data = get_client().upload(file_path, use_mmap)
+        # core_files_upload answers with a list of uploaded files on recent Moodle versions
+        if isinstance(upload_data, list) and upload_data:
+            upload_data = upload_data[0]
+
+        if isinstance(upload_data, dict) and 'itemid' in upload_data:
+            itemid = upload_data['itemid']
+            print(f"SCORM package uploaded successfully with item ID {itemid}.")
+        else:
+            print(f"Error uploading SCORM package: {upload_data}")
+            raise Exception("SCORM package upload failed.")
+    except Exception as e:
+        if key:
+            with _upload_cache_lock:
+                _uploads_in_flight.pop(key).set_exception(e)
+        raise
+
+    if key:
+        with _upload_cache_lock:
+            _upload_cache[key] = {'itemid': itemid, 'time': time.time()}
+            with open(f"{cache_path}.tmp", 'w', encoding='utf-8') as f:
+                json.dump(_upload_cache, f)
+            os.replace(f"{cache_path}.tmp", cache_path)
+            _uploads_in_flight.pop(key).set_result(itemid)
+    return itemid
+
+# Function to add an uploaded SCORM package to a course
+def add_scorm(course_id, itemid, name='SCORM Package'):
+    """
+    Create a SCORM activity in a course from an uploaded draft file.
+    :param course_id: ID of the course to add the SCORM activity to.
+    :param itemid: Draft item ID returned by upload_file.
+    :param name: Name of the SCORM activity.
+    :return: ID of the created SCORM activity.
+    """
+    scorm_data = get_client().call('mod_scorm_add_scorm', {
+        'courseid': course_id,
+        'name': name,
+        'intro': 'Uploaded SCORM package',
+        'files': [{'itemid': itemid}]
+    })
+
+    if isinstance(scorm_data, dict) and 'id' in scorm_data:
+        print(f"SCORM package added successfully to course ID {course_id}.")
+        return scorm_data['id']
+    print(f"Error adding SCORM package: {scorm_data}")
+    raise Exception("Adding SCORM package to course failed.")
 
 # Function to upload a SCORM package to a course
 def upload_scorm_package(course_id, scorm_file_path):
@@ -45,40 +801,295 @@ def upload_scorm_package(course_id, scorm_file_path):
     :param course_id: ID of the course to upload the SCORM package to.
     :param scorm_file_path: Path to the SCORM package file.
     """
-    # Upload the SCORM file
-    upload_url = f"{ENDPOINT}?wstoken={TOKEN}&moodlewsrestformat=json&wsfunction=core_files_upload"
-    files = {'file': open(scorm_file_path, 'rb')}
-    upload_response = requests.post(upload_url, files=files)
-    upload_data = upload_response.json()
+    itemid = upload_file(scorm_file_path)
+    add_scorm(course_id, itemid)
 
-    if upload_response.status_code == 200 and 'itemid' in upload_data:
-        itemid = upload_data['itemid']
-        print(f"SCORM package uploaded successfully with item ID {itemid}.")
-    else:
-        print(f"Error uploading SCORM package: {upload_data}")
-        raise Exception("SCORM package upload failed.")
-
-    # Add the SCORM package to the course
-    scorm_payload = {
-        'wstoken': TOKEN,
-        'moodlewsrestformat': 'json',
-        'wsfunction': 'mod_scorm_add_scorm',
-        'courseid': course_id,
-        'name': 'SCORM Package',
-        'intro': 'Uploaded SCORM package',
-        'files[0][itemid]': itemid
-    }
-    scorm_response = requests.post(ENDPOINT, data=scorm_payload)
-    scorm_data = scorm_response.json()
+_server_limits = {}
+_server_limits_lock = threading.Lock()
 
-    if scorm_response.status_code == 200 and 'id' in scorm_data:
-        print(f"SCORM package added successfully to course ID {course_id}.")
-    else:
-        print(f"Error adding SCORM package: {scorm_data}")
-        raise Exception("Adding SCORM package to course failed.")
+# Function to get the semaphore that caps concurrent calls to one Moodle server
+def server_limit(url):
+    """
+    Return the semaphore shared by all calls to the server hosting url.
+    :param url: Any URL on the Moodle server.
+    """
+    host = urlparse(url).netloc
+    with _server_limits_lock:
+        if host not in _server_limits:
+            _server_limits[host] = threading.BoundedSemaphore(SERVER_CONCURRENCY)
+        return _server_limits[host]
+
+# Attribute holding xml:base in ElementTree
+XML_BASE = '{http://www.w3.org/XML/1998/namespace}base'
+
+# Function to inspect a SCORM package without uploading it
+def inspect_package(package_path):
+    """
+    Validate a SCORM package locally and extract its manifest details.
+    Only the zip central directory and imsmanifest.xml are read; the manifest
+    is parsed incrementally, so large manifests are never held in memory.
+    :param package_path: Path to the SCORM zip.
+    :return: Dict with fingerprint, identifier, title, version, resources,
+             organizations, errors and valid.
+    """
+    info = {'fingerprint': None, 'identifier': None, 'title': None, 'version': None,
+            'resources': 0, 'organizations': 0, 'errors': []}
+    try:
+        with zipfile.ZipFile(package_path) as archive:
+            entries = archive.infolist()
+            names = {entry.filename for entry in entries}
+            # Cheap content fingerprint taken from the central directory alone
+            digest = hashlib.sha256()
+            for entry in sorted(entries, key=lambda e: e.filename):
+                digest.update(f"{entry.filename}\0{entry.CRC}\0{entry.file_size}\n".encode())
+            info['fingerprint'] = digest.hexdigest()
+
+            if 'imsmanifest.xml' not in names:
+                info['errors'].append("imsmanifest.xml is missing from the package root.")
+            else:
+                missing = []
+                path = []
+                # xml:base in effect for each open element; manifest, resources and resource may all set one
+                bases = ['']
+                with archive.open('imsmanifest.xml') as manifest:
+                    for event, element in ET.iterparse(manifest, events=('start', 'end')):
+                        tag = element.tag.rsplit('}', 1)[-1]
+                        if event == 'start':
+                            path.append(tag)
+                            bases.append(urljoin(bases[-1], element.get(XML_BASE) or ''))
+                            if tag == 'manifest' and len(path) == 1:
+                                info['identifier'] = element.get('identifier')
+                                namespaces = ' '.join(element.attrib.values()) + ' ' + element.tag
+                                if 'adlcp_rootv1p2' in namespaces:
+                                    info['version'] = '1.2'
+                                elif 'adlcp_v1p3' in namespaces:
+                                    info['version'] = '2004'
+                            continue
+                        parent = path[-2] if len(path) > 1 else None
+                        if tag == 'schemaversion' and element.text:
+                            version = element.text.strip()
+                            info['version'] = '1.2' if version == '1.2' else '2004' if version else info['version']
+                        elif tag == 'title' and parent == 'organization' and info['title'] is None:
+                            info['title'] = (element.text or '').strip()
+                        elif tag == 'organization':
+                            info['organizations'] += 1
+                        elif tag == 'resource':
+                            info['resources'] += 1
+                            href = element.get('href')
+                            target = urlparse(urljoin(bases[-1], href or ''))
+                            # Hrefs with a scheme point outside the package
+                            if href and not target.scheme and not target.netloc:
+                                member = posixpath.normpath(unquote(target.path)).lstrip('/')
+                                if member not in names:
+                                    missing.append(href)
+                            element.clear()
+                        path.pop()
+                        bases.pop()
+                if info['organizations'] == 0:
+                    info['errors'].append("Manifest has no organization.")
+                if info['resources'] == 0:
+                    info['errors'].append("Manifest has no resources.")
+                if missing:
+                    info['errors'].append(f"{len(missing)} resource file(s) missing, e.g. {missing[0]}.")
+    except Exception as e:
+        # Includes NotImplementedError for unsupported compression and RuntimeError for encrypted members
+        info['errors'].append(f"{type(e).__name__}: {e}")
+    info['valid'] = not info['errors']
+    return info
+
+# Initialize the package index
+def init_index(index_path=SCORM_INDEX_PATH):
+    conn = sqlite3.connect(index_path)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS packages (
+        path TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime_ns INTEGER,
+        fingerprint TEXT,
+        identifier TEXT,
+        title TEXT,
+        version TEXT,
+        resources INTEGER,
+        organizations INTEGER,
+        errors TEXT,
+        valid INTEGER
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS packages_fingerprint ON packages (fingerprint)")
+    conn.commit()
+    return conn
+
+# Function to validate many packages in parallel, using the index as a cache
+def validate_packages(package_paths, index_path=SCORM_INDEX_PATH, workers=None):
+    """
+    Validate SCORM packages before any network I/O.
+    Packages whose size and mtime match the index are not opened again; the
+    rest are inspected in parallel across processes and written to the index.
+    :param package_paths: Paths of the packages to validate.
+    :param index_path: Path of the SQLite index.
+    :param workers: Number of worker processes (default: one per CPU).
+    :return: Dict mapping each path to its inspect_package result.
+    """
+    conn = init_index(index_path)
+    columns = ('fingerprint', 'identifier', 'title', 'version', 'resources', 'organizations', 'errors', 'valid')
+    results = {}
+    to_inspect = []
+    for path in dict.fromkeys(package_paths):
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            results[path] = {'errors': [str(e)], 'valid': False}
+            continue
+        row = conn.execute(
+            f"SELECT {', '.join(columns)} FROM packages WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, st.st_size, st.st_mtime_ns)
+        ).fetchone()
+        if row:
+            results[path] = dict(zip(columns, row))
+            results[path]['errors'] = json.loads(results[path]['errors'])
+            results[path]['valid'] = bool(results[path]['valid'])
+        else:
+            to_inspect.append((path, st))
+
+    if to_inspect:
+        # Imported here: multiprocessing is only needed once packages have to be opened
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            inspected = pool.map(inspect_package, [path for path, _ in to_inspect], chunksize=16)
+            for (path, st), info in zip(to_inspect, inspected):
+                results[path] = info
+                conn.execute(
+                    f"INSERT OR REPLACE INTO packages (path, size, mtime_ns, {', '.join(columns)}) "
+                    f"VALUES (?, ?, ?, {', '.join('?' * len(columns))})",
+                    (path, st.st_size, st.st_mtime_ns, info['fingerprint'], info['identifier'], info['title'],
+                     info['version'], info['resources'], info['organizations'], json.dumps(info['errors']),
+                     int(info['valid']))
+                )
+        conn.commit()
+    conn.close()
+    return results
+
+# Function to read (course, package) pairs from a CSV manifest
+def load_package_manifest(csv_path):
+    """
+    Read a CSV manifest with course_id and package columns and an optional name column.
+    :param csv_path: Path to the manifest.
+    :return: List of dicts with course_id, package and name.
+    """
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        return [
+            {'course_id': int(row['course_id']), 'package': row['package'],
+             'name': row.get('name') or 'SCORM Package'}
+            for row in csv.DictReader(f)
+        ]
+
+# Function to upload many SCORM packages concurrently
+def upload_scorm_packages(manifest, journal_path=JOURNAL_PATH, workers=UPLOAD_WORKERS, use_mmap=False,
+                          validate=True):
+    """
+    Upload and attach SCORM packages for every (course, package) pair in a manifest.
+    Pairs run on a pool of workers; at most twice that many are queued at a
+    time, and every call goes through the shared client's rate and
+    concurrency limits and retries.
+    Each attached package is appended to a JSON-lines journal, and pairs
+    already in the journal are skipped, so a rerun resumes where the last
+    run stopped.
+    :param manifest: List of dicts with course_id, package and name.
+    :param journal_path: Path of the progress journal.
+    :param workers: Number of packages processed at once.
+    :param use_mmap: Read packages through mmap while hashing and uploading.
+    :param validate: Check every package locally first and report invalid ones without uploading them.
+    :return: Tuple of (attached, errors): the number of pairs attached in this
+             run and a dict mapping failed (course_id, package) pairs to their error.
+    """
+    done = set()
+    try:
+        with open(journal_path, encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                done.add((entry['course_id'], entry['package']))
+    except FileNotFoundError:
+        pass
+
+    pending_pairs = [item for item in manifest if (item['course_id'], item['package']) not in done]
+    print(f"{len(manifest) - len(pending_pairs)} package(s) already attached; {len(pending_pairs)} to go.")
+    journal_lock = threading.Lock()
+    errors = {}
+
+    # Reject malformed packages before any network I/O
+    if validate:
+        checks = validate_packages([item['package'] for item in pending_pairs])
+        for item in [item for item in pending_pairs if not checks[item['package']]['valid']]:
+            errors[(item['course_id'], item['package'])] = "; ".join(checks[item['package']]['errors'])
+            print(f"Skipping invalid package {item['package']}: {errors[(item['course_id'], item['package'])]}")
+        pending_pairs = [item for item in pending_pairs if checks[item['package']]['valid']]
+    attached = 0
+
+    def process(item):
+        itemid = upload_file(item['package'], use_mmap)
+        scorm_id = add_scorm(item['course_id'], itemid, item['name'])
+        with journal_lock, open(journal_path, 'a', encoding='utf-8') as journal:
+            journal.write(json.dumps({'course_id': item['course_id'], 'package': item['package'],
+                                      'scorm_id': scorm_id, 'time': time.time()}) + "\n")
+
+    def collect(finished):
+        nonlocal attached
+        for future in finished:
+            item = futures.pop(future)
+            try:
+                future.result()
+                attached += 1
+            except Exception as e:
+                errors[(item['course_id'], item['package'])] = str(e)
+                print(f"Error attaching {item['package']} to course ID {item['course_id']}: {e}")
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for item in pending_pairs:
+            futures[pool.submit(process, item)] = item
+            if len(futures) >= workers * 2:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                collect(finished)
+        finished, _ = wait(futures)
+        collect(finished)
+    return attached, errors
+
+# Command-line entry point, also used by moodle_tools.py
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Provision Moodle courses and SCORM packages")
+    parser.add_argument("--courses", metavar="CSV", help="create every course listed in a CSV file")
+    parser.add_argument("--packages", metavar="CSV",
+                        help="upload and attach every (course_id, package) pair listed in a CSV manifest")
+    parser.add_argument("--workers", type=int, default=UPLOAD_WORKERS, help="packages processed at once")
+    parser.add_argument("--journal", default=JOURNAL_PATH, help="progress journal used to resume uploads")
+    parser.add_argument("--mmap", action="store_true", help="read packages through mmap")
+    parser.add_argument("--validate", metavar="CSV",
+                        help="only validate the packages listed in a CSV manifest, without uploading")
+    args = parser.parse_args(argv)
+
+    if args.validate:
+        checks = validate_packages([item['package'] for item in load_package_manifest(args.validate)])
+        for path, check in checks.items():
+            status = "OK" if check['valid'] else "INVALID: " + "; ".join(check['errors'])
+            print(f"{path}: SCORM {check.get('version')} '{check.get('title')}' - {status}")
+        return 0 if all(check['valid'] for check in checks.values()) else 1
+
+    if args.courses or args.packages:
+        failed = False
+        if args.courses:
+            course_ids, errors = create_courses(load_courses_csv(args.courses), skip_existing=True)
+            print(f"Created {len(course_ids) - len(errors)} course(s), {len(errors)} failed.")
+            failed = bool(errors)
+        if args.packages and not failed:
+            attached, errors = upload_scorm_packages(
+                load_package_manifest(args.packages), args.journal, args.workers, args.mmap
+            )
+            print(f"Attached {attached} package(s), {len(errors)} failed.")
+            failed = bool(errors)
+        get_client().print_latency_report()
+        return 1 if failed else 0
 
-# Main execution flow
-if __name__ == "__main__":
     try:
         # Specify your details here
         category_id = 1  # Replace with your category ID
@@ -94,3 +1105,9 @@ if __name__ == "__main__":
 
     except Exception as e:
         print(f"Error: {e}")
+        return 1
+    return 0
+
+# Main execution flow
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+from urllib.parse import urlparse
+
+# Local full-text index of harvested result URLs, page titles and the queries that found them
+LOCAL_INDEX_PATH = "search_index.db"
+LOCAL_INDEX_COLUMNS = "url, title, query, host, tld UNINDEXED, country UNINDEXED"
+
+class RateLimiter:
+    """Spaces out query starts so they never exceed a global rate."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self, cancelled):
+        """Block until the caller may start a query; return False if cancelled meanwhile."""
+        with self.lock:
+            start = max(self.next_start, time.monotonic())
+            self.next_start = start + self.interval
+        return not cancelled.wait(max(0.0, start - time.monotonic()))
+
+class SearchBackend:
+    """
+    Interface of a search backend. Filters are structured instead of being
+    spelled into the query: domain is a top-level domain such as "uk" (the
+    site: operator) and country a country code such as "in" (the cr: operator).
+    """
+    name = "base"
+    remote = False  # Remote backends are rate limited and cached by the callers
+
+    def search(self, query, num_results=10, domain=None, country=None):
+        """Return up to num_results result URLs for query."""
+        raise NotImplementedError
+
+class GoogleBackend(SearchBackend):
+    """Live Google search through googlesearch, optionally harvesting results into a local index."""
+    name = "google"
+    remote = True
+
+    def __init__(self, harvest_index=None):
+        self.harvest_index = harvest_index
+
+    def search(self, query, num_results=10, domain=None, country=None):
+        from googlesearch import search
+
+        terms = query
+        if domain:
+            terms += f" site:{domain}"
+        if country:
+            terms += f" cr:{country}"
+        # Advanced results carry the page title, which the local index needs to answer later queries
+        hits = list(search(terms, num_results=num_results, advanced=True))
+        if self.harvest_index is not None:
+            self.harvest_index.add_many([(hit.url, hit.title, country or domain, query) for hit in hits])
+        return [hit.url for hit in hits]
+
+class LocalIndexBackend(SearchBackend):
+    """
+    Offline backend over an SQLite FTS5 index of URLs, titles and the queries
+    that found them, ranked by bm25. Domain and country filters become
+    predicates on indexed columns.
+    """
+    name = "local"
+
+    def __init__(self, path=LOCAL_INDEX_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        try:
+            self.conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS pages USING fts5({LOCAL_INDEX_COLUMNS})")
+        except sqlite3.OperationalError as e:
+            raise Exception(f"SQLite FTS5 is not available: {e}")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(pages)")]
+        if "query" not in columns:
+            # Indexes built before queries were stored are copied into the new layout
+            self.conn.execute(f"CREATE VIRTUAL TABLE pages_new USING fts5({LOCAL_INDEX_COLUMNS})")
+            self.conn.execute("INSERT INTO pages_new (url, title, query, host, tld, country) "
+                              "SELECT url, title, '', host, tld, country FROM pages")
+            self.conn.execute("DROP TABLE pages")
+            self.conn.execute("ALTER TABLE pages_new RENAME TO pages")
+        self.conn.commit()
+
+    def add_many(self, pages):
+        """
+        Add or replace pages in the index.
+        :param pages: Iterable of (url, title, country) or (url, title, country, query) tuples;
+                      title, country and query may be empty. Queries that found a page
+                      earlier are kept, so it still answers them.
+        """
+        pages = [tuple(page) + ("",) * (4 - len(page)) for page in pages]
+        with self.lock:
+            rows = {}
+            for url, title, country, query in pages:
+                host = (urlparse(url).hostname or "").lower()
+                previous = rows.get(url) or self.conn.execute(
+                    "SELECT url, title, query FROM pages WHERE url = ?", (url,)).fetchone()
+                queries = previous[2].split("\n") if previous and previous[2] else []
+                if query and query not in queries:
+                    queries.append(query)
+                rows[url] = (url, title or (previous[1] if previous else ""), "\n".join(queries), host,
+                             host.rsplit(".", 1)[-1], (country or "").lower())
+            self.conn.executemany("DELETE FROM pages WHERE url = ?", [(url,) for url in rows])
+            self.conn.executemany("INSERT INTO pages (url, title, query, host, tld, country) "
+                                  "VALUES (?, ?, ?, ?, ?, ?)", rows.values())
+            self.conn.commit()
+
+    def search(self, query, num_results=10, domain=None, country=None):
+        # Quote every term so user input is never parsed as FTS5 syntax
+        terms = " ".join('"{}"'.format(term.replace('"', '""')) for term in query.split())
+        if not terms:
+            return []
+        sql = "SELECT url FROM pages WHERE pages MATCH ?"
+        args = [terms]
+        if domain:
+            sql += " AND tld = ?"
+            args.append(domain.lower())
+        if country:
+            sql += " AND (country = ? OR tld = ?)"
+            args.extend([country.lower(), country.lower()])
+        sql += " ORDER BY bm25(pages) LIMIT ?"
+        args.append(num_results)
+        with self.lock:
+            return [row[0] for row in self.conn.execute(sql, args)]
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the local search index")
+    parser.add_argument("--index", default=LOCAL_INDEX_PATH, help="path of the index database")
+    parser.add_argument("--import", dest="import_file", metavar="FILE",
+                        help="add pages from a file of 'url<TAB>title<TAB>country[<TAB>query]' lines")
+    parser.add_argument("query", nargs="*", help="terms to search for")
+    parser.add_argument("--domain", help="restrict results to a top-level domain, e.g. uk")
+    parser.add_argument("--country", help="restrict results to a country code, e.g. in")
+    parser.add_argument("-n", type=int, default=10, help="number of results")
+    args = parser.parse_args()
+
+    index = LocalIndexBackend(args.index)
+    if args.import_file:
+        with open(args.import_file, encoding="utf-8") as f:
+            pages = [(line.rstrip("\n").split("\t") + ["", "", ""])[:4] for line in f if line.strip()]
+        index.add_many(pages)
+        print(f"Imported {len(pages)} page(s); the index now holds {index.count()}.")
+    if args.query:
+        for url in index.search(" ".join(args.query), args.n, args.domain, args.country):
+            print(url)
+    sys.exit(0)
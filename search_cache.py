@@ -0,0 +1,113 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Shared on-disk cache of search results: where it lives, how long results stay
+# fresh in seconds, and the entry count / total size (bytes) kept before the
+# least recently used results are evicted
+SEARCH_CACHE_PATH = "search_cache.db"
+SEARCH_CACHE_TTL = 24 * 60 * 60
+SEARCH_CACHE_MAX_ENTRIES = 5000
+SEARCH_CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+# Function to normalize a query so trivially different spellings share an entry
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+class SearchCache:
+    """
+    SQLite cache of search results keyed by the normalized query and the
+    parameters that affect the results. Safe to share between threads, and
+    between the search tools running as separate processes.
+    """
+
+    def __init__(self, path=SEARCH_CACHE_PATH, ttl=SEARCH_CACHE_TTL,
+                 max_entries=SEARCH_CACHE_MAX_ENTRIES, max_bytes=SEARCH_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS results (
+            key TEXT PRIMARY KEY,
+            query TEXT,
+            stored REAL,
+            last_used REAL,
+            size INTEGER,
+            results TEXT
+        )
+        """)
+        self.conn.commit()
+
+    @staticmethod
+    def key(query, params=None):
+        return hashlib.sha256(json.dumps([normalize_query(query), params or {}], sort_keys=True).encode()).hexdigest()
+
+    def get(self, query, params=None):
+        """Return the cached results for a query, or None when missing or older than the TTL."""
+        key = self.key(query, params)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT stored, results FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[0] > self.ttl:
+                return None
+            self.conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+        return json.loads(row[1])
+
+    def put(self, query, results, params=None):
+        """Store the results of a query and evict old entries beyond the size limits."""
+        data = json.dumps(list(results))
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                              (self.key(query, params), normalize_query(query), now, now, len(data), data))
+            self.conn.execute("DELETE FROM results WHERE stored < ?", (now - self.ttl,))
+            self.conn.execute("""
+            DELETE FROM results WHERE key IN (
+                SELECT key FROM (
+                    SELECT key,
+                           ROW_NUMBER() OVER (ORDER BY last_used DESC) AS position,
+                           SUM(size) OVER (ORDER BY last_used DESC ROWS UNBOUNDED PRECEDING) AS total
+                    FROM results
+                ) WHERE position > ? OR total > ?
+            )
+            """, (self.max_entries, self.max_bytes))
+            self.conn.commit()
+
+    def search(self, fetch, query, params=None, refresh=False):
+        """
+        Read-through lookup: return cached results, or call fetch(query) and cache what it returns.
+        :param fetch: Callable running the live search; its return value is listed and cached.
+        :param query: Search query.
+        :param params: Dict of parameters that change the results, included in the key.
+        :param refresh: Ignore any cached entry and replace it with fresh results.
+        :return: Tuple of (results, cached).
+        """
+        if not refresh:
+            results = self.get(query, params)
+            if results is not None:
+                return results, True
+        results = list(fetch(query))
+        self.put(query, results, params)
+        return results, False
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM results")
+            self.conn.commit()
+
+_shared = None
+_shared_lock = threading.Lock()
+
+# Function to get the cache shared by everything in this process
+def shared_cache():
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = SearchCache()
+        return _shared
@@ -0,0 +1,289 @@
+import time
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait, as_completed
+from search_cache import shared_cache
+from search_backends import GoogleBackend, RateLimiter
+from url_utils import normalize_url, site_root
+
+# Results are handed to the UI at most every BATCH_INTERVAL seconds, or as soon
+# as BATCH_SIZE of them are waiting, so large result sets arrive in few signals
+BATCH_INTERVAL = 0.1
+BATCH_SIZE = 500
+
+class ResultBatcher:
+    """Collects results in a worker thread and passes them on in batches."""
+
+    def __init__(self, emit, interval=BATCH_INTERVAL, size=BATCH_SIZE):
+        self.emit = emit
+        self.interval = interval
+        self.size = size
+        self.pending = []
+        self.last_flush = time.monotonic()
+
+    def add(self, items):
+        self.pending.extend(items)
+        if len(self.pending) >= self.size:
+            self.flush()
+        else:
+            self.poll()
+
+    def poll(self):
+        """Flush if the interval has passed since the last batch."""
+        if self.pending and time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            items, self.pending = self.pending, []
+            self.emit(items)
+        self.last_flush = time.monotonic()
+
+# Dictionary of country codes, full names, and their national domains
+COUNTRY_DATA = {
+    "us": {"name": "United States", "domain": "site:us"},
+    "uk": {"name": "United Kingdom", "domain": "site:uk"},
+    "ca": {"name": "Canada", "domain": "site:ca"},
+    "au": {"name": "Australia", "domain": "site:au"},
+    "in": {"name": "India", "domain": "site:in"},
+    "de": {"name": "Germany", "domain": "site:de"},
+    "fr": {"name": "France", "domain": "site:fr"},
+    "ae": {"name": "United Arab Emirates", "domain": "site:ae"},
+    "sa": {"name": "Saudi Arabia", "domain": "site:sa"},
+    "om": {"name": "Oman", "domain": "site:om"},
+    "qa": {"name": "Qatar", "domain": "site:qa"},
+    "kw": {"name": "Kuwait", "domain": "site:kw"},
+    "bh": {"name": "Bahrain", "domain": "site:bh"},
+    # Add more countries as needed
+}
+
+# Per-country searches run at most SEARCH_WORKERS at a time, and no more than
+# SEARCH_RATE_LIMIT queries per second are started across all searches
+SEARCH_WORKERS = 4
+SEARCH_RATE_LIMIT = 1.0
+RESULTS_PER_QUERY = 10
+
+# Shared by every search thread so repeated clicks stay polite too
+search_limiter = RateLimiter(SEARCH_RATE_LIMIT)
+
+class SiteIndex:
+    """Groups result URLs by site root, with hit counts and the countries each site matched."""
+
+    def __init__(self):
+        self.sites = {}
+
+    def add(self, urls, country):
+        """Record one search's results; return the roots of the sites that changed."""
+        changed = {}
+        for url in urls:
+            root = site_root(url)
+            site = self.sites.get(root)
+            if site is None:
+                site = self.sites[root] = {"hits": 0, "pages": set(), "countries": set()}
+            site["hits"] += 1
+            site["pages"].add(normalize_url(url))
+            site["countries"].add(country)
+            changed[root] = True
+        return list(changed)
+
+    def describe(self, root):
+        site = self.sites[root]
+        return (f"{root}  -  {site['hits']} hit(s), {len(site['pages'])} page(s); "
+                f"{', '.join(sorted(site['countries']))}")
+
+class SiteSearch:
+    """
+    Moodle site search across COUNTRY_DATA. Per-country queries run on a
+    bounded pool under the global rate limit, and results are grouped by site.
+    """
+
+    def __init__(self, query, country_code, search_in_domains=False, refresh=False, backend=None):
+        self.query = query
+        self.country_code = country_code
+        self.search_in_domains = search_in_domains
+        self.refresh = refresh
+        self.backend = backend or GoogleBackend()
+        self.cancelled = threading.Event()
+        self.sites = SiteIndex()
+
+    def cancel(self):
+        """Stop starting new queries; queries already sent are abandoned."""
+        self.cancelled.set()
+
+    def queries(self):
+        """Return the (label, filters) pairs this search has to run."""
+        if self.search_in_domains:
+            if self.country_code:
+                # Search within the selected country's domain
+                data = COUNTRY_DATA[self.country_code]
+                return [(data["name"], {"domain": data["domain"].split(":", 1)[1]})]
+            # Search within all country domains
+            return [(data["name"], {"domain": data["domain"].split(":", 1)[1]}) for data in COUNTRY_DATA.values()]
+        # Perform a general search
+        if self.country_code:
+            return [(COUNTRY_DATA[self.country_code]["name"], {"country": self.country_code})]
+        return [("All Countries", {})]
+
+    def fetch(self, filters):
+        if not self.backend.remote:
+            return self.backend.search(self.query, RESULTS_PER_QUERY, **filters)
+        # Cached results skip the rate limiter altogether
+        cache = shared_cache()
+        params = dict(filters, backend=self.backend.name, num_results=RESULTS_PER_QUERY)
+        if not self.refresh:
+            results = cache.get(self.query, params)
+            if results is not None:
+                return results
+        if not search_limiter.wait(self.cancelled):
+            return []
+        results = self.backend.search(self.query, RESULTS_PER_QUERY, **filters)
+        cache.put(self.query, results, params)
+        return results
+
+    def run(self, emit):
+        """
+        Run the search, passing batches of (site root, row text) pairs and a
+        progress note to emit as results arrive.
+        :return: Tuple of (number of sites found, status message).
+        """
+        total = 0
+        failed = 0
+        futures = {}
+        pool = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+        try:
+            queries = self.queries()
+            futures = {pool.submit(self.fetch, filters): label for label, filters in queries}
+            # Results reach the UI in batches rather than one signal per search
+            batcher = ResultBatcher(lambda batch: emit(
+                batch, f"{len(queries) - len(futures)} of {len(queries)} search(es) done"
+            ))
+            while futures and not self.cancelled.is_set():
+                finished, _ = wait(futures, timeout=batcher.interval, return_when=FIRST_COMPLETED)
+                batcher.poll()
+                for future in finished:
+                    label = futures.pop(future)
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        logging.error(f"Search error ({label}): {e}")
+                        failed += 1
+                        continue
+                    total += len(results)
+                    if not self.cancelled.is_set():
+                        batcher.add([(root, self.sites.describe(root)) for root in self.sites.add(results, label)])
+            if not self.cancelled.is_set():
+                batcher.flush()
+        finally:
+            # Queued queries are dropped and waiting ones wake up; don't block on requests in flight
+            if futures:
+                self.cancelled.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        found = f"{len(self.sites.sites)} site(s) in {total} result(s)"
+        if futures:
+            return len(self.sites.sites), f"Search cancelled after {found}."
+        if failed:
+            return len(self.sites.sites), f"Found {found}; {failed} search(es) failed. Please try again later."
+        if not total:
+            return 0, "No results found. Please refine your search."
+        return len(self.sites.sites), f"Found {found}."
+
+# Job titles searched at once, live Google queries started per second across them,
+# and the database remembering every posting seen by earlier runs
+JOB_SEARCH_WORKERS = 3
+JOB_SEARCH_RATE_LIMIT = 0.5
+SEEN_JOBS_PATH = "seen_jobs.db"
+
+job_search_limiter = RateLimiter(JOB_SEARCH_RATE_LIMIT)
+
+class SeenJobs:
+    """Persistent set of normalized posting URLs found by earlier runs."""
+
+    def __init__(self, path=SEEN_JOBS_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS seen (
+            url TEXT PRIMARY KEY,
+            job_title TEXT,
+            first_seen REAL
+        )
+        """)
+        self.conn.commit()
+
+    def unseen(self, urls):
+        """Return the URLs that no earlier run has recorded, keeping their order."""
+        with self.lock:
+            known = set()
+            for start in range(0, len(urls), 500):
+                chunk = urls[start:start + 500]
+                known.update(row[0] for row in self.conn.execute(
+                    f"SELECT url FROM seen WHERE url IN ({', '.join('?' * len(chunk))})", chunk
+                ))
+        return [url for url in urls if url not in known]
+
+    def add(self, urls, job_title):
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO seen VALUES (?, ?, ?)",
+                                  [(url, job_title, time.time()) for url in urls])
+            self.conn.commit()
+
+# Function to search several job titles concurrently
+def find_jobs(job_titles, emit, only_new=False, refresh=False, seen_path=SEEN_JOBS_PATH):
+    """
+    Search job titles on a small pool of workers under a shared rate limit.
+    Result URLs are normalized and each posting is reported once, under the
+    first title that found it. Every posting found is recorded as seen.
+    :param job_titles: Titles to search for.
+    :param emit: Called with lists of output lines as titles complete.
+    :param only_new: Report only postings that earlier runs did not see.
+    :param refresh: Ignore cached search results.
+    :return: Number of postings reported.
+    """
+    seen = SeenJobs(seen_path)
+    never_cancelled = threading.Event()
+    reported = set()
+    count = 0
+
+    def fetch(query):
+        from googlesearch import search  # Import the Google Search function
+
+        job_search_limiter.wait(never_cancelled)
+        return search(
+            query,  # Search query as the first positional argument
+            stop=10,  # Stop after fetching 10 results
+            pause=2.0  # Delay between requests (in seconds)
+        )
+
+    def search_title(job_title):
+        # Perform Google search, unless it was run recently
+        return shared_cache().search(fetch, f"{job_title} jobs", params={'stop': 10}, refresh=refresh)
+
+    with ThreadPoolExecutor(max_workers=JOB_SEARCH_WORKERS) as pool:
+        futures = {pool.submit(search_title, job_title): job_title for job_title in dict.fromkeys(job_titles)}
+        for future in as_completed(futures):
+            job_title = futures[future]
+            try:
+                search_results, cached = future.result()
+            except Exception as e:
+                logging.error(f"Error fetching jobs for '{job_title}': {e}")
+                emit([f"Error fetching jobs for '{job_title}': {e}"])
+                continue
+
+            urls = [url for url in dict.fromkeys(normalize_url(url) for url in search_results)
+                    if url not in reported]
+            reported.update(urls)
+            new = seen.unseen(urls)
+            seen.add(urls, job_title)
+            shown = new if only_new else urls
+            count += len(shown)
+
+            note = " (cached)" if cached else ""
+            if not search_results:
+                emit([f"No jobs found for '{job_title}'{note}."])
+            elif only_new:
+                emit([f"'{job_title}': {len(new)} new posting(s) since the last run{note}."] + shown)
+            else:
+                emit([f"'{job_title}': {len(urls)} posting(s), {len(new)} new{note}."] + shown)
+    return count
@@ -0,0 +1,54 @@
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Query parameters that only track where a click came from
+TRACKING_PARAMS = {
+    "gclid", "fbclid", "msclkid", "dclid", "yclid", "mc_cid", "mc_eid", "igshid",
+    "ref", "ref_src", "referrer", "source", "src", "trk", "trackingid", "refid",
+}
+TRACKING_PREFIXES = ("utm_", "_hs", "pk_", "mtm_")
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Function to normalize a URL so different spellings of one page compare equal
+def normalize_url(url):
+    """
+    Lowercase the scheme and host, drop default ports, fragments, tracking
+    parameters and trailing slashes, and sort the remaining query parameters.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower() or "http"
+    host = (parts.hostname or "").rstrip(".")
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host += f":{parts.port}"
+    path = parts.path.rstrip("/") or "/"
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith(TRACKING_PREFIXES)
+    )
+    return urlunsplit((scheme, host, path, urlencode(query), ""))
+
+# First path segments of Moodle pages; whatever precedes them is the site's wwwroot
+MOODLE_ENTRY_POINTS = {
+    "login", "course", "mod", "user", "my", "admin", "blocks", "theme", "lib", "auth", "enrol",
+    "calendar", "grade", "message", "local", "report", "question", "badges", "blog", "cohort",
+    "index.php", "pluginfile.php", "webservice", "help.php", "lang",
+}
+
+# Function to reduce a URL to the root of the site it belongs to
+def site_root(url):
+    """
+    Return scheme://host[/subdirectory] for a URL, where the subdirectory is
+    the part of the path before the first Moodle entry point, so that
+    /moodle/login/index.php, /moodle/course/view.php?id=2 and /moodle/ share a root.
+    """
+    parts = urlsplit(normalize_url(url))
+    segments = [segment for segment in parts.path.split("/") if segment]
+    for position, segment in enumerate(segments):
+        if segment.lower() in MOODLE_ENTRY_POINTS:
+            segments = segments[:position]
+            break
+    else:
+        # Not a recognisable Moodle page: keep a single directory such as /moodle/,
+        # otherwise fall back to the host
+        if len(segments) != 1 or not urlsplit(url.strip()).path.endswith("/"):
+            segments = []
+    return urlunsplit((parts.scheme, parts.netloc, "/" + "/".join(segments), "", "")).rstrip("/")